@@ -0,0 +1,296 @@
+import html
+import http.server
+import logging
+import mimetypes
+import os
+import re
+import shutil
+import threading
+import zipfile
+from urllib.parse import quote, unquote, urlparse
+
+from awfulutils.manifest import ExportManifest
+from awfulutils.media import MediaStage
+from awfulutils.posts import PostExtractor
+
+logger = logging.getLogger(__name__)
+
+
+class ThreadArchive:
+    """
+    A thread export packed into a single zip file next to its output folder, instead of the tens of thousands of small
+    files a big thread exports to. Pages, stylesheets and posts are compressed, images are stored as they are since
+    they are already compressed, and any file can be read straight out of the archive through its central directory.
+
+    Only the manifest is left in the output folder once an export has been packed, so later exports of the thread
+    can still resume and sync. Those exports write just the pages and assets they fetch to the output folder, and
+    packing again merges them into the existing archive.
+    """
+    ARCHIVE_EXTENSION = '.zip'
+    STORED_EXTENSIONS = ['.gif', '.png', '.jpg', '.jpeg', '.webp', '.zip', '.parquet']
+    MANIFEST_FILENAMES = [ExportManifest.FILENAME, ExportManifest.FILENAME + '-wal', ExportManifest.FILENAME + '-shm']
+    PAGE_FILENAME_PATTERN = re.compile(r'^page_(\d+)\.html$')
+    PAGE_POSTS_FILENAME_PATTERN = re.compile(r'^%s/page_(\d+)\.jsonl$' % PostExtractor.POSTS_FOLDER)
+
+    def __init__(self, archive_filename):
+        self.archive_filename = archive_filename
+        self.zip_file = zipfile.ZipFile(archive_filename)
+        self.pages = {}
+        for name in self.zip_file.namelist():
+            page_match = self.PAGE_FILENAME_PATTERN.match(name)
+            if page_match:
+                self.pages[int(page_match.group(1))] = name
+        self.total_pages = max(self.pages) if self.pages else 0
+
+    def close(self):
+        self.zip_file.close()
+
+    def names(self):
+        return self.zip_file.namelist()
+
+    def read(self, name):
+        """
+        :param name: path of a file relative to the output folder, such as images/smile.gif
+        :return: the contents of the file
+        :raises KeyError: if the file is not in the archive
+        """
+        return self.zip_file.read(name)
+
+    def page(self, page_number):
+        """
+        :param page_number:
+        :return: the saved html of a page
+        :raises KeyError: if the page is not in the archive
+        """
+        return self.zip_file.read(self.pages[page_number])
+
+    @classmethod
+    def archive_filename(cls, output_folder):
+        return os.path.normpath(output_folder) + cls.ARCHIVE_EXTENSION
+
+    @classmethod
+    def pack(cls, output_folder, remove=False):
+        """
+        Pack an export into its archive, merging it with what was packed before. Files in the output folder replace
+        the same files in the archive, and posts.jsonl is put back together from the posts of every page. The archive
+        is written under a temporary name and moved into place once complete.
+        :param output_folder:
+        :param remove: remove everything but the manifest from the output folder once it has been packed
+        :return: the archive filename
+        """
+        archive_filename = cls.archive_filename(output_folder)
+        # the thread's posts are rebuilt from the posts of each page, since the folder may only have some pages
+        rebuilt_filenames = cls.MANIFEST_FILENAMES + [PostExtractor.POSTS_FILENAME,
+                                                      PostExtractor.POSTS_PARQUET_FILENAME]
+        folder_files = {}
+        for folder, _, filenames in os.walk(output_folder):
+            for filename in filenames:
+                name = os.path.relpath(os.path.join(folder, filename), output_folder).replace(os.sep, '/')
+                # the media folder only shares files between the images on disk, zip files cannot share them
+                if name not in rebuilt_filenames and not name.endswith('.part') and \
+                        not name.startswith(MediaStage.MEDIA_FOLDER + '/'):
+                    folder_files[name] = os.path.join(folder, filename)
+        folder_page_numbers = set(int(page_match.group(1)) for page_match in
+                                  map(cls.PAGE_FILENAME_PATTERN.match, folder_files) if page_match)
+        posts_parquet = os.path.exists(os.path.join(output_folder, PostExtractor.POSTS_PARQUET_FILENAME))
+
+        previous_archive = zipfile.ZipFile(archive_filename) if os.path.exists(archive_filename) else None
+        page_posts = {}
+        try:
+            with zipfile.ZipFile(archive_filename + '.part', 'w', allowZip64=True) as archive:
+                if previous_archive:
+                    for info in previous_archive.infolist():
+                        page_match = cls.PAGE_FILENAME_PATTERN.match(info.filename)
+                        if info.filename == PostExtractor.POSTS_PARQUET_FILENAME:
+                            posts_parquet = True
+                        # page filenames change when the thread grows by a digit, so pages are matched by number
+                        if info.filename in folder_files or info.filename in rebuilt_filenames or \
+                                (page_match and int(page_match.group(1)) in folder_page_numbers):
+                            continue
+                        # writing updates the offsets in the info, which are still needed to read the previous archive
+                        copied_info = zipfile.ZipInfo(info.filename, info.date_time)
+                        copied_info.compress_type = info.compress_type
+                        copied_info.external_attr = info.external_attr
+                        archive.writestr(copied_info, previous_archive.read(info))
+                        cls.__collect_page_posts(page_posts, info.filename, previous_archive.read, info.filename)
+                for name, filename in sorted(folder_files.items()):
+                    archive.write(filename, name, compress_type=cls.__compress_type(name))
+                    cls.__collect_page_posts(page_posts, name, cls.__read_file, filename)
+                if page_posts:
+                    cls.__write_posts(archive, output_folder, page_posts, posts_parquet)
+            os.replace(archive_filename + '.part', archive_filename)
+        finally:
+            if previous_archive:
+                previous_archive.close()
+            if os.path.exists(archive_filename + '.part'):
+                os.remove(archive_filename + '.part')
+
+        if remove:
+            for name in os.listdir(output_folder):
+                filename = os.path.join(output_folder, name)
+                if os.path.isdir(filename):
+                    shutil.rmtree(filename)
+                elif name not in cls.MANIFEST_FILENAMES:
+                    os.remove(filename)
+        return archive_filename
+
+    @classmethod
+    def __collect_page_posts(cls, page_posts, name, read, source):
+        page_posts_match = cls.PAGE_POSTS_FILENAME_PATTERN.match(name)
+        if page_posts_match:
+            page_posts[int(page_posts_match.group(1))] = (read, source)
+
+    @classmethod
+    def __write_posts(cls, archive, output_folder, page_posts, posts_parquet):
+        """
+        Put the thread's posts back together from the posts of every page, in page order
+        :param archive:
+        :param output_folder: where the posts are written while they are being put together
+        :param page_posts: dict of page number to a function and its argument that read the page's posts
+        :param posts_parquet: also write posts.parquet
+        :return:
+        """
+        posts_filename = os.path.join(output_folder, PostExtractor.POSTS_FILENAME + '.part')
+        parquet_filename = os.path.join(output_folder, PostExtractor.POSTS_PARQUET_FILENAME + '.part')
+        try:
+            with open(posts_filename, 'wb') as posts_file:
+                for page_number in sorted(page_posts):
+                    read, source = page_posts[page_number]
+                    posts_file.write(read(source))
+            archive.write(posts_filename, PostExtractor.POSTS_FILENAME, compress_type=zipfile.ZIP_DEFLATED)
+            if posts_parquet:
+                PostExtractor.write_parquet(posts_filename, parquet_filename)
+                archive.write(parquet_filename, PostExtractor.POSTS_PARQUET_FILENAME, compress_type=zipfile.ZIP_STORED)
+        finally:
+            for filename in [posts_filename, parquet_filename]:
+                if os.path.exists(filename):
+                    os.remove(filename)
+
+    @staticmethod
+    def __read_file(filename):
+        with open(filename, 'rb') as input_file:
+            return input_file.read()
+
+    @classmethod
+    def __compress_type(cls, name):
+        if os.path.splitext(name)[1].lower() in cls.STORED_EXTENSIONS:
+            return zipfile.ZIP_STORED
+        return zipfile.ZIP_DEFLATED
+
+
+class ArchiveServer(http.server.ThreadingHTTPServer):
+    """
+    Serves a folder of thread exports for viewing in a browser, reading files from each thread's output folder or
+    straight out of its archive. Pages are served at the same paths they would have on disk, such as
+    /somethingawful_thread_3677640/page_2.html, so links between pages and from the search index still work.
+    """
+    def __init__(self, folder, server_address):
+        super().__init__(server_address, ArchiveRequestHandler)
+        self.folder = folder
+        self.lock = threading.Lock()
+        self.archives = {}
+
+    def server_close(self):
+        super().server_close()
+        with self.lock:
+            for mtime, archive in self.archives.values():
+                archive.close()
+            self.archives.clear()
+
+    def archive(self, export_name):
+        """
+        :param export_name: name of a thread's output folder
+        :return: the thread's ThreadArchive, or None if it has not been packed
+        """
+        archive_filename = ThreadArchive.archive_filename(os.path.join(self.folder, export_name))
+        if not os.path.exists(archive_filename):
+            return None
+        mtime = os.stat(archive_filename).st_mtime
+        with self.lock:
+            previous_mtime, archive = self.archives.get(export_name, (None, None))
+            # an archive that is packed again while being served is replaced, so open the new one
+            if archive and previous_mtime != mtime:
+                archive.close()
+                archive = None
+            if archive is None:
+                archive = ThreadArchive(archive_filename)
+                self.archives[export_name] = (mtime, archive)
+            return archive
+
+    def export_names(self):
+        """
+        :return: sorted names of the thread exports in the folder, packed or not
+        """
+        export_names = set()
+        for name in os.listdir(self.folder):
+            if name.endswith(ThreadArchive.ARCHIVE_EXTENSION):
+                export_names.add(name[:-len(ThreadArchive.ARCHIVE_EXTENSION)])
+            elif os.path.exists(os.path.join(self.folder, name, ExportManifest.FILENAME)):
+                export_names.add(name)
+        return sorted(export_names)
+
+
+class ArchiveRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves a file from a thread's output folder if it is there, otherwise from the thread's archive
+    """
+    def do_GET(self):
+        self.__serve(send_body=True)
+
+    def do_HEAD(self):
+        self.__serve(send_body=False)
+
+    def __serve(self, send_body):
+        path = unquote(urlparse(self.path).path).strip('/')
+        if not path:
+            return self.__send_index(send_body)
+        export_name, _, name = path.partition('/')
+        if '..' in path.split('/') or '\\' in path:
+            return self.send_error(404)
+        if not name:
+            self.send_response(302)
+            self.send_header('Location', '/%s/' % quote(export_name) + self.__first_page(export_name))
+            return self.end_headers()
+
+        filename = os.path.join(self.server.folder, export_name, *name.split('/'))
+        if os.path.isfile(filename):
+            with open(filename, 'rb') as input_file:
+                data = input_file.read()
+        else:
+            archive = self.server.archive(export_name)
+            try:
+                data = archive.read(name) if archive else None
+            except KeyError:
+                data = None
+        if data is None:
+            return self.send_error(404)
+        self.__send(data, mimetypes.guess_type(name)[0] or 'application/octet-stream', send_body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def __first_page(self, export_name):
+        archive = self.server.archive(export_name)
+        if archive and archive.pages:
+            return archive.pages[min(archive.pages)]
+        folder = os.path.join(self.server.folder, export_name)
+        if not os.path.isdir(folder):
+            return ''
+        page_filenames = sorted(name for name in os.listdir(folder) if ThreadArchive.PAGE_FILENAME_PATTERN.match(name))
+        return page_filenames[0] if page_filenames else ''
+
+    def __send_index(self, send_body):
+        items = ''.join('<li><a href="/%s/">%s</a></li>' % (quote(export_name), html.escape(export_name))
+                        for export_name in self.server.export_names())
+        self.__send(('<!DOCTYPE html><html><head><meta charset="utf-8"><title>Thread exports</title></head>'
+                     '<body><ul>%s</ul></body></html>' % items).encode('utf-8'), 'text/html', send_body)
+
+    def __send(self, data, content_type, send_body):
+        if content_type.startswith('text/') and 'charset' not in content_type:
+            content_type += '; charset=utf-8'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(data)
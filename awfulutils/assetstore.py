@@ -0,0 +1,106 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+
+
+class AssetStore:
+    """
+    Content addressed store of images and stylesheets shared by any number of thread exports. Each file is kept once,
+    named after the sha256 of its contents, and an index maps the hash of every url that has been downloaded to the
+    file it produced. Thread export folders get hardlinks to the stored files, so the same smilies, avatars and forum
+    stylesheets are only downloaded and stored once across every export that uses the store.
+    """
+    INDEX_FILENAME = 'index.sqlite'
+    OBJECTS_FOLDER = 'objects'
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.objects_folder = os.path.join(folder, self.OBJECTS_FOLDER)
+        os.makedirs(self.objects_folder, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(folder, self.INDEX_FILENAME), check_same_thread=False,
+                                          isolation_level=None, timeout=30)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS urls (
+                url_hash TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                sha256 TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                stored_at REAL
+            );
+        ''')
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def lookup(self, url):
+        """
+        Find the stored copy of a url that has been downloaded before
+        :param url:
+        :return: tuple of the stored filename, its size and sha256 hex digest, or None if the url is not in the store
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT sha256, size FROM urls WHERE url_hash = ?',
+                                          (self.__url_hash(url),)).fetchone()
+        if row is None:
+            return None
+        sha256, size = row
+        stored_filename = self.__stored_filename(sha256)
+        if not os.path.exists(stored_filename):
+            return None
+        return stored_filename, size, sha256
+
+    def add(self, url, filename, size, sha256):
+        """
+        Add a downloaded file to the store, unless a file with the same contents is already stored, and record the url
+        it was downloaded from
+        :param url:
+        :param filename: downloaded file, which is left in place
+        :param size: size of the file in bytes
+        :param sha256: hex digest of the file contents
+        :return: the stored filename
+        """
+        stored_filename = self.__stored_filename(sha256)
+        if not os.path.exists(stored_filename):
+            os.makedirs(os.path.dirname(stored_filename), exist_ok=True)
+            self.link(filename, stored_filename)
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO urls (url_hash, url, sha256, size, stored_at)'
+                                    ' VALUES (?, ?, ?, ?, ?)', (self.__url_hash(url), url, sha256, size, time.time()))
+        return stored_filename
+
+    @staticmethod
+    def link(source_filename, output_filename):
+        """
+        Hardlink a file into place, copying it instead where hardlinks are not possible, such as across filesystems.
+        The link is made under a unique temporary name and moved into place, so several exports can link the same
+        file at once and an existing output file is replaced.
+        :param source_filename:
+        :param output_filename:
+        :return:
+        """
+        partial_filename = '%s.%s.part' % (output_filename, uuid.uuid4().hex)
+        try:
+            try:
+                os.link(source_filename, partial_filename)
+            except OSError:
+                shutil.copyfile(source_filename, partial_filename)
+            os.replace(partial_filename, output_filename)
+        finally:
+            if os.path.exists(partial_filename):
+                os.remove(partial_filename)
+
+    @staticmethod
+    def __url_hash(url):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def __stored_filename(self, sha256):
+        return os.path.join(self.objects_folder, sha256[:2], sha256)
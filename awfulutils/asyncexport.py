@@ -0,0 +1,329 @@
+import asyncio
+import concurrent.futures
+import functools
+import hashlib
+import logging
+import os
+import random
+import time
+
+import aiohttp
+from yarl import URL
+
+from awfulutils.archive import ThreadArchive
+from awfulutils.awfulclient import AwfulClient, PageRewriter, ThreadExport
+from awfulutils.manifest import ExportManifest
+from awfulutils.metrics import ExportMetrics
+from awfulutils.posts import PostExtractor
+from awfulutils.scheduler import RequestScheduler
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncThreadExport:
+    """
+    Exports a thread the same way ThreadExport does, but all of the page and asset downloads are done on a single
+    asyncio event loop. Parsing and rewriting pages is still done in a pool of worker threads. Requests do not go
+    through a RequestScheduler: connections are limited per host by aiohttp instead, and transient failures are
+    retried with the same jittered exponential backoff.
+    """
+    DEFAULT_MAX_CONNECTIONS = 100
+    DEFAULT_MAX_CONNECTIONS_PER_HOST = 10
+    DEFAULT_PAGE_CONCURRENCY = 5
+    DEFAULT_PARSE_WORKERS = 5
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, cookies, threadid, timeout=AwfulClient.DEFAULT_TIMEOUT_SECONDS, posts_per_page=40,
+                 max_connections=DEFAULT_MAX_CONNECTIONS, max_connections_per_host=DEFAULT_MAX_CONNECTIONS_PER_HOST,
+                 page_concurrency=DEFAULT_PAGE_CONCURRENCY, parse_workers=DEFAULT_PARSE_WORKERS, parse_processes=None,
+                 parser=AwfulClient.DEFAULT_PARSER, single_pass=False, pretty=True, asset_store=None,
+                 extract_posts=False, posts_parquet=False, search_index=None, archive=False, media=None,
+                 max_retries=RequestScheduler.DEFAULT_MAX_RETRIES,
+                 backoff_seconds=RequestScheduler.DEFAULT_BACKOFF_SECONDS, metrics=None):
+        """
+        :param cookies: dict of the forum cookies, only sent with requests for thread pages
+        :param threadid:
+        :param timeout: seconds to wait when connecting or reading
+        :param posts_per_page:
+        :param max_connections: limit on the number of connections open at once across all hosts
+        :param max_connections_per_host: limit on the number of connections open at once to any single host
+        :param page_concurrency: limit on the number of pages being downloaded or rewritten at once
+        :param parse_workers: number of threads used to parse and rewrite pages
+        :param parse_processes: if set, pages are parsed and rewritten in a pool of this many processes instead
+        :param parser: BeautifulSoup tree builder used to parse pages, html5lib or lxml
+        :param single_pass: rewrite each page in a single pass instead of a pass per kind of change
+        :param pretty: pretty print the saved pages
+        :param asset_store: AssetStore consulted before downloading images and stylesheets
+        :param extract_posts: also save the posts on every page as structured records, see PostExtractor
+        :param posts_parquet: save the extracted posts as parquet as well as JSON lines. Requires pyarrow.
+        :param search_index: SearchIndex the posts on each page are added to as the page is saved
+        :param archive: pack the export into a single zip file once it has finished, see ThreadArchive
+        :param media: MediaStage the images are run through once they have been downloaded
+        :param max_retries: how many times a timeout, dropped connection, or 5xx or 429 response is retried
+        :param backoff_seconds: delay before the first retry, doubled for each one after, with full jitter
+        :param metrics: ExportMetrics each stage of the export is measured in
+        """
+        if posts_parquet:
+            # fail now rather than once the whole thread has been exported
+            import pyarrow
+        self.cookies = cookies
+        self.threadid = threadid
+        self.timeout = timeout
+        self.posts_per_page = posts_per_page
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.page_concurrency = page_concurrency
+        self.parse_workers = parse_workers
+        self.parse_processes = parse_processes
+        self.parser = parser
+        self.single_pass = single_pass
+        self.pretty = pretty
+        self.asset_store = asset_store
+        self.extract_posts = extract_posts or posts_parquet or search_index is not None
+        self.posts_parquet = posts_parquet
+        self.search_index = search_index
+        self.archive = archive
+        self.media = media
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.metrics = metrics or ExportMetrics()
+        self.total_pages = None
+        self.page_pad_zeros = None
+        self.output_folder = None
+        self.rewriter = None
+        self.manifest = None
+        self.downloads = {}
+
+    def thread_url(self, page_number):
+        return '%s/showthread.php?perpage=%d&threadid=%d&pagenumber=%d'\
+               % (AwfulClient.FORUMS_URL, self.posts_per_page, self.threadid, page_number)
+
+    async def save(self):
+        """
+        Saves all the pages and images, waiting for every page and asset download to finish
+        :return: dict with the number of pages saved, images and stylesheets downloaded, and pages and images and
+        stylesheets still unfinished, which the next export of the thread will retry
+        """
+        connector = aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.max_connections_per_host)
+        client_timeout = aiohttp.ClientTimeout(sock_connect=self.timeout, sock_read=self.timeout)
+        headers = {'User-Agent': AwfulClient.USER_AGENT}
+        loop = asyncio.get_running_loop()
+        if self.parse_processes:
+            parse_executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.parse_processes)
+        else:
+            parse_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.parse_workers)
+        with parse_executor:
+            async with aiohttp.ClientSession(connector=connector, timeout=client_timeout, headers=headers) as http:
+                # retrieve some basic info about the thread
+                first_page = await self.__fetch_page(http, 1)
+                self.total_pages = await loop.run_in_executor(parse_executor, ThreadExport.parse_total_pages,
+                                                              first_page[0], self.parser)
+                self.page_pad_zeros = len(str(self.total_pages))
+                self.output_folder = ThreadExport.create_output_folders(self.threadid)
+                self.rewriter = PageRewriter(self.threadid, self.total_pages, self.output_folder, parser=self.parser,
+                                             single_pass=self.single_pass, pretty=self.pretty,
+                                             extract_posts=self.extract_posts,
+                                             unique_image_names=self.media is not None)
+
+                logger.info('Saving thread %d export to %s' % (self.threadid, self.output_folder))
+                self.manifest = ExportManifest(self.output_folder)
+                page_numbers = self.manifest.pages_to_fetch(self.total_pages)
+                self.manifest.set('total_pages', self.total_pages)
+                if len(page_numbers) < self.total_pages:
+                    logger.info('Skipping %d pages saved by a previous export' % (self.total_pages - len(page_numbers)))
+                for url, asset_filename, page_number in self.manifest.unfinished_assets():
+                    self.__enqueue(http, url, asset_filename, page_number or 0)
+                for url, asset_filename in self.rewriter.static_assets():
+                    self.__enqueue(http, url, asset_filename, 0)
+
+                page_semaphore = asyncio.Semaphore(self.page_concurrency)
+                results = await asyncio.gather(*[
+                    self.__save_page(http, parse_executor, page_semaphore, page_number,
+                                     first_page if page_number == 1 else None)
+                    for page_number in page_numbers
+                ], return_exceptions=True)
+                saved_pages_count = 0
+                for page_number, result in zip(page_numbers, results):
+                    if isinstance(result, Exception):
+                        self.manifest.page_failed(page_number)
+                        logger.error('Error saving page %d: %r' % (page_number, result))
+                    else:
+                        saved_pages_count += 1
+
+                logger.info('Waiting for images and stylesheets to finish downloading')
+                downloaded = await asyncio.gather(*self.downloads.values(), return_exceptions=True)
+                for output_filename, result in zip(self.downloads.keys(), downloaded):
+                    if isinstance(result, Exception):
+                        logger.error('Error downloading %s: %r' % (output_filename, result))
+                # the remaining steps read and write whole files, so they are run off the event loop, which other
+                # exports may be sharing
+                if self.extract_posts:
+                    posts_count = await loop.run_in_executor(None, functools.partial(
+                        PostExtractor.stitch, self.output_folder, parquet=self.posts_parquet))
+                    logger.info('Saved %d posts to %s' % (posts_count, PostExtractor.POSTS_FILENAME))
+                if self.media is not None:
+                    await loop.run_in_executor(None, self.media.process, self.output_folder, self.manifest)
+                unfinished_pages_count, unfinished_assets_count = self.manifest.unfinished_counts(self.total_pages)
+                self.manifest.close()
+                if self.archive:
+                    archive_filename = await loop.run_in_executor(None, functools.partial(
+                        ThreadArchive.pack, self.output_folder, remove=True))
+                    logger.info('Packed export into %s' % archive_filename)
+                downloaded_count = sum(1 for result in downloaded if result is True)
+                logger.info('Finished exporting thread (%d images and stylesheets downloaded)' % downloaded_count)
+                if unfinished_pages_count or unfinished_assets_count:
+                    logger.warning('Thread %d has %d pages and %d images and stylesheets that could not be saved,'
+                                   ' exporting it again will retry them'
+                                   % (self.threadid, unfinished_pages_count, unfinished_assets_count))
+                return {
+                    'saved_pages_count': saved_pages_count,
+                    'downloaded_assets_count': downloaded_count,
+                    'unfinished_pages_count': unfinished_pages_count,
+                    'unfinished_assets_count': unfinished_assets_count
+                }
+
+    async def __fetch_page(self, http, page_number):
+        """
+        :return: tuple of the page html and a dict of its ETag and Last-Modified headers
+        :raises aiohttp.ClientError: if the page could not be retrieved, including error responses
+        """
+        return await self.__retry(self.thread_url(page_number), self.__fetch_page_once, http, page_number)
+
+    async def __fetch_page_once(self, http, page_number):
+        start = time.time()
+        async with http.get(self.thread_url(page_number), cookies=self.cookies) as response:
+            # an error page has no paginator, and would be counted as a one page thread and saved over the real page
+            response.raise_for_status()
+            validators = {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+            html = await response.text()
+        self.metrics.observe('page_fetch', time.time() - start)
+        self.metrics.count('bytes_downloaded', len(html.encode('utf-8')), host=response.url.host)
+        return html, validators
+
+    async def __save_page(self, http, parse_executor, page_semaphore, page_number, fetched_page=None):
+        """
+        Saves a single page and queues its images and stylesheets for download
+        :param http:
+        :param parse_executor:
+        :param page_semaphore:
+        :param page_number:
+        :param fetched_page: page html and validators if it has already been retrieved
+        :return:
+        """
+        output_filename = os.path.join(self.output_folder,
+                                       PageRewriter.PAGE_PATTERN_FILENAME % str(page_number).zfill(self.page_pad_zeros))
+        async with page_semaphore:
+            start = time.time()
+            logger.info('Starting thread %d page %d/%d' % (self.threadid, page_number, self.total_pages))
+            if fetched_page is None:
+                fetched_page = await self.__fetch_page(http, page_number)
+            html, validators = fetched_page
+            page = await asyncio.get_running_loop().run_in_executor(
+                parse_executor, self.rewriter.save, html, page_number, output_filename)
+            for stage, seconds in page['timings'].items():
+                self.metrics.observe(stage, seconds)
+            self.manifest.page_complete(page_number, page['size'], page['sha256'], page['assets'], **validators)
+            if self.search_index is not None:
+                self.search_index.index_page(self.threadid, page_number, output_filename, page['posts'])
+
+        queued_assets_count = 0
+        for url, asset_filename in page['assets']:
+            if self.__enqueue(http, url, asset_filename, page_number):
+                queued_assets_count += 1
+        self.metrics.observe('page', time.time() - start)
+        logger.info('Finished page %d/%d (%d new images and stylesheets queued) in %d seconds'
+                    % (page_number, self.total_pages, queued_assets_count, time.time() - start))
+
+    def __enqueue(self, http, url, output_filename, page_number):
+        """
+        Start a download unless the same output file has already been started or was downloaded by a previous export
+        :return: True if the download was started
+        """
+        if output_filename in self.downloads or self.manifest.asset_is_complete(output_filename):
+            return False
+        self.downloads[output_filename] = asyncio.ensure_future(self.__download(http, url, output_filename,
+                                                                                page_number))
+        return True
+
+    async def __download(self, http, url, output_filename, page_number):
+        """
+        Download a single file under a temporary name, moving it into place once it is complete
+        :param http:
+        :param url:
+        :param output_filename:
+        :param page_number: page the asset was found on, used for logging
+        :return: True if the file was downloaded, False if it could not be downloaded
+        """
+        if self.asset_store:
+            stored = self.asset_store.lookup(url)
+            if stored:
+                stored_filename, size, sha256 = stored
+                self.asset_store.link(stored_filename, output_filename)
+                self.manifest.asset_complete(output_filename, url, size, sha256)
+                return True
+
+        partial_filename = output_filename + '.part'
+        downloaded = False
+        try:
+            size, sha256 = await self.__retry(url, self.__fetch, http, url, partial_filename)
+            self.metrics.count('bytes_downloaded', size, host=URL(url, encoded=True).host)
+            if self.asset_store:
+                self.asset_store.add(url, partial_filename, size, sha256)
+            os.replace(partial_filename, output_filename)
+            self.manifest.asset_complete(output_filename, url, size, sha256)
+            downloaded = True
+        except aiohttp.ClientError as e:
+            logger.warning('Error downloading %s on page %d due to %s' % (url, page_number, e))
+        except asyncio.TimeoutError:
+            logger.warning('Error downloading %s on page %d because %d second timeout was reached'
+                           % (url, page_number, self.timeout))
+        finally:
+            if os.path.exists(partial_filename):
+                os.remove(partial_filename)
+            if not downloaded:
+                self.manifest.asset_failed(output_filename, url)
+        return downloaded
+
+    async def __fetch(self, http, url, partial_filename):
+        """
+        Stream a single download to disk, starting the file over on every attempt
+        :return: tuple of the size in bytes and sha256 hex digest of the download
+        """
+        size = 0
+        sha256 = hashlib.sha256()
+        async with http.get(URL(url, encoded=True), raise_for_status=True) as response:
+            with open(partial_filename, 'wb') as output_file:
+                async for chunk in response.content.iter_chunked(self.CHUNK_SIZE):
+                    output_file.write(chunk)
+                    sha256.update(chunk)
+                    size += len(chunk)
+        return size, sha256.hexdigest()
+
+    async def __retry(self, url, function, *args):
+        """
+        Await a request, awaiting it again after a backoff if it times out, loses its connection or gets a status
+        code worth retrying, until max_retries runs out
+        :param url: url the function requests, used for logging
+        :param function: coroutine function making the request
+        :return: whatever the function returns
+        """
+        attempt = 0
+        while True:
+            try:
+                return await function(*args)
+            except (aiohttp.ClientResponseError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError,
+                    asyncio.TimeoutError) as e:
+                status = getattr(e, 'status', None)
+                retry = status is None or status in RequestScheduler.RETRY_STATUS_CODES
+                if not retry or attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                delay = random.uniform(0, min(RequestScheduler.MAX_BACKOFF_SECONDS,
+                                              self.backoff_seconds * 2 ** (attempt - 1)))
+                retry_after = (getattr(e, 'headers', None) or {}).get('Retry-After', '')
+                if retry_after.isdigit():
+                    delay = max(delay, min(float(retry_after), RequestScheduler.MAX_BACKOFF_SECONDS))
+                self.metrics.count('retries', host=URL(url, encoded=True).host)
+                logger.warning('Retrying %s in %.1f seconds (attempt %d of %d) due to %r'
+                               % (url, delay, attempt, self.max_retries, e))
+                await asyncio.sleep(delay)
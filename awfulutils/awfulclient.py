@@ -1,20 +1,31 @@
+import collections
 import concurrent.futures
-import glob
+import contextlib
+import functools
+import hashlib
+import itertools
 import logging
 import os
 import re
-import shutil
-import urllib.request
+import threading
 import time
+import weakref
 from datetime import datetime
-from http.client import RemoteDisconnected
 from urllib import parse
-from urllib.error import URLError
 from urllib.parse import urlparse, parse_qs, urljoin, quote
 
 import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, Tag
+from bs4.element import AttributeValueWithCharsetSubstitution
 from requests import Timeout
+from requests.adapters import HTTPAdapter
+
+from awfulutils.archive import ThreadArchive
+from awfulutils.manifest import ExportManifest
+from awfulutils.posts import PostExtractor
+from awfulutils.progress import ExportCancelled, ExportControl, ExportHandle, ProgressTracker
+from awfulutils.scheduler import RequestScheduler
+from awfulutils.usercache import UserInfoCache
 
 logger = logging.getLogger(__name__)
 
@@ -22,13 +33,33 @@ logger = logging.getLogger(__name__)
 class AwfulClient:
     DATE_FORMAT = '%b %d, %Y'
     DATETIME_FORMAT = '%b %d, %Y %H:%M'
+    LAST_POST_DATETIME_FORMAT = '%H:%M %b %d, %Y'
     USER_AGENT = 'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:33.0) Gecko/20100101 Firefox/33.0'
     FORUMS_URL = 'http://forums.somethingawful.com'
     DEFAULT_TIMEOUT_SECONDS = 10
+    DEFAULT_PARSER = 'html5lib'
+    DEFAULT_USERINFO_WORKERS = 5
+    DEFAULT_THREADS_AT_ONCE = 4
+    DEFAULT_BULK_PAGE_WORKERS = 10
+    DEFAULT_BULK_ASSET_WORKERS = 20
 
-    def __init__(self, userid, sessionid, timeout=DEFAULT_TIMEOUT_SECONDS):
+    def __init__(self, userid, sessionid, timeout=DEFAULT_TIMEOUT_SECONDS, parser=DEFAULT_PARSER, userinfo_cache=None,
+                 scheduler=None, metrics=None):
+        """
+        :param userid:
+        :param sessionid:
+        :param timeout:
+        :param parser: BeautifulSoup tree builder used to parse pages, html5lib or lxml
+        :param userinfo_cache: UserInfoCache that user details are looked up in first, an in memory cache by default
+        :param scheduler: RequestScheduler every request is made through, shared with thread exports
+        :param metrics: ExportMetrics that user lookups and thread exports are measured in, the scheduler's by default
+        """
         self.userid = userid
         self.timeout = timeout
+        self.parser = parser
+        self.userinfo_cache = userinfo_cache if userinfo_cache is not None else UserInfoCache()
+        self.scheduler = scheduler or RequestScheduler(metrics=metrics)
+        self.metrics = metrics or self.scheduler.metrics
         self.session = requests.Session()
         self.session.cookies.set('bbuserid', str(userid))
         self.session.cookies.set('bbpassword', sessionid)
@@ -40,8 +71,60 @@ class AwfulClient:
         :param userid:
         :return:
         """
-        r = self.session.get('%s/member.php?action=getinfo&userid=%d' % (self.FORUMS_URL, userid), timeout=self.timeout)
-        soup = BeautifulSoup(r.text, 'html5lib')
+        userinfo = self.userinfo_cache.get(userid)
+        if userinfo is None:
+            self.metrics.count('userinfo_cache_misses')
+            with self.metrics.time('userinfo_fetch'):
+                r = self.scheduler.get(self.session,
+                                       '%s/member.php?action=getinfo&userid=%d' % (self.FORUMS_URL, userid),
+                                       timeout=self.timeout)
+            with self.metrics.time('userinfo_parse'):
+                userinfo = self.parse_userinfo(r.text, self.parser)
+            self.userinfo_cache.put(userid, userinfo)
+        else:
+            self.metrics.count('userinfo_cache_hits')
+        return userinfo
+
+    def userinfo_many(self, userids, max_workers=DEFAULT_USERINFO_WORKERS):
+        """
+        Retrieve user details for many users at once. Cached users are served locally and the rest are fetched by a
+        pool of workers. Users that could not be retrieved are logged and left out.
+        :param userids: iterable of user ids, duplicates are only looked up once
+        :param max_workers: limit on the number of profiles being fetched at once
+        :return: dict of user id to UserInfo
+        """
+        userinfos = {}
+        missing_userids = []
+        for userid in dict.fromkeys(userids):
+            userinfo = self.userinfo_cache.get(userid)
+            if userinfo is None:
+                missing_userids.append(userid)
+            else:
+                userinfos[userid] = userinfo
+        if not missing_userids:
+            return userinfos
+
+        logger.info('Fetching %d of %d users not found in the cache' % (len(missing_userids),
+                                                                         len(missing_userids) + len(userinfos)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            future_userids = {executor.submit(self.userinfo, userid): userid for userid in missing_userids}
+            for future in concurrent.futures.as_completed(future_userids):
+                userid = future_userids[future]
+                try:
+                    userinfos[userid] = future.result()
+                except Exception:
+                    logger.exception('Error retrieving user %d' % userid)
+        return userinfos
+
+    @classmethod
+    def parse_userinfo(cls, html, parser=DEFAULT_PARSER):
+        """
+        Read the user details from a profile page
+        :param html:
+        :param parser:
+        :return:
+        """
+        soup = BeautifulSoup(html, parser)
 
         userinfo_elem = soup.find('dl', class_='userinfo')
 
@@ -61,15 +144,15 @@ class AwfulClient:
         additional_elem = soup.find('dl', class_='additional')
 
         join_date_string = additional_elem.find('dt', text=re.compile('Member Since')).findNext('dd').get_text()
-        userinfo.join_date = datetime.strptime(join_date_string, self.DATE_FORMAT)
+        userinfo.join_date = datetime.strptime(join_date_string, cls.DATE_FORMAT)
 
         userinfo.post_count = int(additional_elem.find('dt', text=re.compile('Post Count')).findNext('dd').get_text())
 
         posts_per_day_string = additional_elem.find('dt', text=re.compile('Post Rate')).findNext('dd').get_text()
-        userinfo.posts_per_day = float(re.findall("-?\d+.\d+", posts_per_day_string)[0])
+        userinfo.posts_per_day = float(re.findall(r'-?\d+\.\d+', posts_per_day_string)[0])
 
         last_post_string = additional_elem.find('dt', text=re.compile('Last Post')).findNext('dd').get_text().strip()
-        userinfo.last_post = datetime.strptime(last_post_string, self.DATETIME_FORMAT)
+        userinfo.last_post = datetime.strptime(last_post_string, cls.DATETIME_FORMAT)
 
         location_elem = additional_elem.find('dt', text=re.compile('Location'))
         if location_elem:
@@ -86,12 +169,225 @@ class AwfulClient:
 
         return userinfo
 
-    def export_thread(self, threadid):
-        thread_export = ThreadExport(self.session, threadid, timeout=self.timeout)
-        thread_export.save()
+    def export_thread(self, threadid, background=False, **kwargs):
+        """
+        Export a thread to local disk. Keyword arguments are passed through to ThreadExport, apart from
+        max_buffered_events which is passed to the ExportHandle when exporting in the background.
+        :param threadid:
+        :param background: export the thread on a thread of its own and return straight away, see ExportHandle
+        :return: dict with the number of pages saved, new posts found and images and stylesheets downloaded, or an
+        ExportHandle if exporting in the background
+        """
+        kwargs.setdefault('parser', self.parser)
+        kwargs.setdefault('scheduler', self.scheduler)
+        kwargs.setdefault('metrics', self.metrics)
+        if background:
+            listener = kwargs.pop('listener', None)
+            max_buffered_events = kwargs.pop('max_buffered_events', ExportHandle.DEFAULT_MAX_BUFFERED_EVENTS)
+            return ExportHandle(threadid, lambda control, handle_listener: ThreadExport(
+                self.session, threadid, timeout=self.timeout, control=control, listener=handle_listener, **kwargs
+            ).save(), listener=listener, max_buffered_events=max_buffered_events)
+        thread_export = ThreadExport(self.session, threadid, timeout=self.timeout, **kwargs)
+        return thread_export.save()
+
+    def export_threads(self, threadids, threads_at_once=DEFAULT_THREADS_AT_ONCE, page_workers=DEFAULT_BULK_PAGE_WORKERS,
+                       asset_workers=DEFAULT_BULK_ASSET_WORKERS, asset_store=None, **kwargs):
+        """
+        Export many threads sharing one pool of page workers, one asset downloader and this client's session and
+        request scheduler, so the worker counts are global limits and the scheduler's per host limits apply across
+        every thread. Several threads are exported at once so their pages are interleaved in the shared queue. Each
+        thread is finished and its manifest closed as soon as its own images and stylesheets have been downloaded.
+        Keyword arguments are passed through to ThreadExport.
+        :param threadids: iterable of thread ids, consumed as threads are started
+        :param threads_at_once: number of threads whose pages are being queued at the same time
+        :param page_workers: number of threads used to download pages across all of the threads, raised to
+        parse_processes if that is higher
+        :param asset_workers: number of threads used to download images and stylesheets across all of the threads
+        :param asset_store: AssetStore shared by all of the threads
+        :param kwargs: passed through to ThreadExport, except that a single pool of parse_processes processes is shared
+        by all of the threads
+        :return: dict of thread id to the result of its export, or None if the export failed
+        """
+        parse_processes = kwargs.get('parse_processes')
+        # as with a single thread, there are enough page workers to keep every parse process busy
+        page_workers = max(page_workers, parse_processes or 0)
+        kwargs.setdefault('parser', self.parser)
+        kwargs.setdefault('scheduler', self.scheduler)
+        kwargs.setdefault('metrics', self.metrics)
+        asset_downloader = AssetDownloader(timeout=self.timeout, max_workers=asset_workers, asset_store=asset_store,
+                                           scheduler=kwargs['scheduler'], metrics=kwargs['metrics'])
+        kwargs['metrics'].gauge('page_workers', page_workers)
+        finish_futures = {}
+
+        def save_pages(threadid):
+            thread_export = ThreadExport(self.session, threadid, timeout=self.timeout, asset_store=asset_store,
+                                         **kwargs)
+            try:
+                thread_export.save_pages(page_executor, asset_downloader, parse_executor)
+            finally:
+                # finish the thread once its own downloads are done rather than once every thread's are, so its
+                # manifest is not held open and what it has saved is recorded even if the batch never ends
+                asset_downloader.when_finished(thread_export.manifest,
+                                               functools.partial(finish, threadid, thread_export))
+
+        def finish(threadid, thread_export):
+            finish_futures[threadid] = finish_executor.submit(thread_export.finish)
+
+        results = {}
+        failed_threadids = set()
+        # one pool of parse processes for every thread, rather than one started and stopped for each
+        parse_pool = (concurrent.futures.ProcessPoolExecutor(max_workers=parse_processes) if parse_processes
+                      else contextlib.nullcontext())
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads_at_once) as finish_executor:
+            with parse_pool as parse_executor, \
+                    concurrent.futures.ThreadPoolExecutor(max_workers=page_workers) as page_executor:
+                # threads are started by their own small pool since they wait on the page workers, and only as others
+                # finish so thread ids can come from a generator that is still discovering them
+                with concurrent.futures.ThreadPoolExecutor(max_workers=threads_at_once) as thread_executor:
+                    future_threadids = {}
+                    for threadid in itertools.chain(threadids, [None]):
+                        if threadid is not None:
+                            results[threadid] = None
+                            future_threadids[thread_executor.submit(save_pages, threadid)] = threadid
+                        while future_threadids and (threadid is None or len(future_threadids) >= threads_at_once):
+                            done, _ = concurrent.futures.wait(future_threadids,
+                                                              return_when=concurrent.futures.FIRST_COMPLETED)
+                            for future in done:
+                                try:
+                                    future.result()
+                                except Exception:
+                                    failed_threadids.add(future_threadids[future])
+                                    logger.exception('Error exporting thread %d' % future_threadids[future])
+                                del future_threadids[future]
+            logger.info('Waiting for images and stylesheets to finish downloading')
+            downloaded_count = asset_downloader.wait()
+        for threadid, future in finish_futures.items():
+            try:
+                result = future.result()
+            except Exception:
+                failed_threadids.add(threadid)
+                logger.exception('Error finishing thread %d' % threadid)
+            else:
+                if threadid not in failed_threadids:
+                    results[threadid] = result
+        logger.info('Finished exporting %d of %d threads (%d images and stylesheets downloaded)'
+                    % (len(results) - len(failed_threadids), len(results), downloaded_count))
+        kwargs['metrics'].write()
+        return results
+
+    def forum_url(self, forumid, page_number):
+        return '%s/forumdisplay.php?forumid=%d&pagenumber=%d' % (self.FORUMS_URL, forumid, page_number)
+
+    def forum_threads(self, forumid, max_pages=None):
+        """
+        Walk the thread listing of a forum a page at a time, only requesting the next page once every thread on the
+        previous one has been consumed
+        :param forumid:
+        :param max_pages: stop after this many pages of the listing, every page if not set
+        :return: generator of ForumThread, each thread only once even if it moves pages during the walk
+        """
+        seen_threadids = set()
+        page_number = 1
+        total_pages = 1
+        while page_number <= total_pages and (max_pages is None or page_number <= max_pages):
+            r = self.scheduler.get(self.session, self.forum_url(forumid, page_number), timeout=self.timeout)
+            r.raise_for_status()
+            forum_threads, total_pages = self.parse_forum_page(r.text, self.parser)
+            logger.info('Found %d threads on page %d/%d of forum %d'
+                        % (len(forum_threads), page_number, total_pages, forumid))
+            for forum_thread in forum_threads:
+                if forum_thread.threadid not in seen_threadids:
+                    seen_threadids.add(forum_thread.threadid)
+                    yield forum_thread
+            page_number += 1
+
+    @classmethod
+    def parse_forum_page(cls, html, parser=DEFAULT_PARSER):
+        """
+        Read the threads listed on a page of a forum
+        :param html:
+        :param parser:
+        :return: tuple of a list of ForumThread and the number of pages in the forum
+        """
+        soup = BeautifulSoup(html, parser)
+        forum_threads = []
+        for thread_elem in soup.findAll('tr', class_='thread'):
+            # announcements are listed like threads but do not have a thread id
+            threadid_string = thread_elem.get('id', '')[len('thread'):]
+            if not threadid_string.isdigit():
+                continue
+            forum_thread = ForumThread()
+            forum_thread.threadid = int(threadid_string)
+
+            title_elem = thread_elem.find('a', class_='thread_title')
+            if title_elem:
+                forum_thread.title = title_elem.get_text().strip()
+
+            replies_elem = thread_elem.find('td', class_='replies')
+            replies_string = replies_elem.get_text().strip().replace(',', '') if replies_elem else ''
+            if replies_string.isdigit():
+                forum_thread.replies = int(replies_string)
+
+            last_post_elem = thread_elem.find('td', class_='lastpost')
+            date_elem = last_post_elem.find('div', class_='date') if last_post_elem else None
+            if date_elem:
+                try:
+                    forum_thread.last_post = datetime.strptime(date_elem.get_text().strip(),
+                                                               cls.LAST_POST_DATETIME_FORMAT)
+                except ValueError:
+                    logger.warning('Could not read the last post time of thread %d' % forum_thread.threadid)
+            forum_threads.append(forum_thread)
+        return forum_threads, ThreadExport.find_total_pages(soup)
+
+    def export_forum(self, forumid, max_pages=None, **kwargs):
+        """
+        Export every thread in a forum, discovering threads while earlier ones are being exported. Threads whose last
+        post has not changed since they were last exported this way are skipped, and the rest are synced by default
+        rather than exported from scratch. Keyword arguments are passed through to export_threads.
+        :param forumid:
+        :param max_pages: only look at this many pages of the forum's thread listing
+        :return: dict of thread id to the result of its export, or None if the export failed
+        """
+        kwargs.setdefault('sync', True)
+        forum_threads = {}
+
+        def changed_threadids():
+            for forum_thread in self.forum_threads(forumid, max_pages=max_pages):
+                previous_last_post = ThreadExport.previous_forum_last_post(forum_thread.threadid)
+                if forum_thread.last_post and previous_last_post and forum_thread.last_post <= previous_last_post:
+                    logger.info('Skipping thread %d, nothing has been posted since it was last exported'
+                                % forum_thread.threadid)
+                    continue
+                forum_threads[forum_thread.threadid] = forum_thread
+                yield forum_thread.threadid
+
+        results = self.export_threads(changed_threadids(), **kwargs)
+        for threadid, result in results.items():
+            # a thread with pages or images left unfinished is not skipped next time, so they get another try
+            if result is not None and forum_threads[threadid].last_post and not result['unfinished_pages_count'] \
+                    and not result['unfinished_assets_count']:
+                ThreadExport.record_forum_last_post(threadid, forum_threads[threadid].last_post)
+        return results
+
+    async def export_thread_async(self, threadid, **kwargs):
+        """
+        Export a thread with all of the network I/O done on the running event loop, so many exports can share a single
+        loop. Requires aiohttp. Keyword arguments are passed through to AsyncThreadExport.
+        :param threadid:
+        :return: dict with the number of pages saved, images and stylesheets downloaded, and pages and images and
+        stylesheets still unfinished
+        """
+        from awfulutils.asyncexport import AsyncThreadExport
+        kwargs.setdefault('parser', self.parser)
+        kwargs.setdefault('metrics', self.metrics)
+        thread_export = AsyncThreadExport(self.session.cookies.get_dict(), threadid, timeout=self.timeout, **kwargs)
+        return await thread_export.save()
 
 
 class UserInfo:
+    __slots__ = ('username', 'post_count', 'posts_per_day', 'join_date', 'icq_handle', 'aim_handle', 'yahoo_handle',
+                 'home_page', 'last_post', 'location', 'interests', 'occupation', 'avatar', 'title', 'about_me')
+
     def __init__(self):
         self.username = None
         self.post_count = 0
@@ -110,138 +406,716 @@ class UserInfo:
         self.about_me = None
 
 
-class ThreadExport:
-    PAGE_PATTERN_FILENAME = 'page_%s.html'
+class ForumThread:
+    __slots__ = ('threadid', 'title', 'replies', 'last_post')
 
-    def __init__(self, session, threadid, timeout=AwfulClient.DEFAULT_TIMEOUT_SECONDS, posts_per_page=40):
-        self.session = session
-        self.threadid = threadid
+    def __init__(self):
+        self.threadid = None
+        self.title = None
+        self.replies = None
+        self.last_post = None
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """
+    Keeps a pool of keep-alive connections for each host and counts how many connections had to be opened versus how
+    many requests reused a connection that was already open.
+    """
+    POOLED_HOSTS = 100
+
+    def __init__(self, pool_maxsize):
+        super().__init__(pool_connections=self.POOLED_HOSTS, pool_maxsize=pool_maxsize)
+        self.stats_lock = threading.Lock()
+        self.sockets = weakref.WeakSet()
+        self.connections_opened = 0
+        self.connections_reused = 0
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        connection = response.raw.connection
+        sock = connection.sock if connection else None
+        if sock is not None:
+            with self.stats_lock:
+                if sock in self.sockets:
+                    self.connections_reused += 1
+                else:
+                    self.sockets.add(sock)
+                    self.connections_opened += 1
+        return response
+
+
+class AssetDownloader:
+    """
+    Downloads the images and stylesheets referenced by exported pages on a dedicated pool of workers, so a slow image
+    host never holds up the page workers. Each output file is fetched at most once, no matter how many pages reference
+    it or how many workers ask for it at the same time. One downloader can be shared by several thread exports, each
+    passing its own manifest along with its downloads and asking to be told once they have finished.
+    """
+    DEFAULT_MAX_WORKERS = 10
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, timeout=AwfulClient.DEFAULT_TIMEOUT_SECONDS, max_workers=DEFAULT_MAX_WORKERS, manifest=None,
+                 asset_store=None, scheduler=None, metrics=None):
+        """
+        :param timeout:
+        :param max_workers:
+        :param manifest: ExportManifest used to decide whether a file has already been downloaded and to record each
+        download, unless one is passed with the download. Without one, any file that already exists is considered
+        downloaded.
+        :param asset_store: AssetStore consulted before going to the network, and that every download is added to
+        :param scheduler: RequestScheduler that limits and retries the downloads
+        :param metrics: ExportMetrics the downloads are measured in, the scheduler's by default
+        """
         self.timeout = timeout
-        self.posts_per_page = posts_per_page
+        self.manifest = manifest
+        self.asset_store = asset_store
+        self.scheduler = scheduler or RequestScheduler(metrics=metrics)
+        self.metrics = metrics or self.scheduler.metrics
+        self.metrics.gauge('asset_workers', max_workers)
 
-        # setup an opener to download files
-        self.opener = urllib.request.build_opener()
-        self.opener.addheaders = [('User-Agent', AwfulClient.USER_AGENT)]
+        # assets are downloaded without the forum cookies, through connections that are kept open and shared between
+        # the workers, with one pool per host sized so every worker can have a connection to the same host
+        self.adapter = PooledHTTPAdapter(max_workers)
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = AwfulClient.USER_AGENT
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
 
-        # retrieve some basic info about the thread
-        r = self.session.get(self.thread_url(1), timeout=self.timeout)
-        soup = BeautifulSoup(r.text, 'html5lib')
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        # downloads of each output file and of each manifest, kept until every download of the manifest has finished
+        self.futures = {}
+        self.manifest_filenames = collections.defaultdict(list)
+        # lock for each url being downloaded into the asset store, and how many downloads are using it
+        self.url_locks = {}
+        self.stored_count = 0
+        # downloads enqueued without an ExportControl of their own are never held back
+        self.control = ExportControl()
+        # number of files downloaded for each manifest until it is taken with pop_downloaded_count(), and downloads
+        # still pending for each manifest
+        self.downloaded_counts = collections.Counter()
+        self.downloaded_count = 0
+        self.pending_counts = collections.Counter()
+        self.finished_callbacks = collections.defaultdict(list)
 
-        last_page_url = urlparse(soup.find('a', title='Last page')['href'])
-        self.total_pages = int(parse_qs(last_page_url.query)['pagenumber'][0])
-        self.page_pad_zeros = len(str(self.total_pages))
+    def enqueue(self, url, output_filename, page_number, manifest=None, progress=None, control=None):
+        """
+        Queue a download unless the same output file has already been queued
+        :param url: url to download
+        :param output_filename: local path to save the download to
+        :param page_number: page the asset was found on, used for logging
+        :param manifest: ExportManifest of the export the download belongs to, instead of the downloader's own
+        :param progress: ProgressTracker of the export the download belongs to
+        :param control: ExportControl of the export the download belongs to, which can hold it back or cancel it
+        :return: True if the download was queued, False if it was already queued or the file already exists
+        """
+        manifest = manifest or self.manifest
+        with self.lock:
+            if output_filename in self.futures or self.__is_downloaded(output_filename, manifest):
+                return False
+            self.metrics.adjust('asset_queue_depth', 1)
+            if progress:
+                progress.asset_queued()
+            future = self.executor.submit(self.__download, url, output_filename, page_number, manifest, progress,
+                                          control or self.control)
+            self.futures[output_filename] = future
+            self.manifest_filenames[manifest].append(output_filename)
+            self.pending_counts[manifest] += 1
+        future.add_done_callback(functools.partial(self.__finished, output_filename, manifest))
+        return True
 
-        # setup the output directory
-        self.output_folder = 'somethingawful_thread_%d' % self.threadid
-        if not os.path.exists(self.output_folder):
-            os.mkdir(self.output_folder)
-        self.images_folder = os.path.join(self.output_folder, 'images')
-        if not os.path.exists(self.images_folder):
-            os.mkdir(self.images_folder)
-        self.css_folder = os.path.join(self.output_folder, 'css')
-        if not os.path.exists(self.css_folder):
-            os.mkdir(self.css_folder)
+    def when_finished(self, manifest, callback):
+        """
+        Call a function once every download queued for a manifest has finished, straight away if none are pending.
+        Nothing more should be queued for the manifest after this.
+        :param manifest:
+        :param callback: called without arguments from the worker that finished the last download, so it should
+        return quickly
+        :return:
+        """
+        with self.lock:
+            if self.pending_counts[manifest]:
+                self.finished_callbacks[manifest].append(callback)
+                return
+        callback()
 
-    def thread_url(self, page_number):
-        return urljoin(AwfulClient.FORUMS_URL,
-                       '/showthread.php?perpage=%d&threadid=%d&pagenumber=%d'
-                       % (self.posts_per_page, self.threadid, page_number))
+    def pop_downloaded_count(self, manifest):
+        """
+        :param manifest:
+        :return: the number of files downloaded for a manifest, which is forgotten after this
+        """
+        with self.lock:
+            return self.downloaded_counts.pop(manifest, 0)
 
-    def save(self):
+    def wait(self):
         """
-        Saves all the pages and images
+        Blocks until every queued download has finished
+        :return: the number of files that were downloaded
+        """
+        self.executor.shutdown(wait=True)
+        if self.asset_store:
+            logger.info('%d images and stylesheets taken from the asset store' % self.stored_count)
+        logger.info('Asset connections: %d opened, %d reused'
+                    % (self.adapter.connections_opened, self.adapter.connections_reused))
+        self.session.close()
+        return self.downloaded_count
+
+    def __finished(self, output_filename, manifest, future):
+        """
+        Count a finished download against its manifest. Once it was the last one pending for the manifest, the
+        manifest's downloads are forgotten, since the manifest itself now tells whether they need downloading again,
+        and whatever was waiting for them is called.
+        :param output_filename:
+        :param manifest:
+        :param future:
         :return:
         """
-        logger.info('Saving thread %d export to %s' % (self.threadid, self.output_folder))
+        downloaded = False
+        if not future.cancelled():
+            if future.exception() is not None:
+                logger.error('Error downloading %s' % output_filename, exc_info=future.exception())
+            else:
+                downloaded = future.result()
+        callbacks = []
+        with self.lock:
+            if downloaded:
+                self.downloaded_count += 1
+                self.downloaded_counts[manifest] += 1
+            self.pending_counts[manifest] -= 1
+            if not self.pending_counts[manifest]:
+                del self.pending_counts[manifest]
+                for finished_filename in self.manifest_filenames.pop(manifest):
+                    del self.futures[finished_filename]
+                callbacks = self.finished_callbacks.pop(manifest, [])
+        for callback in callbacks:
+            callback()
 
-        existing_pages = glob.glob(os.path.join(self.output_folder, 'page_*.html'))
-        if existing_pages:
-            existing_pages.sort()
-            old_last_page = existing_pages[-1]
-            logger.info('Deleting %s from previous export as it has probably changed' % old_last_page)
-            os.remove(old_last_page)
-
-        with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-            # Start the load operations and mark each future with its URL
-            future_pages = {
-                executor.submit(self.__save_page, page_number): page_number
-                for page_number in range(1, self.total_pages + 1)
-            }
-            for future in concurrent.futures.as_completed(future_pages):
-                page_number = future_pages[future]
-                try:
-                    data = future.result()
-                except Exception as e:
-                    logger.exception('Error saving page %d' % page_number, e)
-                else:
-                    if data['skipped']:
-                        logger.info('Skipped page %d/%d because it already exists' % (page_number, self.total_pages))
-                    else:
-                        logger.info('Finished page %d/%d (%d new images, %d new stylseheets) in %d seconds'
-                                    % (page_number, self.total_pages, data['downloaded_images_count'],
-                                       data['downloaded_stylesheets_count'], data['execution_time_seconds']))
-        logger.info('Finished exporting thread')
+    @staticmethod
+    def __is_downloaded(output_filename, manifest):
+        if manifest:
+            return manifest.asset_is_complete(output_filename)
+        return os.path.exists(output_filename)
 
-    def __save_page(self, page_number):
+    def __download(self, url, output_filename, page_number, manifest, progress, control):
         """
-        Saves a single page and images
+        Download a single file. The file is written under a temporary name and only moved into place once complete, so
+        a failed download never leaves behind a file that would be skipped on the next run.
+        :param url:
+        :param output_filename:
         :param page_number:
-        :return:
+        :param manifest:
+        :param progress:
+        :param control:
+        :return: True if the file was downloaded, False if it could not be downloaded or the export was cancelled
+        """
+        try:
+            with control.slot(ExportControl.ASSET), self.metrics.time('asset'):
+                return self.__download_or_link(url, output_filename, page_number, manifest, progress, control)
+        except ExportCancelled:
+            # left pending in the manifest, so the next export of the thread downloads it
+            return False
+        finally:
+            self.metrics.adjust('asset_queue_depth', -1)
+
+    def __download_or_link(self, url, output_filename, page_number, manifest, progress, control):
+        if self.asset_store:
+            # the same url wanted by another export is downloaded by whichever asks first, and linked by the others
+            with self.__url_lock(url):
+                return self.__fetch_or_link(url, output_filename, page_number, manifest, progress, control)
+        return self.__fetch_or_link(url, output_filename, page_number, manifest, progress, control)
+
+    @contextlib.contextmanager
+    def __url_lock(self, url):
+        """
+        Hold back a download while another download of the same url is underway
+        :param url:
+        """
+        with self.lock:
+            lock, users = self.url_locks.get(url, (None, 0))
+            lock = lock or threading.Lock()
+            self.url_locks[url] = (lock, users + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self.lock:
+                lock, users = self.url_locks.pop(url)
+                if users > 1:
+                    self.url_locks[url] = (lock, users - 1)
+
+    def __fetch_or_link(self, url, output_filename, page_number, manifest, progress, control):
+        if self.asset_store:
+            stored = self.asset_store.lookup(url)
+            if stored:
+                stored_filename, size, sha256 = stored
+                self.asset_store.link(stored_filename, output_filename)
+                if manifest:
+                    manifest.asset_complete(output_filename, url, size, sha256)
+                with self.lock:
+                    self.stored_count += 1
+                self.metrics.count('asset_store_hits')
+                if progress:
+                    progress.asset_fetched(url, output_filename, page_number, size, stored=True)
+                return True
+
+        partial_filename = output_filename + '.part'
+        downloaded = False
+        error = None
+        try:
+            with self.metrics.time('asset_fetch'):
+                size, sha256 = self.scheduler.call(url, self.__fetch, url, partial_filename, control)
+            self.metrics.count('bytes_downloaded', size, host=urlparse(url).hostname)
+            if self.asset_store:
+                self.asset_store.add(url, partial_filename, size, sha256)
+            os.replace(partial_filename, output_filename)
+            if manifest:
+                manifest.asset_complete(output_filename, url, size, sha256)
+            downloaded = True
+        except Timeout as e:
+            error = e
+            logger.warning('Error downloading %s on page %d because %d second timeout was reached'
+                           % (url, page_number, self.timeout))
+        except requests.RequestException as e:
+            error = e
+            logger.warning('Error downloading %s on page %d due to %s' % (url, page_number, e))
+        finally:
+            if os.path.exists(partial_filename):
+                os.remove(partial_filename)
+            if not downloaded and not control.cancelled:
+                self.metrics.count('asset_failures')
+                if manifest:
+                    manifest.asset_failed(output_filename, url)
+        if progress:
+            if downloaded:
+                progress.asset_fetched(url, output_filename, page_number, size, stored=False)
+            else:
+                progress.asset_failed(url, output_filename, page_number, error)
+        return downloaded
+
+    def __fetch(self, url, partial_filename, control):
+        """
+        Stream a single download to disk, starting the file over on every attempt
+        :param url:
+        :param partial_filename:
+        :param control: ExportControl checked between chunks, so a cancelled export stops downloading large files
+        :return: tuple of the size in bytes and sha256 hex digest of the download
+        """
+        size = 0
+        sha256 = hashlib.sha256()
+        with self.session.get(url, timeout=self.timeout, stream=True) as response:
+            self.scheduler.headers_received()
+            response.raise_for_status()
+            with open(partial_filename, 'wb') as output_file:
+                for chunk in response.iter_content(self.CHUNK_SIZE):
+                    control.check()
+                    output_file.write(chunk)
+                    sha256.update(chunk)
+                    size += len(chunk)
+        return size, sha256.hexdigest()
+
+
+class PageRewriter:
+    """
+    Rewrites a thread page so it can be viewed from local disk. This never touches the network, the images and
+    stylesheets the rewritten page refers to are returned so the caller can download them however it likes.
+
+    Pages can be parsed with any tree builder BeautifulSoup supports. html5lib is the reference and the default, lxml is
+    much faster. Other tree builders do not add the tbody html5lib adds to tables that leave it out, as the forums' post
+    tables do, so one is added while rewriting and pretty printed lxml pages come out the same as html5lib pages.
+    Without pretty printing, lxml can keep less of the whitespace between tags. The rewriting itself is either done
+    with a separate pass over the page for each kind of change, or with a single pass that makes every change as it
+    walks the page once. Both produce the same output.
+
+    Rewritten pages are written out a piece at a time rather than building the whole document as a string first, either
+    pretty printed exactly like prettify() or exactly like decode() when pretty printing is turned off.
+    """
+    PAGE_PATTERN_FILENAME = 'page_%s.html'
+    OUTPUT_ENCODING = 'utf-8'
+    WRITE_BUFFER_SIZE = 64 * 1024
+    CUSTOM_STYLES = '.bbc-spoiler:hover { background-color: inherit; }'
+    IMAGE_LINK_PATTERN = re.compile(r'\.(gif|png|jpeg|jpg)$')
+    PAGINATOR_TITLES = ['First page', 'Previous page', 'Next page', 'Last page']
+    FLUFF_IDS = ['loggedinusername', 'nav_purchase']
+    FLUFF_CLASSES = [('ul', 'navigation'), ('div', 'bottom_forms'), ('div', 'threadrate'), ('img', 'thread_bookmark')]
+    FLUFF_TAGS = ['script', 'noscript']
+    TABLE_SECTION_TAGS = ['tbody', 'thead', 'tfoot', 'caption', 'colgroup']
+
+    def __init__(self, threadid, total_pages, output_folder, parser=AwfulClient.DEFAULT_PARSER, single_pass=False,
+                 pretty=True, extract_posts=False, unique_image_names=False):
+        """
+        :param unique_image_names: add a hash of the url to the name of every downloaded image, so different images
+        with the same name never overwrite each other
+        """
+        self.threadid = threadid
+        self.output_folder = output_folder
+        self.total_pages = total_pages
+        self.page_pad_zeros = len(str(total_pages))
+        self.images_folder = os.path.join(output_folder, 'images')
+        self.css_folder = os.path.join(output_folder, 'css')
+        self.parser = parser
+        self.single_pass = single_pass
+        self.pretty = pretty
+        self.extract_posts = extract_posts
+        self.unique_image_names = unique_image_names
+        # html5lib already adds a tbody wherever a browser would
+        self.insert_table_bodies = parser != 'html5lib'
+
+    def static_assets(self):
         """
+        Assets every page refers to no matter what is on it, so they only need to be downloaded once per export
+        :return: list of (url, output filename) tuples
+        """
+        return [(urljoin(AwfulClient.FORUMS_URL, '/favicon.ico'), os.path.join(self.images_folder, 'favicon.ico'))]
+
+    def rewrite(self, html, page_number):
+        """
+        Parse and rewrite a single page
+        :param html: page html as retrieved from the forums
+        :param page_number:
+        :return: tuple of the rewritten page soup and a list of (url, output filename) tuples for each asset
+        """
+        page_soup = BeautifulSoup(html, self.parser)
+        return page_soup, self.__rewrite_soup(page_soup, page_number)
+
+    def __rewrite_soup(self, page_soup, page_number):
+        """
+        :param page_soup: parsed page, which is changed in place
+        :param page_number:
+        :return: list of (url, output filename) tuples for each asset
+        """
+        if self.single_pass:
+            return self.__rewrite_single_pass(page_soup, page_number)
+        assets = []
+        if self.insert_table_bodies:
+            for table in page_soup.findAll('table'):
+                self.__insert_table_body(page_soup, table)
+        self.__insert_custom_styles(page_soup)
+        self.__process_hyperlinks(page_soup)
+        self.__add_charset(page_soup)
+        self.__add_favicon(page_soup)
+        self.__remove_fluff(page_soup)
+        self.__process_images(page_soup, page_number, assets)
+        self.__process_stylesheets(page_soup, assets)
+        self.__process_paginators(page_soup, page_number)
+        return assets
+
+    def render(self, html, page_number):
+        """
+        Parse, rewrite and serialize a single page. Only plain strings and tuples go in and out, so this can be run in
+        another process.
+        :param html: page html as retrieved from the forums
+        :param page_number:
+        :return: tuple of the rewritten page html and a list of (url, output filename) tuples for each asset
+        """
+        page_soup, assets = self.rewrite(html, page_number)
+        return ''.join(self.serialize(page_soup, self.pretty)), assets
+
+    def save(self, html, page_number, output_filename):
+        """
+        Parse and rewrite a single page and write it to disk. The page is written under a temporary name and only moved
+        into place once it is complete, so an interrupted export never leaves a truncated page behind. Only plain
+        strings and tuples go in and out, so this can be run in another process.
+        :param html: page html as retrieved from the forums
+        :param page_number:
+        :param output_filename:
+        :return: dict with the list of (url, output filename) tuples for each asset, the ids of the posts on the page,
+        the size and sha256 hex digest of the saved page, the post records if posts are being extracted, and the
+        seconds spent in each stage of saving it
+        """
+        timings = {}
         start = time.time()
-        skipped = False
-        downloaded_images_count = 0
-        downloaded_stylesheets_count = 0
+        page_soup = BeautifulSoup(html, self.parser)
+        timings['parse'] = time.time() - start
 
-        output_filename = os.path.join(self.output_folder,
-                                       self.PAGE_PATTERN_FILENAME % str(page_number).zfill(self.page_pad_zeros))
-        if os.path.exists(output_filename):
-            skipped = True
-        else:
-            with open(output_filename, 'w') as output_file:
-                logger.info('Starting thread %d page %d/%d' % (self.threadid, page_number, self.total_pages))
-                r = self.session.get(self.thread_url(page_number), timeout=self.timeout)
-                page_soup = BeautifulSoup(r.text, 'html5lib')
-                self.__insert_custom_styles(page_soup)
-                self.__process_hyperlinks(page_soup)
-                self.__add_charset(page_soup)
-                self.__add_favicon(page_soup)
-                self.__remove_fluff(page_soup)
-                downloaded_images_count = self.__process_images(page_soup, page_number)
-                downloaded_stylesheets_count = self.__process_stylesheets(page_soup)
-                self.__process_paginators(page_soup, page_number)
-                output_file.write(page_soup.prettify())
+        start = time.time()
+        assets = self.__rewrite_soup(page_soup, page_number)
+        post_ids = self.find_post_ids(page_soup)
+        timings['rewrite'] = time.time() - start
 
-        end = time.time()
+        posts = None
+        if self.extract_posts:
+            start = time.time()
+            posts = PostExtractor.extract(page_soup, page_number)
+            PostExtractor.write_page(posts, self.output_folder, page_number)
+            timings['extract_posts'] = time.time() - start
+
+        # pieces are written out in blocks, which keeps the time spent writing separate from serializing
+        start = time.time()
+        write_seconds = 0.0
+        partial_filename = output_filename + '.part'
+        size = 0
+        sha256 = hashlib.sha256()
+        try:
+            with open(partial_filename, 'wb', buffering=self.WRITE_BUFFER_SIZE) as output_file:
+                block = []
+                block_size = 0
+                for piece in itertools.chain(self.serialize(page_soup, self.pretty), [None]):
+                    if piece is not None:
+                        block.append(piece)
+                        block_size += len(piece)
+                    if block and (piece is None or block_size >= self.WRITE_BUFFER_SIZE):
+                        data = ''.join(block).encode(self.OUTPUT_ENCODING)
+                        sha256.update(data)
+                        size += len(data)
+                        write_start = time.time()
+                        output_file.write(data)
+                        write_seconds += time.time() - write_start
+                        block = []
+                        block_size = 0
+                write_start = time.time()
+            os.replace(partial_filename, output_filename)
+            write_seconds += time.time() - write_start
+        finally:
+            if os.path.exists(partial_filename):
+                os.remove(partial_filename)
+        timings['serialize'] = time.time() - start - write_seconds
+        timings['disk_write'] = write_seconds
         return {
-            'skipped': skipped,
-            'downloaded_images_count': downloaded_images_count,
-            'downloaded_stylesheets_count': downloaded_stylesheets_count,
-            'execution_time_seconds': end - start
+            'assets': assets,
+            'post_ids': post_ids,
+            'size': size,
+            'sha256': sha256.hexdigest(),
+            'posts': posts,
+            'timings': timings
         }
 
     @staticmethod
-    def __insert_custom_styles(soup):
+    def find_post_ids(soup):
         """
-        Adds styles that are specific to this AwfulClient
         :param soup:
+        :return: list of the ids of the posts on a page
+        """
+        return [int(post_elem['id'][len('post'):]) for post_elem in soup.findAll('table', class_='post')
+                if post_elem.get('id', '')[len('post'):].isdigit()]
+
+    @classmethod
+    def serialize(cls, soup, pretty=True):
+        """
+        Generates the html for a page a piece at a time. Joined together the pieces are exactly what prettify() returns,
+        or decode() if pretty is False.
+        :param soup:
+        :param pretty:
+        :return:
+        """
+        formatter = soup.formatter_for_name('minimal')
+        indent_level = 0 if pretty else None
+        # inside tags like <pre> whitespace matters, so nothing is indented until the tag is closed
+        string_literal_tag = None
+
+        for opening, closing, element in cls.__walk(soup):
+            if isinstance(element, Tag):
+                if closing and not opening and indent_level is not None:
+                    indent_level -= 1
+                piece = cls.__format_tag(element, formatter, opening)
+            else:
+                piece = element.output_ready(formatter)
+
+            if indent_level is not None:
+                indent_before = indent_after = string_literal_tag is None
+                if opening and not closing and string_literal_tag is None and element.preserve_whitespace_tags \
+                        and element.name in element.preserve_whitespace_tags:
+                    indent_after = False
+                    string_literal_tag = element
+                elif closing and not opening and element is string_literal_tag:
+                    indent_before = False
+                    indent_after = True
+                    string_literal_tag = None
+
+                if indent_before or indent_after:
+                    if not isinstance(element, Tag):
+                        piece = piece.strip()
+                    if piece:
+                        if indent_before and indent_level:
+                            piece = formatter.indent * indent_level + piece
+                        if indent_after:
+                            piece += '\n'
+                if opening and not closing:
+                    indent_level += 1
+            yield piece
+
+    @staticmethod
+    def __walk(soup):
+        """
+        Walk the document in order, yielding (opening, closing, element) for every tag being opened or closed, and for
+        every string. Empty elements like <br/> are opened and closed at once, strings are neither.
+        :param soup:
+        :return:
+        """
+        open_tags = []
+        for element in itertools.chain([] if soup.hidden else [soup], soup.descendants):
+            while open_tags and element.parent is not open_tags[-1]:
+                yield False, True, open_tags.pop()
+            if not isinstance(element, Tag):
+                yield False, False, element
+            elif element.is_empty_element:
+                yield True, True, element
+            else:
+                yield True, False, element
+                open_tags.append(element)
+        while open_tags:
+            yield False, True, open_tags.pop()
+
+    @classmethod
+    def __format_tag(cls, tag, formatter, opening):
+        """
+        Format an opening or closing tag the same way BeautifulSoup does
+        :param tag:
+        :param formatter:
+        :param opening:
         :return:
         """
+        if tag.hidden:
+            return ''
+        attribute_string = ''
+        if opening:
+            attributes = []
+            for key, value in formatter.attributes(tag):
+                if value is None:
+                    attributes.append(key)
+                    continue
+                if isinstance(value, (list, tuple)):
+                    value = ' '.join(value)
+                elif isinstance(value, AttributeValueWithCharsetSubstitution):
+                    value = value.substitute_encoding(cls.OUTPUT_ENCODING)
+                elif not isinstance(value, str):
+                    value = str(value)
+                attributes.append('%s=%s' % (key, formatter.quoted_attribute_value(formatter.attribute_value(value))))
+            if attributes:
+                attribute_string = ' ' + ' '.join(attributes)
+        return '<%s%s%s%s%s>' % ('' if opening else '/', tag.prefix + ':' if tag.prefix else '', tag.name,
+                                 attribute_string,
+                                 (formatter.void_element_close_prefix or '') if tag.is_empty_element else '')
+
+    def __rewrite_single_pass(self, soup, page_number):
+        """
+        Makes all the same changes as the separate passes, in the same order for any given element, while walking the
+        page only once. Elements that are removed are not descended into.
+        :param soup:
+        :param page_number:
+        :return: list of (url, output filename) tuples for each asset, in the same order the separate passes use
+        """
+        image_assets = []
+        image_link_assets = []
+        stylesheet_assets = []
+        head_style = None
+        in_body = False
+        removed_ids = set()
+        removed_apple_touch_icon = False
+
+        stack = [child for child in reversed(soup.contents) if isinstance(child, Tag)]
+        while stack:
+            elem = stack.pop()
+            if elem.name == 'body':
+                in_body = True
+            elif elem.name == 'style' and head_style is None and not in_body:
+                head_style = elem
+
+            if elem.has_attr('href'):
+                self.__process_hyperlink(elem)
+
+            # remove fluff, only the first element with each of the ids is removed
+            if elem.get('id') in self.FLUFF_IDS and elem['id'] not in removed_ids:
+                removed_ids.add(elem['id'])
+                elem.extract()
+                continue
+            if elem.name == 'link' and not removed_apple_touch_icon and self.__has_value(elem, 'rel',
+                                                                                         'apple-touch-icon'):
+                removed_apple_touch_icon = True
+                elem.extract()
+                continue
+            if elem.name in self.FLUFF_TAGS or any(elem.name == name and self.__has_value(elem, 'class', class_)
+                                                   for name, class_ in self.FLUFF_CLASSES):
+                elem.extract()
+                continue
+            if elem.name == 'ul' and self.__has_value(elem, 'class', 'postbuttons'):
+                elem['style'] = 'visibility: hidden'
+
+            if elem.name == 'img':
+                self.__process_image(elem, page_number, image_assets)
+                if self.__has_value(elem, 'class', 'timg'):
+                    elem['style'] = 'visibility: visible'
+            elif elem.name == 'a':
+                if elem.has_attr('href') and self.IMAGE_LINK_PATTERN.search(elem['href']):
+                    self.__process_image_link(elem, page_number, image_link_assets)
+                if elem.get('title') in self.PAGINATOR_TITLES:
+                    self.__process_paginator(elem, page_number)
+            elif elem.name == 'link' and self.__has_value(elem, 'rel', 'stylesheet'):
+                self.__process_stylesheet(elem, stylesheet_assets)
+            elif elem.name == 'div' and self.__has_value(elem, 'class', 'pages'):
+                self.__process_page_select(elem)
+            elif elem.name == 'table' and self.insert_table_bodies:
+                self.__insert_table_body(soup, elem)
+
+            stack.extend(child for child in reversed(elem.contents) if isinstance(child, Tag))
+
         soup.head.append(soup.new_tag('style', type='text/css'))
-        soup.style.append('.bbc-spoiler:hover { background-color: inherit; }')
+        (head_style or soup.head.contents[-1]).append(self.CUSTOM_STYLES)
+        self.__add_charset(soup)
+        self.__add_favicon(soup)
+        return image_assets + image_link_assets + stylesheet_assets
+
+    @classmethod
+    def __insert_table_body(cls, soup, table):
+        """
+        Move rows that are directly inside a table into a tbody, the way html5lib does while parsing. Strings after the
+        first row go along with the rows, as html5lib puts them in the tbody too.
+        :param soup:
+        :param table:
+        :return:
+        """
+        tbody = None
+        for child in list(table.contents):
+            if isinstance(child, Tag) and child.name == 'tr':
+                if tbody is None:
+                    tbody = soup.new_tag('tbody')
+                    child.insert_before(tbody)
+                tbody.append(child.extract())
+            elif isinstance(child, Tag):
+                if child.name in cls.TABLE_SECTION_TAGS:
+                    tbody = None
+            elif tbody is not None:
+                tbody.append(child.extract())
 
     @staticmethod
-    def __process_hyperlinks(soup):
+    def __has_value(elem, attribute, value):
+        """
+        Check an attribute the same way find does, matching either one of its values or the whole attribute
+        :param elem:
+        :param attribute:
+        :param value:
+        :return:
+        """
+        values = elem.get(attribute)
+        if isinstance(values, list):
+            return value in values or ' '.join(values) == value
+        return values == value
+
+    @classmethod
+    def __insert_custom_styles(cls, soup):
+        """
+        Adds styles that are specific to this AwfulClient
+        :param soup:
+        :return:
+        """
+        soup.head.append(soup.new_tag('style', type='text/css'))
+        soup.style.append(cls.CUSTOM_STYLES)
+
+    @classmethod
+    def __process_hyperlinks(cls, soup):
         """
         Add the base url to relative links
         :param soup:
         :return:
         """
         for elem in soup.findAll(href=True):
-            if elem['href'].startswith('//'):
-                elem['href'] = 'http:' + elem['href']
-            if not elem['href'].startswith('#'):
-                elem['href'] = urljoin(AwfulClient.FORUMS_URL, elem['href'])
+            cls.__process_hyperlink(elem)
+
+    @staticmethod
+    def __process_hyperlink(elem):
+        if elem['href'].startswith('//'):
+            elem['href'] = 'http:' + elem['href']
+        if not elem['href'].startswith('#'):
+            elem['href'] = urljoin(AwfulClient.FORUMS_URL, elem['href'])
 
     @staticmethod
     def __add_charset(soup):
@@ -253,34 +1127,30 @@ class ThreadExport:
         encoding_tag = soup.new_tag('meta', charset='utf-8')
         soup.find('head').append(encoding_tag)
 
-    def __add_favicon(self, soup):
+    @staticmethod
+    def __add_favicon(soup):
         """
-        Adds the html tag for the favicon
+        Adds the html tag for the favicon, which is downloaded once for the whole export as one of the static assets
         :param soup:
         :return:
         """
         favicon_tag = soup.new_tag('link', rel='icon', href='images/favicon.ico')
         soup.find('head').append(favicon_tag)
-        with self.opener.open('%s/favicon.ico' % AwfulClient.FORUMS_URL, timeout=self.timeout) as response, \
-                open(os.path.join(self.images_folder, 'favicon.ico'), 'wb') as output_file:
-            shutil.copyfileobj(response, output_file)
 
-    @staticmethod
-    def __remove_fluff(soup):
+    @classmethod
+    def __remove_fluff(cls, soup):
         """
         Remove all the extra stuff on the page we don't need
         :param soup:
         :return:
         """
-        soup.find(id='loggedinusername').extract()
-        soup.find(id='nav_purchase').extract()
+        for fluff_id in cls.FLUFF_IDS:
+            soup.find(id=fluff_id).extract()
         soup.find('link', rel='apple-touch-icon').extract()
-        [tag.extract() for tag in soup.findAll('ul', class_='navigation')]
-        [tag.extract() for tag in soup.findAll('div', class_='bottom_forms')]
-        [tag.extract() for tag in soup.findAll('div', class_='threadrate')]
-        [tag.extract() for tag in soup.findAll('img', class_='thread_bookmark')]
-        [tag.extract() for tag in soup.findAll('script')]
-        [tag.extract() for tag in soup.findAll('noscript')]
+        for name, class_ in cls.FLUFF_CLASSES:
+            [tag.extract() for tag in soup.findAll(name, class_=class_)]
+        for name in cls.FLUFF_TAGS:
+            [tag.extract() for tag in soup.findAll(name)]
         # we want the postbuttons to still take up space in the layout, so just hide them
         for tag in soup.findAll('ul', class_='postbuttons'):
             tag['style'] = 'visibility: hidden'
@@ -311,109 +1181,87 @@ class ThreadExport:
             return waffleimages_mirror_url
         return img_src
 
-    def __process_images(self, soup, page_number):
+    def __process_images(self, soup, page_number, assets):
         """
-        Download all the images on the page and change references to local copy.  If the local copy already exists,
-        it will not be downloaded again.
+        Change all the image references on the page to the local copy
         :param soup:
+        :param page_number:
+        :param assets: list the image downloads are added to
         :return:
         """
-        downloaded_images_count = 0
         for img in soup.findAll('img'):
-            # Attachments need the base url prepended
-            if not img['src'].startswith('http'):
-                img['src'] = urljoin(AwfulClient.FORUMS_URL, img['src'])
-            img['src'] = self.__handle_waffleimages_replacement(img['src'], self.threadid, page_number)
-
-            image_url = urlparse(img['src'])
-            image_path = image_url.path if '%' in image_url.path else quote(image_url.path)  # avoid double encoding
-            if image_url.path == '/attachment.php':
-                if 'attachmentid' in image_url.query:
-                    output_filename = 'attachment_%d' % int(parse.parse_qs(image_url.query)['attachmentid'][0])
-                else:
-                    output_filename = 'attachment_%d' % int(parse.parse_qs(image_url.query)['postid'][0])
-            else:
-                output_filename = os.path.basename(image_path)
-
-            # Update the image source to reference the local copy
-            img['src'] = 'images/%s' % output_filename
-
-            output_filename = os.path.join(self.images_folder, output_filename)
-            if not os.path.exists(output_filename):
-                image_download_url = str.rstrip('%s://%s%s?%s' % (image_url.scheme, image_url.netloc,
-                                                                  image_path, image_url.query), '?')
-                try:
-                    with open(output_filename, 'wb') as output_file:
-                        with self.opener.open(image_download_url, timeout=self.timeout) as response:
-                            shutil.copyfileobj(response, output_file)
-                            downloaded_images_count += 1
-                except URLError as e:
-                    logger.warning('Error downloading image %s on page %d due to %s'
-                                   % (image_download_url, page_number, e.reason))
-                except Timeout:
-                    logger.warning('Error downloading image %s on page %d because %d second timeout was reached'
-                                   % (image_download_url, page_number, self.timeout))
-                except RemoteDisconnected:
-                    logger.warning('Error downloading image %s on page %d because the remote disconnected'
-                                   % (image_download_url, page_number))
+            self.__process_image(img, page_number, assets)
 
         # Links to external images should be downloaded too
-        for anchor in soup.findAll('a', href=re.compile('\.(gif|png|jpeg|jpg)$')):
-            anchor['href'] = self.__handle_waffleimages_replacement(anchor['href'], self.threadid, page_number)
-            image_url = urlparse(anchor['href'])
-            image_path = image_url.path if '%' in image_url.path else quote(image_url.path)  # avoid double encoding
-            image_filename = os.path.basename(image_path)
-
-            # Update the link to point to the local copy
-            anchor['href'] = 'images/%s' % image_filename
-
-            output_filename = os.path.join(self.images_folder, image_filename)
-            if not os.path.exists(output_filename):
-                image_download_url = str.rstrip('%s://%s%s?%s' % (image_url.scheme, image_url.netloc,
-                                                                  image_path, image_url.query), '?')
-                try:
-                    with open(output_filename, 'wb') as output_file:
-                        with self.opener.open(image_download_url, timeout=self.timeout) as response:
-                            shutil.copyfileobj(response, output_file)
-                            downloaded_images_count += 1
-                except URLError as e:
-                    logger.warning('Error downloading image %s on page %d due to %s'
-                                   % (image_download_url, page_number, e.reason))
-                except Timeout:
-                    logger.warning('Error downloading image %s on page %d because %d second timeout was reached'
-                                   % (image_download_url, page_number, self.timeout))
-                except RemoteDisconnected:
-                    logger.warning('Error downloading image %s on page %d because the remote disconnected'
-                                   % (image_download_url, page_number))
+        for anchor in soup.findAll('a', href=self.IMAGE_LINK_PATTERN):
+            self.__process_image_link(anchor, page_number, assets)
+
         # Make sure quoted images are visible
         for timg_elem in soup.findAll('img', class_='timg'):
             timg_elem['style'] = 'visibility: visible'
 
-        return downloaded_images_count
+    def __process_image(self, img, page_number, assets):
+        # Attachments need the base url prepended
+        if not img['src'].startswith('http'):
+            img['src'] = urljoin(AwfulClient.FORUMS_URL, img['src'])
+        img['src'] = self.__handle_waffleimages_replacement(img['src'], self.threadid, page_number)
+
+        image_url = urlparse(img['src'])
+        image_path = image_url.path if '%' in image_url.path else quote(image_url.path)  # avoid double encoding
+        if image_url.path == '/attachment.php':
+            if 'attachmentid' in image_url.query:
+                output_filename = 'attachment_%d' % int(parse.parse_qs(image_url.query)['attachmentid'][0])
+            else:
+                output_filename = 'attachment_%d' % int(parse.parse_qs(image_url.query)['postid'][0])
+        else:
+            output_filename = os.path.basename(image_path)
+        image_download_url = str.rstrip('%s://%s%s?%s' % (image_url.scheme, image_url.netloc,
+                                                          image_path, image_url.query), '?')
+        output_filename = self.__image_filename(output_filename, image_download_url)
+
+        # Update the image source to reference the local copy
+        img['src'] = 'images/%s' % output_filename
+
+        assets.append((image_download_url, os.path.join(self.images_folder, output_filename)))
+
+    def __process_image_link(self, anchor, page_number, assets):
+        anchor['href'] = self.__handle_waffleimages_replacement(anchor['href'], self.threadid, page_number)
+        image_url = urlparse(anchor['href'])
+        image_path = image_url.path if '%' in image_url.path else quote(image_url.path)  # avoid double encoding
+        image_download_url = str.rstrip('%s://%s%s?%s' % (image_url.scheme, image_url.netloc,
+                                                          image_path, image_url.query), '?')
+        image_filename = self.__image_filename(os.path.basename(image_path), image_download_url)
+
+        # Update the link to point to the local copy
+        anchor['href'] = 'images/%s' % image_filename
 
-    def __process_stylesheets(self, soup):
+        assets.append((image_download_url, os.path.join(self.images_folder, image_filename)))
+
+    def __image_filename(self, filename, image_download_url):
+        if not self.unique_image_names:
+            return filename
+        name, extension = os.path.splitext(filename)
+        return '%s_%s%s' % (name, hashlib.sha1(image_download_url.encode('utf-8')).hexdigest()[:10], extension)
+
+    def __process_stylesheets(self, soup, assets):
         """
-        Download all the stylesheets on the page and change references to local copy. If the local copy already exists,
-        it will not be downloaded again.
+        Change all the stylesheet references on the page to the local copy
         :param soup:
+        :param assets: list the stylesheet downloads are added to
         :return:
         """
-        downloaded_stylesheets_count = 0
         for link in soup.findAll('link', rel='stylesheet'):
-            original_href = link['href']
+            self.__process_stylesheet(link, assets)
+
+    def __process_stylesheet(self, link, assets):
+        original_href = link['href']
 
-            stylesheet_url = urlparse(original_href)
-            stylesheet_filename = os.path.basename(stylesheet_url.path)
+        stylesheet_url = urlparse(original_href)
+        stylesheet_filename = os.path.basename(stylesheet_url.path)
 
-            link['href'] = 'css/%s' % stylesheet_filename
+        link['href'] = 'css/%s' % stylesheet_filename
 
-            output_filename = os.path.join(self.css_folder, stylesheet_filename)
-            if not os.path.exists(output_filename):
-                with open(output_filename, 'wb') as output_file:
-                    with self.opener.open(original_href, timeout=self.timeout) as response:
-                        shutil.copyfileobj(response, output_file)
-                        downloaded_stylesheets_count += 1
-        return downloaded_stylesheets_count
+        assets.append((original_href, os.path.join(self.css_folder, stylesheet_filename)))
 
     def __process_paginators(self, soup, page_number):
         """
@@ -421,19 +1269,386 @@ class ThreadExport:
         :param soup:
         :return:
         """
-        for first_page_elem in soup.findAll('a', title='First page'):
-            first_page_elem['href'] = self.PAGE_PATTERN_FILENAME % str(1).zfill(self.page_pad_zeros)
-        for prev_page_elem in soup.findAll('a', title='Previous page'):
-            prev_page_elem['href'] = self.PAGE_PATTERN_FILENAME % str(page_number - 1).zfill(self.page_pad_zeros)
-        for next_page_elem in soup.findAll('a', title='Next page'):
-            next_page_elem['href'] = self.PAGE_PATTERN_FILENAME % str(page_number + 1).zfill(self.page_pad_zeros)
-        for last_page_elem in soup.findAll('a', title='Last page'):
-            last_page_elem['href'] = self.PAGE_PATTERN_FILENAME % str(self.total_pages)
+        for title in self.PAGINATOR_TITLES:
+            for page_elem in soup.findAll('a', title=title):
+                self.__process_paginator(page_elem, page_number)
 
         # update the jump to page picklist to point to the local pages
         for pages_elem in soup.findAll('div', class_='pages'):
-            page_select_elem = pages_elem.find('select')
-            del (page_select_elem['data-url'])
-            page_select_elem['onchange'] = 'window.location = "page_"+this.value+".html"'
-            for option_elem in page_select_elem.findAll('option'):
-                option_elem['value'] = str(option_elem['value']).zfill(self.page_pad_zeros)
+            self.__process_page_select(pages_elem)
+
+    def __process_paginator(self, page_elem, page_number):
+        if page_elem['title'] == 'First page':
+            page_elem['href'] = self.PAGE_PATTERN_FILENAME % str(1).zfill(self.page_pad_zeros)
+        elif page_elem['title'] == 'Previous page':
+            page_elem['href'] = self.PAGE_PATTERN_FILENAME % str(page_number - 1).zfill(self.page_pad_zeros)
+        elif page_elem['title'] == 'Next page':
+            page_elem['href'] = self.PAGE_PATTERN_FILENAME % str(page_number + 1).zfill(self.page_pad_zeros)
+        elif page_elem['title'] == 'Last page':
+            page_elem['href'] = self.PAGE_PATTERN_FILENAME % str(self.total_pages)
+
+    def __process_page_select(self, pages_elem):
+        page_select_elem = pages_elem.find('select')
+        del (page_select_elem['data-url'])
+        page_select_elem['onchange'] = 'window.location = "page_"+this.value+".html"'
+        for option_elem in page_select_elem.findAll('option'):
+            option_elem['value'] = str(option_elem['value']).zfill(self.page_pad_zeros)
+
+
+class ThreadExport:
+    PAGE_PATTERN_FILENAME = PageRewriter.PAGE_PATTERN_FILENAME
+    OUTPUT_FOLDER_PATTERN = 'somethingawful_thread_%d'
+
+    def __init__(self, session, threadid, timeout=AwfulClient.DEFAULT_TIMEOUT_SECONDS, posts_per_page=40,
+                 page_workers=5, asset_workers=AssetDownloader.DEFAULT_MAX_WORKERS, parse_processes=None,
+                 parser=AwfulClient.DEFAULT_PARSER, single_pass=False, pretty=True, sync=False, asset_store=None,
+                 scheduler=None, extract_posts=False, posts_parquet=False, search_index=None, archive=False,
+                 media=None, metrics=None, listener=None, control=None):
+        """
+        :param session:
+        :param threadid:
+        :param timeout:
+        :param posts_per_page:
+        :param page_workers: number of threads used to download pages
+        :param asset_workers: number of threads used to download images and stylesheets
+        :param parse_processes: if set, pages are parsed and rewritten in a pool of this many processes instead of in
+        the page download threads. There will be at least this many page download threads to keep the pool busy.
+        :param parser: BeautifulSoup tree builder used to parse pages, html5lib or lxml
+        :param single_pass: rewrite each page in a single pass instead of a pass per kind of change
+        :param pretty: pretty print the saved pages, turning this off makes them about a third smaller
+        :param sync: bring a previous export up to date with as few requests as possible. The thread is checked by
+        requesting what was its last page during the previous export, with a conditional request, instead of page 1.
+        :param asset_store: AssetStore shared with other exports, images and stylesheets already in it are linked into
+        the export instead of being downloaded again
+        :param scheduler: RequestScheduler that limits and retries page and asset requests
+        :param extract_posts: also save the posts on every page as structured records, see PostExtractor
+        :param posts_parquet: save the extracted posts as parquet as well as JSON lines. Requires pyarrow.
+        :param search_index: SearchIndex the posts on each page are added to as the page is saved, which turns on
+        extract_posts
+        :param archive: pack the export into a single zip file once it has finished, see ThreadArchive
+        :param media: MediaStage the images are run through once they have been downloaded. Images are named with a
+        hash of their url so different images with the same name do not collide.
+        :param metrics: ExportMetrics each stage of the export is measured in, the scheduler's by default
+        :param listener: called with a ProgressEvent whenever a page or image is started, finished or fails, from
+        whichever worker thread it happened on
+        :param control: ExportControl that can pause, cancel or limit the export while it runs
+        """
+        if posts_parquet:
+            # fail now rather than once the whole thread has been exported
+            import pyarrow
+        self.session = session
+        self.threadid = threadid
+        self.timeout = timeout
+        self.posts_per_page = posts_per_page
+        self.page_workers = max(page_workers, parse_processes or 0)
+        self.asset_workers = asset_workers
+        self.parse_processes = parse_processes
+        self.asset_store = asset_store
+        self.scheduler = scheduler or RequestScheduler(metrics=metrics)
+        self.metrics = metrics or self.scheduler.metrics
+        self.progress = ProgressTracker(threadid, listener)
+        self.control = control or ExportControl()
+        self.extract_posts = extract_posts or posts_parquet or search_index is not None
+        self.posts_parquet = posts_parquet
+        self.search_index = search_index
+        self.archive = archive
+        self.media = media
+        self.asset_downloader = None
+        self.parse_executor = None
+        self.output_folder = self.create_output_folders(self.threadid)
+        self.manifest = ExportManifest(self.output_folder)
+        self.previous_total_pages = int(self.manifest.get('total_pages', 0))
+        self.previous_last_post_id = int(self.manifest.get('last_post_id', 0))
+        self.saved_pages_count = 0
+        self.new_posts_count = 0
+        self.last_post_id = self.previous_last_post_id
+        # responses retrieved while looking up the thread details, so they are not requested twice
+        self.prefetched_pages = {}
+        self.unchanged_pages = set()
+
+        # retrieve some basic info about the thread
+        try:
+            self.total_pages = self.__find_total_pages(sync, parser)
+        except Exception:
+            self.manifest.close()
+            raise
+        self.page_pad_zeros = len(str(self.total_pages))
+
+        self.rewriter = PageRewriter(self.threadid, self.total_pages, self.output_folder, parser=parser,
+                                     single_pass=single_pass, pretty=pretty, extract_posts=self.extract_posts,
+                                     unique_image_names=media is not None)
+
+    def __find_total_pages(self, sync, parser):
+        """
+        Request a page of the thread to find out how many pages it has, keeping the response so the page does not
+        need to be requested again
+        :param sync: check what was the last page during the previous export, if nothing has changed there is no need
+        to save it again
+        :param parser:
+        :return:
+        """
+        if sync and self.previous_total_pages:
+            r = self.__get_page(self.previous_total_pages, conditional=True)
+            if r.status_code == requests.codes.not_modified:
+                logger.info('Page %d has not changed since the previous export' % self.previous_total_pages)
+                self.unchanged_pages.add(self.previous_total_pages)
+                return self.previous_total_pages
+            self.prefetched_pages[self.previous_total_pages] = r
+        else:
+            r = self.__get_page(1)
+            self.prefetched_pages[1] = r
+        return self.parse_total_pages(r.text, parser)
+
+    @staticmethod
+    def parse_total_pages(html, parser=AwfulClient.DEFAULT_PARSER):
+        """
+        Determine the number of pages in a thread from the paginator on one of its pages
+        :param html:
+        :param parser:
+        :return:
+        """
+        return ThreadExport.find_total_pages(BeautifulSoup(html, parser))
+
+    @staticmethod
+    def find_total_pages(soup):
+        """
+        Determine the number of pages in a thread or forum from the paginator
+        :param soup:
+        :return:
+        """
+        last_page_elem = soup.find('a', title='Last page')
+        if last_page_elem:
+            last_page_url = urlparse(last_page_elem['href'])
+            return int(parse_qs(last_page_url.query)['pagenumber'][0])
+        # there is no link to the last page when on the last page, but the page picklist still has every page
+        page_numbers = [int(option_elem['value']) for pages_elem in soup.findAll('div', class_='pages')
+                        for option_elem in pages_elem.findAll('option') if option_elem.get('value', '').isdigit()]
+        return max(page_numbers) if page_numbers else 1
+
+    @staticmethod
+    def create_output_folders(threadid):
+        """
+        Setup the output directory for a thread
+        :param threadid:
+        :return: the output directory
+        """
+        output_folder = ThreadExport.OUTPUT_FOLDER_PATTERN % threadid
+        for folder in [output_folder, os.path.join(output_folder, 'images'), os.path.join(output_folder, 'css')]:
+            if not os.path.exists(folder):
+                os.mkdir(folder)
+        return output_folder
+
+    @staticmethod
+    def previous_forum_last_post(threadid):
+        """
+        :param threadid:
+        :return: time of the last post in the forum listing when the thread was last exported from it, or None
+        """
+        output_folder = ThreadExport.OUTPUT_FOLDER_PATTERN % threadid
+        if not os.path.exists(os.path.join(output_folder, ExportManifest.FILENAME)):
+            return None
+        manifest = ExportManifest(output_folder)
+        last_post_string = manifest.get('forum_last_post')
+        manifest.close()
+        return datetime.fromisoformat(last_post_string) if last_post_string else None
+
+    @staticmethod
+    def record_forum_last_post(threadid, last_post):
+        manifest = ExportManifest(ThreadExport.OUTPUT_FOLDER_PATTERN % threadid)
+        manifest.set('forum_last_post', last_post.isoformat())
+        manifest.close()
+
+    def thread_url(self, page_number):
+        return urljoin(AwfulClient.FORUMS_URL,
+                       '/showthread.php?perpage=%d&threadid=%d&pagenumber=%d'
+                       % (self.posts_per_page, self.threadid, page_number))
+
+    def __get_page(self, page_number, conditional=False):
+        """
+        Request a thread page
+        :param page_number:
+        :param conditional: ask for the page only if it has changed since the previous export saved it, using the
+        validators the forums sent at the time
+        :return:
+        """
+        headers = {}
+        if conditional:
+            etag, last_modified = self.manifest.page_validators(page_number)
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        with self.metrics.time('page_fetch'):
+            r = self.scheduler.get(self.session, self.thread_url(page_number), headers=headers, timeout=self.timeout)
+        self.metrics.count('bytes_downloaded', len(r.content), host=urlparse(r.url).hostname)
+        r.raise_for_status()
+        return r
+
+    def save(self):
+        """
+        Saves all the pages and images. Pages are fetched and rewritten by one pool of workers while the images and
+        stylesheets they reference are downloaded by a separate pool, and this waits for both to finish.
+        :return: dict with the number of pages saved, new posts found and images and stylesheets downloaded
+        """
+        asset_downloader = AssetDownloader(timeout=self.timeout, max_workers=self.asset_workers,
+                                           asset_store=self.asset_store, scheduler=self.scheduler, metrics=self.metrics)
+        self.metrics.gauge('page_workers', self.page_workers)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.page_workers) as page_executor:
+            self.save_pages(page_executor, asset_downloader)
+        logger.info('Waiting for images and stylesheets to finish downloading')
+        asset_downloader.wait()
+        if self.control.cancelled:
+            self.manifest.close()
+            logger.info('Cancelled exporting thread %d after saving %d pages' % (self.threadid, self.saved_pages_count))
+            raise ExportCancelled('Export of thread %d was cancelled' % self.threadid)
+        result = self.finish()
+        self.metrics.write()
+        return result
+
+    def save_pages(self, page_executor, asset_downloader, parse_executor=None):
+        """
+        Saves the pages that need saving using a pool of page workers and an asset downloader that can both be shared
+        with other exports, waiting for the pages but not for the images and stylesheets. finish() must be called once
+        the export's images and stylesheets have finished downloading, see AssetDownloader.when_finished().
+        :param page_executor:
+        :param asset_downloader:
+        :param parse_executor: pool of processes to parse and rewrite pages in, which can also be shared with other
+        exports. If it is not given and parse_processes is set, a pool is started for this export alone.
+        :return:
+        """
+        logger.info('Saving thread %d export to %s' % (self.threadid, self.output_folder))
+        page_numbers = [page_number for page_number in self.manifest.pages_to_fetch(self.total_pages)
+                        if page_number not in self.unchanged_pages]
+        self.manifest.set('total_pages', self.total_pages)
+        if len(page_numbers) < self.total_pages:
+            logger.info('Skipping %d pages saved by a previous export' % (self.total_pages - len(page_numbers)))
+
+        self.asset_downloader = asset_downloader
+        unfinished_assets = self.manifest.unfinished_assets()
+        if unfinished_assets:
+            logger.info('Retrying %d images and stylesheets left unfinished by a previous export'
+                        % len(unfinished_assets))
+        for url, asset_filename, page_number in unfinished_assets:
+            self.asset_downloader.enqueue(url, asset_filename, page_number or 0, self.manifest, self.progress,
+                                          self.control)
+        # assets shared by every page are queued up front, and skipped if a previous export already downloaded them
+        for url, asset_filename in self.rewriter.static_assets():
+            self.asset_downloader.enqueue(url, asset_filename, 0, self.manifest, self.progress, self.control)
+
+        own_parse_executor = parse_executor is None and self.parse_processes
+        if own_parse_executor:
+            parse_executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.parse_processes)
+        self.parse_executor = parse_executor
+        # Start the load operations and mark each future with its URL
+        future_pages = {
+            page_executor.submit(self.__save_page, page_number): page_number
+            for page_number in page_numbers
+        }
+        self.metrics.adjust('page_queue_depth', len(future_pages))
+        self.progress.pages_queued(len(future_pages))
+        for future in concurrent.futures.as_completed(future_pages):
+            self.metrics.adjust('page_queue_depth', -1)
+            page_number = future_pages[future]
+            try:
+                data = future.result()
+            except ExportCancelled:
+                # the page was never started, so the next export of the thread fetches it
+                pass
+            except Exception as e:
+                self.manifest.page_failed(page_number)
+                logger.exception('Error saving page %d' % page_number)
+                self.progress.page_failed(page_number, e)
+            else:
+                self.saved_pages_count += 1
+                self.new_posts_count += sum(1 for post_id in data['post_ids'] if post_id > self.previous_last_post_id)
+                self.last_post_id = max([self.last_post_id] + data['post_ids'])
+                logger.info('Finished page %d/%d (%d new images and stylesheets queued) in %d seconds'
+                            % (page_number, self.total_pages, data['queued_assets_count'],
+                               data['execution_time_seconds']))
+        if own_parse_executor:
+            self.parse_executor.shutdown(wait=True)
+        self.parse_executor = None
+
+    def finish(self):
+        """
+        Record the export as finished once its images and stylesheets have been downloaded
+        :return: dict with the number of pages saved, new posts found, images and stylesheets downloaded, and pages
+        and images and stylesheets still unfinished, which the next export of the thread will retry
+        """
+        downloaded_count = self.asset_downloader.pop_downloaded_count(self.manifest)
+        if self.extract_posts:
+            with self.metrics.time('stitch_posts'):
+                posts_count = PostExtractor.stitch(self.output_folder, parquet=self.posts_parquet)
+            logger.info('Saved %d posts from thread %d to %s'
+                        % (posts_count, self.threadid, PostExtractor.POSTS_FILENAME))
+        if self.media is not None:
+            with self.metrics.time('media'):
+                self.media.process(self.output_folder, self.manifest)
+        self.manifest.set('last_post_id', self.last_post_id)
+        unfinished_pages_count, unfinished_assets_count = self.manifest.unfinished_counts(self.total_pages)
+        self.manifest.close()
+        if self.archive:
+            with self.metrics.time('archive'):
+                archive_filename = ThreadArchive.pack(self.output_folder, remove=True)
+            logger.info('Packed thread %d export into %s' % (self.threadid, archive_filename))
+        if self.previous_last_post_id:
+            logger.info('Found %d new posts since the previous export of thread %d'
+                        % (self.new_posts_count, self.threadid))
+        logger.info('Finished exporting thread %d (%d images and stylesheets downloaded)'
+                    % (self.threadid, downloaded_count))
+        if unfinished_pages_count or unfinished_assets_count:
+            logger.warning('Thread %d has %d pages and %d images and stylesheets that could not be saved, exporting it'
+                           ' again will retry them' % (self.threadid, unfinished_pages_count, unfinished_assets_count))
+        return {
+            'saved_pages_count': self.saved_pages_count,
+            'new_posts_count': self.new_posts_count,
+            'downloaded_assets_count': downloaded_count,
+            'unfinished_pages_count': unfinished_pages_count,
+            'unfinished_assets_count': unfinished_assets_count
+        }
+
+    def __save_page(self, page_number):
+        """
+        Saves a single page and queues its images and stylesheets for download, once the export's control allows it
+        :param page_number:
+        :return:
+        """
+        with self.control.slot(ExportControl.PAGE):
+            return self.__save_allowed_page(page_number)
+
+    def __save_allowed_page(self, page_number):
+        start = time.time()
+        queued_assets_count = 0
+
+        output_filename = os.path.join(self.output_folder,
+                                       self.PAGE_PATTERN_FILENAME % str(page_number).zfill(self.page_pad_zeros))
+        logger.info('Starting thread %d page %d/%d' % (self.threadid, page_number, self.total_pages))
+        self.progress.page_started(page_number, self.total_pages)
+        r = self.prefetched_pages.pop(page_number, None)
+        if r is None:
+            r = self.__get_page(page_number)
+        if self.parse_executor:
+            page = self.parse_executor.submit(self.rewriter.save, r.text, page_number, output_filename).result()
+        else:
+            page = self.rewriter.save(r.text, page_number, output_filename)
+        for stage, seconds in page['timings'].items():
+            self.metrics.observe(stage, seconds)
+        with self.metrics.time('manifest'):
+            self.manifest.page_complete(page_number, page['size'], page['sha256'], page['assets'],
+                                        etag=r.headers.get('ETag'), last_modified=r.headers.get('Last-Modified'))
+        if self.search_index is not None:
+            with self.metrics.time('search_index'):
+                self.search_index.index_page(self.threadid, page_number, output_filename, page['posts'])
+        for url, asset_filename in page['assets']:
+            if self.asset_downloader.enqueue(url, asset_filename, page_number, self.manifest, self.progress,
+                                             self.control):
+                queued_assets_count += 1
+
+        end = time.time()
+        self.metrics.observe('page', end - start)
+        self.progress.page_finished(page_number, self.total_pages, len(r.content), queued_assets_count, end - start)
+        return {
+            'queued_assets_count': queued_assets_count,
+            'post_ids': page['post_ids'],
+            'execution_time_seconds': end - start
+        }
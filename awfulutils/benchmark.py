@@ -0,0 +1,452 @@
+import collections
+import hashlib
+import http.server
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from awfulutils import __version__
+from awfulutils.awfulclient import AwfulClient
+from awfulutils.metrics import ExportMetrics
+
+logger = logging.getLogger(__name__)
+
+
+class ForumStandIn(http.server.ThreadingHTTPServer):
+    """
+    Stands in for the forums and the image hosts threads link to, so exports can be measured without an account or a
+    network. Thread pages replay the recorded showthread.html with its paginator and post ids changed to suit the page
+    asked for, and a thread has as many pages as its threadid unless told otherwise, so thread 50 has 50 pages.
+    Profiles and forum listings replay member.html and forumdisplay.html. Images and stylesheets are made up as they
+    are asked for, each one the same every time it is asked for and different from every other.
+
+    Links to other hosts in the recordings are pointed at localhost instead, so images still come from a different
+    host name than the forums as far as the scheduler can tell. Every response can be delayed, limited to a
+    bandwidth and made to fail some of the time, as the real site does. Thread pages carry an ETag of their contents,
+    and a conditional request for a page that has not changed is answered with 304 Not Modified.
+    """
+    SHOWTHREAD_FILENAME = 'showthread.html'
+    MEMBER_FILENAME = 'member.html'
+    FORUMDISPLAY_FILENAME = 'forumdisplay.html'
+    ASSETS_HOST = 'localhost'
+    DEFAULT_ASSET_SIZE = 32 * 1024
+    FAILURES = [500, 503, 429, None]
+    IMAGE_HEADERS = {
+        '.png': (b'\x89PNG\r\n\x1a\n', 'image/png'),
+        '.jpg': (b'\xff\xd8\xff\xe0', 'image/jpeg'),
+        '.jpeg': (b'\xff\xd8\xff\xe0', 'image/jpeg'),
+        '.gif': (b'GIF89a', 'image/gif'),
+        '.ico': (b'\x00\x00\x01\x00', 'image/x-icon')
+    }
+    PAGES_PATTERN = re.compile(r'<div class="pages">.*?</div>', re.DOTALL)
+    POST_ID_PATTERN = re.compile(r'(post|postid=)(\d+)')
+    ABSOLUTE_URL_PATTERN = re.compile(r'(?:https?:)?//[a-zA-Z0-9.-]+(?::\d+)?(/[^"\'\s>]*)?')
+    # post ids on each page are moved this far along from those in the recording
+    POST_IDS_PER_PAGE = 1000
+
+    def __init__(self, recordings_folder, server_address=('127.0.0.1', 0), latency=0.0, bandwidth=None,
+                 failure_rate=0.0, asset_size=DEFAULT_ASSET_SIZE, seed=None, thread_pages=None, errors=None):
+        """
+        :param recordings_folder: folder with the recorded showthread.html, member.html and forumdisplay.html
+        :param server_address: address to serve on, by default a free port on 127.0.0.1
+        :param latency: seconds every response is delayed by before it starts
+        :param bandwidth: if set, bytes per second each response is sent at
+        :param failure_rate: share of requests answered with a 500, 503 or 429 or by dropping the connection
+        :param asset_size: size in bytes of the images and stylesheets
+        :param seed: seed for choosing which requests fail, so runs fail the same requests
+        :param thread_pages: dict of threadid to the number of pages the thread has, for threads that should not have
+        as many pages as their threadid
+        :param errors: dict of regular expression to the status code every request whose path and query it matches
+        is answered with, such as {r'/ext/': 404}. It can be changed while serving.
+        """
+        super().__init__(server_address, ForumStandInRequestHandler)
+        self.recordings = {}
+        for filename in [self.SHOWTHREAD_FILENAME, self.MEMBER_FILENAME, self.FORUMDISPLAY_FILENAME]:
+            with open(os.path.join(recordings_folder, filename), encoding='utf-8') as recording_file:
+                self.recordings[filename] = recording_file.read()
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.asset_size = asset_size
+        self.thread_pages = thread_pages or {}
+        self.errors = errors if errors is not None else {}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests_count = 0
+        self.failures_count = 0
+        # number of times each path and query has been requested
+        self.paths_requested = collections.Counter()
+        self.thread = None
+
+    @property
+    def forums_url(self):
+        return 'http://%s:%d' % self.server_address[:2]
+
+    @property
+    def assets_url(self):
+        return 'http://%s:%d' % (self.ASSETS_HOST, self.server_address[1])
+
+    def start(self):
+        """
+        Serve in a background thread until stop() is called
+        :return: the url to use as AwfulClient.FORUMS_URL
+        """
+        self.thread = threading.Thread(target=self.serve_forever, name='ForumStandIn', daemon=True)
+        self.thread.start()
+        return self.forums_url
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def should_fail(self, path):
+        """
+        :param path: path and query of the request
+        :return: None if the request should be answered, otherwise the status code to fail it with, or 0 to drop the
+        connection
+        """
+        with self.lock:
+            self.requests_count += 1
+            self.paths_requested[path] += 1
+            for pattern, status in list(self.errors.items()):
+                if re.search(pattern, path):
+                    self.failures_count += 1
+                    return status
+            if not self.failure_rate or self.random.random() >= self.failure_rate:
+                return None
+            self.failures_count += 1
+            return self.random.choice(self.FAILURES) or 0
+
+    def thread_page(self, threadid, page_number):
+        """
+        :param threadid:
+        :param page_number:
+        :return: the recorded thread page made over into the page asked for
+        """
+        total_pages = self.thread_pages.get(threadid, max(threadid, 1))
+        page_number = min(max(page_number, 1), total_pages)
+        html = self.PAGES_PATTERN.sub(lambda _: self.__paginator(threadid, page_number, total_pages),
+                                      self.recordings[self.SHOWTHREAD_FILENAME])
+        html = self.POST_ID_PATTERN.sub(
+            lambda match: match.group(1) + str(int(match.group(2)) + page_number * self.POST_IDS_PER_PAGE), html)
+        return self.ABSOLUTE_URL_PATTERN.sub(lambda match: self.__asset_url(match.group(1) or '/', page_number), html)
+
+    def asset(self, path):
+        """
+        :param path: path of the image or stylesheet asked for
+        :return: made up contents and content type of the image or stylesheet, the same every time for the same path
+        """
+        extension = os.path.splitext(path)[1].lower()
+        filler = hashlib.sha256(path.encode('utf-8')).digest()
+        if extension == '.css':
+            header, content_type = ('/* %s */\n' % filler.hex()).encode('utf-8'), 'text/css'
+            filler = b'.post{margin:0}\n'
+        else:
+            header, content_type = self.IMAGE_HEADERS.get(extension, self.IMAGE_HEADERS['.png'])
+        body_size = max(self.asset_size - len(header), 0)
+        return header + (filler * (body_size // len(filler) + 1))[:body_size], content_type
+
+    def __asset_url(self, path, page_number):
+        """
+        Point a link to another host at the stand-in. Images on other hosts are given a different name on every page,
+        as most images posted in a thread are only posted once.
+        """
+        folder, filename = path.rsplit('/', 1)
+        name, extension = os.path.splitext(filename)
+        if extension.lower() in self.IMAGE_HEADERS:
+            filename = '%s_%d%s' % (name, page_number, extension)
+        return '%s%s/%s' % (self.assets_url, folder, filename)
+
+    @staticmethod
+    def __paginator(threadid, page_number, total_pages):
+        url = '/showthread.php?threadid=%d&amp;pagenumber=%%d' % threadid
+        links = []
+        if page_number > 1:
+            links.append('<a title="First page" href="%s">1</a>' % (url % 1))
+            links.append('<a title="Previous page" href="%s">&lt;</a>' % (url % (page_number - 1)))
+        links.append('<select data-url="showthread.php?threadid=%d">%s</select>' % (threadid, ''.join(
+            '<option value="%d"%s>%d</option>' % (number, ' selected' if number == page_number else '', number)
+            for number in range(1, total_pages + 1))))
+        if page_number < total_pages:
+            links.append('<a title="Next page" href="%s">&gt;</a>' % (url % (page_number + 1)))
+            links.append('<a title="Last page" href="%s">Last</a>' % (url % total_pages))
+        return '<div class="pages">%s</div>' % ''.join(links)
+
+
+class ForumStandInRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, which would otherwise wait on the client's delayed acknowledgement
+    disable_nagle_algorithm = True
+    CHUNK_SIZE = 16 * 1024
+
+    def do_GET(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        failure = self.server.should_fail(self.path)
+        if failure == 0:
+            self.close_connection = True
+            return
+        if failure:
+            self.send_response(failure)
+            self.send_header('Content-Length', '0')
+            return self.end_headers()
+
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        etag = None
+        if url.path == '/showthread.php':
+            data = self.server.thread_page(int(query.get('threadid', ['1'])[0]),
+                                           int(query.get('pagenumber', ['1'])[0])).encode('utf-8')
+            content_type = 'text/html; charset=utf-8'
+            etag = '"%s"' % hashlib.sha256(data).hexdigest()[:16]
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                return self.end_headers()
+        elif url.path == '/member.php':
+            data = self.server.recordings[ForumStandIn.MEMBER_FILENAME].encode('utf-8')
+            content_type = 'text/html; charset=utf-8'
+        elif url.path == '/forumdisplay.php':
+            data = self.server.recordings[ForumStandIn.FORUMDISPLAY_FILENAME].encode('utf-8')
+            content_type = 'text/html; charset=utf-8'
+        else:
+            data, content_type = self.server.asset(self.path)
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        if etag:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.__send(data)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def __send(self, data):
+        if not self.server.bandwidth:
+            return self.wfile.write(data)
+        for start in range(0, len(data), self.CHUNK_SIZE):
+            chunk = data[start:start + self.CHUNK_SIZE]
+            self.wfile.write(chunk)
+            time.sleep(len(chunk) / self.server.bandwidth)
+
+
+class Benchmark:
+    """
+    Measures exporting threads of several sizes and looking up users against a ForumStandIn, for comparing one
+    version with another. Each run happens in a fresh process, so its CPU time and peak memory are its own and not
+    those of the stand-in or of earlier runs. The fastest of the repeated runs of each case is kept, being the one
+    least disturbed by whatever else the machine was doing.
+    """
+    # the recordings are not installed with the package, so this is only there when running from a source checkout
+    DEFAULT_RECORDINGS_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test_data')
+    DEFAULT_THREAD_SIZES = [1, 10, 50]
+    DEFAULT_USERINFO_COUNT = 50
+    DEFAULT_REPEAT = 1
+    # changes smaller than this are treated as noise when comparing with earlier results
+    DEFAULT_TOLERANCE = 0.1
+    # for each kind of case, the measurements where bigger is better and those where smaller is
+    THROUGHPUTS = {'export_thread': ['pages_per_second', 'assets_per_second'], 'userinfo': ['users_per_second']}
+    COSTS = ['cpu_seconds', 'peak_memory_bytes']
+
+    def __init__(self, recordings_folder, thread_sizes=None, userinfo_count=DEFAULT_USERINFO_COUNT,
+                 repeat=DEFAULT_REPEAT, export_options=None, **stand_in_options):
+        """
+        :param recordings_folder: folder with the recordings the ForumStandIn replays
+        :param thread_sizes: numbers of pages in the threads exported, one case each
+        :param userinfo_count: number of users looked up, none if 0
+        :param repeat: how many times each case is run
+        :param export_options: keyword arguments passed through to ThreadExport, such as parser or page_workers
+        :param stand_in_options: keyword arguments passed through to ForumStandIn, such as latency or failure_rate
+        """
+        self.recordings_folder = recordings_folder
+        self.thread_sizes = thread_sizes if thread_sizes is not None else self.DEFAULT_THREAD_SIZES
+        self.userinfo_count = userinfo_count
+        self.repeat = repeat
+        self.export_options = export_options or {}
+        self.stand_in_options = stand_in_options
+
+    def cases(self):
+        cases = [{'name': 'export_thread', 'pages': pages} for pages in self.thread_sizes]
+        if self.userinfo_count:
+            cases.append({'name': 'userinfo', 'users': self.userinfo_count})
+        return cases
+
+    def run(self):
+        """
+        :return: dict describing the machine and settings, with a list of the results of each case
+        """
+        stand_in = ForumStandIn(self.recordings_folder, **self.stand_in_options)
+        forums_url = stand_in.start()
+        context = multiprocessing.get_context('spawn')
+        results = []
+        try:
+            for case in self.cases():
+                runs = []
+                for _ in range(self.repeat):
+                    receiver, sender = context.Pipe(duplex=False)
+                    process = context.Process(target=self.run_case,
+                                              args=(case, forums_url, self.export_options, sender))
+                    process.start()
+                    sender.close()
+                    try:
+                        runs.append(receiver.recv())
+                    except EOFError:
+                        raise RuntimeError('Benchmark case %r exited with code %s without a result'
+                                           % (case, process.exitcode))
+                    finally:
+                        process.join()
+                        receiver.close()
+                result = min(runs, key=lambda run: run['wall_seconds'])
+                logger.info('%s: %s' % (', '.join('%s %s' % item for item in case.items()),
+                                        ', '.join('%s %s' % (key, self.__format(result[key]))
+                                                  for key in self.THROUGHPUTS[case['name']] + self.COSTS)))
+                results.append(result)
+        finally:
+            stand_in.stop()
+        return {
+            'version': __version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'created_at': datetime.now().isoformat(),
+            'settings': {
+                'repeat': self.repeat,
+                'export_options': self.export_options,
+                'stand_in_options': self.stand_in_options,
+                'failed_requests_count': stand_in.failures_count,
+                'requests_count': stand_in.requests_count
+            },
+            'results': results
+        }
+
+    @classmethod
+    def run_case(cls, case, forums_url, export_options, connection):
+        """
+        Run a single case and send its result down a connection. This is run in a fresh process.
+        :param case: dict with the name of the case and its size
+        :param forums_url: url of the ForumStandIn
+        :param export_options:
+        :param connection: multiprocessing connection the result is sent on
+        :return:
+        """
+        AwfulClient.FORUMS_URL = forums_url
+        folder = tempfile.mkdtemp()
+        previous_folder = os.getcwd()
+        os.chdir(folder)
+        try:
+            metrics = ExportMetrics()
+            awful_client = AwfulClient(0, '', metrics=metrics)
+            start_cpu_seconds = cls.cpu_seconds()
+            start = time.time()
+            if case['name'] == 'export_thread':
+                export = awful_client.export_thread(case['pages'], **export_options)
+            else:
+                for userid in range(1, case['users'] + 1):
+                    awful_client.userinfo(userid)
+            wall_seconds = time.time() - start
+            cpu_seconds = cls.cpu_seconds() - start_cpu_seconds
+            summary = metrics.summary()
+        finally:
+            os.chdir(previous_folder)
+            shutil.rmtree(folder)
+
+        result = dict(case)
+        result.update({
+            'wall_seconds': wall_seconds,
+            'cpu_seconds': cpu_seconds,
+            'peak_memory_bytes': cls.peak_memory_bytes()
+        })
+        if case['name'] == 'export_thread':
+            result.update({
+                'saved_pages_count': export['saved_pages_count'],
+                'downloaded_assets_count': export['downloaded_assets_count'],
+                'pages_per_second': export['saved_pages_count'] / wall_seconds,
+                'assets_per_second': export['downloaded_assets_count'] / wall_seconds,
+                'bytes_downloaded': sum(summary['counters'].get('bytes_downloaded', {}).values()),
+                'retries_count': sum(summary['counters'].get('retries', {}).values()),
+                'stages': {stage: timing['total_seconds'] for stage, timing in summary['stages'].items()},
+                'utilization': summary['utilization']
+            })
+        else:
+            result['users_per_second'] = case['users'] / wall_seconds
+        connection.send(result)
+        connection.close()
+
+    @staticmethod
+    def cpu_seconds():
+        """
+        :return: CPU time used so far by this process and the processes it has finished waiting for, such as the
+        processes pages were parsed in
+        """
+        if resource is None:
+            return time.process_time()
+        return sum(usage.ru_utime + usage.ru_stime for usage in [resource.getrusage(resource.RUSAGE_SELF),
+                                                                 resource.getrusage(resource.RUSAGE_CHILDREN)])
+
+    @staticmethod
+    def peak_memory_bytes():
+        """
+        :return: most memory this process has had resident at once, or None where that cannot be found out
+        """
+        if resource is None:
+            return None
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS reports bytes, everywhere else reports KiB
+        return max_rss if platform.system() == 'Darwin' else max_rss * 1024
+
+    @classmethod
+    def compare(cls, previous, current, tolerance=DEFAULT_TOLERANCE):
+        """
+        Compare results with earlier results, such as those of the previous version
+        :param previous: dict returned by run() earlier
+        :param current: dict returned by run()
+        :param tolerance: smallest relative change that counts
+        :return: list of dicts, one per measurement that changed by more than the tolerance, saying whether it got
+        worse
+        """
+        def key(result):
+            return tuple(sorted((name, value) for name, value in result.items() if name in ['name', 'pages', 'users']))
+
+        previous_results = {key(result): result for result in previous['results']}
+        changes = []
+        for result in current['results']:
+            previous_result = previous_results.get(key(result))
+            if previous_result is None:
+                continue
+            throughputs = cls.THROUGHPUTS[result['name']]
+            for measurement in throughputs + cls.COSTS:
+                before, after = previous_result.get(measurement), result.get(measurement)
+                if not before or after is None:
+                    continue
+                change = (after - before) / before
+                if abs(change) > tolerance:
+                    changes.append({
+                        'case': dict(key(result)),
+                        'measurement': measurement,
+                        'previous': before,
+                        'current': after,
+                        'change': change,
+                        'worse': (change < 0) == (measurement in throughputs)
+                    })
+        return changes
+
+    @staticmethod
+    def __format(value):
+        return '%.2f' % value if isinstance(value, float) else str(value)
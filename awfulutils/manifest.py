@@ -0,0 +1,247 @@
+import glob
+import os
+import sqlite3
+import threading
+import time
+
+
+class ExportManifest:
+    """
+    Journal of every page and asset in a thread export, kept in a SQLite database in the output folder. Pages and
+    assets are only marked complete once they have been written to disk in full, so a rerun can tell exactly which
+    items still need to be fetched without looking at the output folder at all.
+    """
+    FILENAME = 'manifest.sqlite'
+    PENDING = 'pending'
+    COMPLETE = 'complete'
+    FAILED = 'failed'
+
+    def __init__(self, output_folder):
+        self.output_folder = output_folder
+        manifest_filename = os.path.join(output_folder, self.FILENAME)
+        is_new = not os.path.exists(manifest_filename)
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(manifest_filename, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS pages (
+                page_number INTEGER PRIMARY KEY,
+                status TEXT NOT NULL,
+                size INTEGER,
+                sha256 TEXT,
+                fetched_at REAL,
+                etag TEXT,
+                last_modified TEXT
+            );
+            CREATE TABLE IF NOT EXISTS assets (
+                filename TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                page_number INTEGER,
+                status TEXT NOT NULL,
+                size INTEGER,
+                sha256 TEXT,
+                fetched_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS assets_status ON assets (status);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        ''')
+        # manifests written before page validators were recorded need the columns added
+        page_columns = [row[1] for row in self.connection.execute('PRAGMA table_info(pages)')]
+        for column in ['etag', 'last_modified']:
+            if column not in page_columns:
+                self.connection.execute('ALTER TABLE pages ADD COLUMN %s TEXT' % column)
+        if is_new:
+            self.__import_existing_export()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def get(self, key, default=None):
+        """
+        Retrieve a value stored about the export as a whole
+        :param key:
+        :param default:
+        :return:
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def set(self, key, value):
+        """
+        Store a value about the export as a whole
+        :param key:
+        :param value:
+        :return:
+        """
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+
+    def pages_to_fetch(self, total_pages):
+        """
+        Work out which pages need to be fetched. That is every page that is not complete, plus what was the last page
+        of the thread during the previous export since it has probably changed. If the thread has grown enough that the
+        page numbers in the filenames need another digit, every page is fetched again.
+        :param total_pages:
+        :return: sorted list of page numbers
+        """
+        previous_total_pages = int(self.get('total_pages', 0))
+        if len(str(previous_total_pages)) != len(str(total_pages)):
+            return list(range(1, total_pages + 1))
+        with self.lock:
+            complete_pages = set(row[0] for row in self.connection.execute(
+                'SELECT page_number FROM pages WHERE status = ? AND page_number <= ?', (self.COMPLETE, total_pages)))
+        complete_pages.discard(previous_total_pages)
+        return [page_number for page_number in range(1, total_pages + 1) if page_number not in complete_pages]
+
+    def page_complete(self, page_number, size, sha256, assets, etag=None, last_modified=None):
+        """
+        Mark a page as complete, recording the assets it refers to as pending unless they are already known. Both are
+        done in one transaction so a page is never complete without its assets being recorded.
+        :param page_number:
+        :param size: size of the saved page in bytes
+        :param sha256: hex digest of the saved page
+        :param assets: list of (url, output filename) tuples for each asset on the page
+        :param etag: ETag header the page was served with
+        :param last_modified: Last-Modified header the page was served with
+        :return:
+        """
+        with self.lock, self.connection:
+            self.connection.execute('BEGIN')
+            self.connection.execute('INSERT OR REPLACE INTO pages (page_number, status, size, sha256, fetched_at, etag,'
+                                    ' last_modified) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (page_number, self.COMPLETE, size, sha256, time.time(), etag, last_modified))
+            self.connection.executemany('INSERT OR IGNORE INTO assets (filename, url, page_number, status)'
+                                        ' VALUES (?, ?, ?, ?)',
+                                        [(self.__relative(filename), url, page_number, self.PENDING)
+                                         for url, filename in assets])
+
+    def page_validators(self, page_number):
+        """
+        :param page_number:
+        :return: tuple of the ETag and Last-Modified headers a complete page was served with, either may be None
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT etag, last_modified FROM pages WHERE page_number = ? AND status = ?',
+                                          (page_number, self.COMPLETE)).fetchone()
+        return tuple(row) if row else (None, None)
+
+    def page_failed(self, page_number):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO pages (page_number, status, fetched_at) VALUES (?, ?, ?)',
+                                    (page_number, self.FAILED, time.time()))
+
+    def asset_is_complete(self, filename):
+        with self.lock:
+            row = self.connection.execute('SELECT status FROM assets WHERE filename = ?',
+                                          (self.__relative(filename),)).fetchone()
+        return row is not None and row[0] == self.COMPLETE
+
+    def unfinished_assets(self):
+        """
+        Assets that were pending when a previous export stopped, or that failed to download
+        :return: list of (url, output filename, page number) tuples
+        """
+        with self.lock:
+            rows = self.connection.execute('SELECT url, filename, page_number FROM assets WHERE status != ?',
+                                           (self.COMPLETE,)).fetchall()
+        return [(url, os.path.join(self.output_folder, filename), page_number) for url, filename, page_number in rows]
+
+    def unfinished_counts(self, total_pages):
+        """
+        :param total_pages:
+        :return: tuple of the number of pages of the thread that are not complete and the number of assets that are not
+        complete, both zero once everything has been saved
+        """
+        with self.lock:
+            complete_pages_count = self.connection.execute(
+                'SELECT COUNT(*) FROM pages WHERE status = ? AND page_number <= ?',
+                (self.COMPLETE, total_pages)).fetchone()[0]
+            unfinished_assets_count = self.connection.execute('SELECT COUNT(*) FROM assets WHERE status != ?',
+                                                              (self.COMPLETE,)).fetchone()[0]
+        return total_pages - complete_pages_count, unfinished_assets_count
+
+    def complete_assets(self):
+        """
+        :return: list of (filename relative to the output folder, size, sha256 hex digest) tuples for every asset that
+        has been downloaded, the digest is None for assets imported from exports made before there was a manifest
+        """
+        with self.lock:
+            return self.connection.execute('SELECT filename, size, sha256 FROM assets WHERE status = ?',
+                                           (self.COMPLETE,)).fetchall()
+
+    def asset_complete(self, filename, url, size, sha256):
+        self.__update_asset(filename, url, self.COMPLETE, size, sha256)
+
+    def asset_failed(self, filename, url):
+        self.__update_asset(filename, url, self.FAILED, None, None)
+
+    def __update_asset(self, filename, url, status, size, sha256):
+        with self.lock:
+            self.connection.execute('INSERT INTO assets (filename, url, status, size, sha256, fetched_at)'
+                                    ' VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (filename) DO UPDATE SET'
+                                    ' url = excluded.url, status = excluded.status, size = excluded.size,'
+                                    ' sha256 = excluded.sha256, fetched_at = excluded.fetched_at',
+                                    (self.__relative(filename), url, status, size, sha256, time.time()))
+
+    def __relative(self, filename):
+        """
+        Assets are recorded relative to the output folder so the export can be moved
+        :param filename:
+        :return:
+        """
+        return os.path.relpath(filename, self.output_folder)
+
+    def __import_existing_export(self):
+        """
+        Exports made before there was a manifest are imported once, trusting whatever files are already there as long
+        as they are not empty. Empty files, such as those left by a crash, are left out so they are fetched again, and
+        so are the pages that refer to an empty image or stylesheet, which queues it for download again. The highest
+        numbered page is treated as the last page of the previous export so it is fetched again.
+        :return:
+        """
+        pages = []
+        for page_filename in glob.glob(os.path.join(self.output_folder, 'page_*.html')):
+            page_number = int(os.path.basename(page_filename)[len('page_'):-len('.html')])
+            pages.append((page_number, page_filename, os.path.getsize(page_filename)))
+        asset_filenames = []
+        empty_asset_filenames = []
+        for asset_folder in ['images', 'css']:
+            for asset_filename in glob.glob(os.path.join(self.output_folder, asset_folder, '*')):
+                if asset_filename.endswith('.part'):
+                    continue
+                size = os.path.getsize(asset_filename)
+                if size:
+                    asset_filenames.append((self.__relative(asset_filename), size))
+                else:
+                    # pages refer to their images and stylesheets relative to the output folder
+                    empty_asset_filenames.append(self.__relative(asset_filename).replace(os.sep, '/'))
+        if not pages and not asset_filenames:
+            return
+
+        page_numbers = []
+        for page_number, page_filename, size in pages:
+            if not size:
+                continue
+            if empty_asset_filenames:
+                with open(page_filename, encoding='utf-8', errors='replace') as page_file:
+                    html = page_file.read()
+                if any('"%s"' % filename in html for filename in empty_asset_filenames):
+                    continue
+            page_numbers.append((page_number, size))
+
+        with self.lock, self.connection:
+            self.connection.execute('BEGIN')
+            self.connection.executemany('INSERT INTO pages (page_number, status, size) VALUES (?, ?, ?)',
+                                        [(page_number, self.COMPLETE, size) for page_number, size in page_numbers])
+            self.connection.executemany('INSERT INTO assets (filename, url, status, size) VALUES (?, ?, ?, ?)',
+                                        [(filename, '', self.COMPLETE, size) for filename, size in asset_filenames])
+            if pages:
+                self.connection.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                                        ('total_pages', str(max(pages)[0])))
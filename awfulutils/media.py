@@ -0,0 +1,177 @@
+import concurrent.futures
+import logging
+import os
+
+from awfulutils.assetstore import AssetStore
+
+logger = logging.getLogger(__name__)
+
+
+class MediaStage:
+    """
+    Runs over the images of an export once they have all been downloaded, off the path of the page workers. Every
+    image is kept once in the media folder, named after the sha256 of what was downloaded with an extension for the
+    type its contents really are, and the files the pages refer to become hardlinks to it, so identical images from
+    different urls only take up space once. Oversized images can also be recompressed in a pool of processes, which
+    requires Pillow. A recompressed image is only kept when it is meaningfully smaller than the original.
+    """
+    MEDIA_FOLDER = 'media'
+    IMAGES_FOLDER = 'images'
+    MAGIC_NUMBERS = [
+        (b'\x89PNG\r\n\x1a\n', 'png'),
+        (b'\xff\xd8\xff', 'jpg'),
+        (b'GIF87a', 'gif'),
+        (b'GIF89a', 'gif'),
+        (b'BM', 'bmp'),
+        (b'\x00\x00\x01\x00', 'ico')
+    ]
+    RECOMPRESSED_TYPES = ['png', 'jpg', 'gif']
+    DEFAULT_MIN_RECOMPRESS_SIZE = 256 * 1024
+    DEFAULT_JPEG_QUALITY = 85
+    # a recompressed image has to be at least this much smaller than the original to replace it
+    MAX_RECOMPRESSED_RATIO = 0.9
+
+    def __init__(self, recompress=False, min_recompress_size=DEFAULT_MIN_RECOMPRESS_SIZE,
+                 jpeg_quality=DEFAULT_JPEG_QUALITY, max_dimension=None, processes=None):
+        """
+        :param recompress: recompress images larger than min_recompress_size. Requires Pillow.
+        :param min_recompress_size: size in bytes an image has to be before it is recompressed
+        :param jpeg_quality: quality JPEG images are recompressed at
+        :param max_dimension: if set, recompressed images are also scaled down to fit within this many pixels wide and
+        high
+        :param processes: number of processes used to recompress images, defaults to the number of CPUs
+        """
+        if recompress:
+            # fail now rather than once the whole thread has been exported
+            import PIL
+        self.recompress = recompress
+        self.min_recompress_size = min_recompress_size
+        self.jpeg_quality = jpeg_quality
+        self.max_dimension = max_dimension
+        self.processes = processes
+        self.executor = None
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    @classmethod
+    def detect_type(cls, filename):
+        """
+        :param filename:
+        :return: the type of image a file really contains judging by its first few bytes, such as png, or None
+        """
+        with open(filename, 'rb') as input_file:
+            header = input_file.read(16)
+        for magic_number, image_type in cls.MAGIC_NUMBERS:
+            if header.startswith(magic_number):
+                return image_type
+        if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+            return 'webp'
+        return None
+
+    def process(self, output_folder, manifest):
+        """
+        Move every downloaded image of an export into the media folder and link it back into place, recompressing
+        new images if asked to
+        :param output_folder:
+        :param manifest: ExportManifest of the export, which has the sha256 of every downloaded image
+        :return: dict with the number of images processed, the number that were duplicates of another image, the
+        number recompressed and the bytes saved by recompressing them
+        """
+        media_folder = os.path.join(output_folder, self.MEDIA_FOLDER)
+        os.makedirs(media_folder, exist_ok=True)
+        images_prefix = self.IMAGES_FOLDER + os.sep
+        filenames_by_sha256 = {}
+        for filename, size, sha256 in manifest.complete_assets():
+            if filename.startswith(images_prefix) and sha256 and os.path.exists(os.path.join(output_folder, filename)):
+                filenames_by_sha256.setdefault(sha256, []).append(os.path.join(output_folder, filename))
+
+        media_filenames = {}
+        new_media_filenames = []
+        for sha256, filenames in filenames_by_sha256.items():
+            image_type = self.detect_type(filenames[0])
+            media_filename = os.path.join(media_folder, sha256 + ('.' + image_type if image_type else ''))
+            if not os.path.exists(media_filename):
+                AssetStore.link(filenames[0], media_filename)
+                if self.recompress and image_type in self.RECOMPRESSED_TYPES and \
+                        os.path.getsize(media_filename) >= self.min_recompress_size:
+                    new_media_filenames.append((media_filename, image_type))
+            media_filenames[sha256] = media_filename
+
+        recompressed_count = 0
+        saved_size = 0
+        if new_media_filenames:
+            if self.executor is None:
+                self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.processes)
+            futures = {
+                self.executor.submit(self.recompress_image, media_filename, image_type, self.jpeg_quality,
+                                     self.max_dimension): media_filename
+                for media_filename, image_type in new_media_filenames
+            }
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    saved = future.result()
+                except Exception as e:
+                    # images that are damaged, or not really images, are kept as they are
+                    logger.warning('Could not recompress %s due to %r' % (futures[future], e))
+                    continue
+                if saved:
+                    recompressed_count += 1
+                    saved_size += saved
+
+        duplicates_count = 0
+        linked_count = 0
+        for sha256, filenames in filenames_by_sha256.items():
+            media_stat = os.stat(media_filenames[sha256])
+            duplicates_count += len(filenames) - 1
+            for filename in filenames:
+                if not os.path.samestat(os.stat(filename), media_stat):
+                    AssetStore.link(media_filenames[sha256], filename)
+                    linked_count += 1
+        logger.info('Linked %d images in %s to the media folder (%d duplicates share a file, %d recompressed saving'
+                    ' %d KiB)'
+                    % (linked_count, output_folder, duplicates_count, recompressed_count, saved_size // 1024))
+        return {
+            'images_count': sum(len(filenames) for filenames in filenames_by_sha256.values()),
+            'duplicates_count': duplicates_count,
+            'recompressed_count': recompressed_count,
+            'saved_size': saved_size
+        }
+
+    @classmethod
+    def recompress_image(cls, filename, image_type, jpeg_quality=DEFAULT_JPEG_QUALITY, max_dimension=None):
+        """
+        Recompress an image in place, keeping the original unless the result is meaningfully smaller. Animated GIFs
+        keep every frame. This only takes plain arguments so it can be run in another process.
+        :param filename:
+        :param image_type: png, jpg or gif
+        :param jpeg_quality:
+        :param max_dimension: if set, scale the image down to fit within this many pixels wide and high
+        :return: bytes saved, 0 if the original was kept
+        """
+        from PIL import Image
+        original_size = os.path.getsize(filename)
+        partial_filename = filename + '.part'
+        try:
+            with Image.open(filename) as image:
+                animated = getattr(image, 'is_animated', False)
+                if max_dimension and not animated and max(image.size) > max_dimension:
+                    image.thumbnail((max_dimension, max_dimension))
+                if image_type == 'jpg':
+                    if image.mode not in ['RGB', 'L', 'CMYK']:
+                        image = image.convert('RGB')
+                    image.save(partial_filename, 'JPEG', quality=jpeg_quality, optimize=True, progressive=True)
+                elif image_type == 'png':
+                    image.save(partial_filename, 'PNG', optimize=True)
+                else:
+                    image.save(partial_filename, 'GIF', optimize=True, save_all=animated)
+            recompressed_size = os.path.getsize(partial_filename)
+            if recompressed_size > original_size * cls.MAX_RECOMPRESSED_RATIO:
+                return 0
+            os.replace(partial_filename, filename)
+            return original_size - recompressed_size
+        finally:
+            if os.path.exists(partial_filename):
+                os.remove(partial_filename)
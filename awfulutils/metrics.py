@@ -0,0 +1,184 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+class ExportMetrics:
+    """
+    Collects measurements from every part of an export: how long each stage takes, bytes transferred per host, cache
+    hits, retries, queue depths and how busy the worker pools are, so it is possible to tell whether an export is
+    limited by the network, the CPU or the disk. Collecting is cheap and always done. Measurements can be passed to a
+    callback as they are made, and a summary written as JSON or as a Prometheus textfile when the run finishes.
+    """
+    PROMETHEUS_PREFIX = 'awfulutils'
+    TIMING = 'timing'
+    COUNTER = 'counter'
+    GAUGE = 'gauge'
+
+    def __init__(self, callback=None, json_filename=None, prometheus_filename=None):
+        """
+        :param callback: called with the kind of measurement (timing, counter or gauge), its name, value and host,
+        which is None unless the measurement is about a single host. It is called from whichever thread made the
+        measurement, so it must be thread safe and quick.
+        :param json_filename: file the summary is written to as JSON by write()
+        :param prometheus_filename: file the summary is written to by write() in the Prometheus text format, for the
+        node exporter's textfile collector
+        """
+        self.callback = callback
+        self.json_filename = json_filename
+        self.prometheus_filename = prometheus_filename
+        self.start = time.time()
+        self.lock = threading.Lock()
+        # stage name to [count, total seconds, max seconds]
+        self.timings = {}
+        # (name, host) to total
+        self.counters = {}
+        # (name, host) to [current value, max value]
+        self.gauges = {}
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        """
+        Time a block of code as a stage
+        :param stage:
+        :return:
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.time() - start)
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            timing = self.timings.setdefault(stage, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+        if self.callback:
+            self.callback(self.TIMING, stage, seconds, None)
+
+    def count(self, name, value=1, host=None):
+        with self.lock:
+            self.counters[(name, host)] = self.counters.get((name, host), 0) + value
+        if self.callback:
+            self.callback(self.COUNTER, name, value, host)
+
+    def gauge(self, name, value, host=None):
+        with self.lock:
+            gauge = self.gauges.setdefault((name, host), [value, value])
+            gauge[0] = value
+            gauge[1] = max(gauge[1], value)
+        if self.callback:
+            self.callback(self.GAUGE, name, value, host)
+
+    def adjust(self, name, delta, host=None):
+        """
+        Change a gauge by an amount, such as the depth of a queue several exports add to
+        :param name:
+        :param delta:
+        :param host:
+        :return:
+        """
+        with self.lock:
+            gauge = self.gauges.setdefault((name, host), [0, 0])
+            gauge[0] += delta
+            gauge[1] = max(gauge[1], gauge[0])
+            value = gauge[0]
+        if self.callback:
+            self.callback(self.GAUGE, name, value, host)
+
+    def summary(self):
+        """
+        :return: dict of everything measured so far. Utilization is the share of the run the workers of a pool spent
+        busy, from the time spent in the page and asset stages and the page_workers and asset_workers gauges.
+        """
+        with self.lock:
+            elapsed_seconds = time.time() - self.start
+            stages = {stage: {'count': count, 'total_seconds': total, 'max_seconds': maximum}
+                      for stage, (count, total, maximum) in sorted(self.timings.items())}
+            counters = {}
+            for (name, host), value in sorted(self.counters.items(), key=lambda item: (item[0][0], item[0][1] or '')):
+                if host is None:
+                    counters[name] = value
+                else:
+                    counters.setdefault(name, {})[host] = value
+            gauges = {}
+            for (name, host), (value, maximum) in sorted(self.gauges.items(),
+                                                         key=lambda item: (item[0][0], item[0][1] or '')):
+                if host is None:
+                    gauges[name] = {'value': value, 'max': maximum}
+                else:
+                    gauges.setdefault(name, {})[host] = {'value': value, 'max': maximum}
+        utilization = {}
+        for pool, stage in [('page_workers', 'page'), ('asset_workers', 'asset')]:
+            if pool in gauges and stage in stages and elapsed_seconds > 0:
+                utilization[pool] = stages[stage]['total_seconds'] / (gauges[pool]['max'] * elapsed_seconds)
+        return {
+            'elapsed_seconds': elapsed_seconds,
+            'stages': stages,
+            'counters': counters,
+            'gauges': gauges,
+            'utilization': utilization
+        }
+
+    def write(self):
+        """
+        Write the summary to the JSON and Prometheus files, whichever were given. Each file is written under a
+        temporary name and moved into place, so a collector never reads half a file.
+        :return: the summary
+        """
+        summary = self.summary()
+        if self.json_filename:
+            self.__write_file(self.json_filename, json.dumps(summary, indent=2, sort_keys=True) + '\n')
+        if self.prometheus_filename:
+            self.__write_file(self.prometheus_filename, self.prometheus_text(summary))
+        return summary
+
+    @classmethod
+    def prometheus_text(cls, summary):
+        """
+        :param summary: as returned by summary()
+        :return: the summary in the Prometheus text exposition format
+        """
+        lines = []
+
+        def metric(name, metric_type, samples):
+            full_name = '%s_%s' % (cls.PROMETHEUS_PREFIX, name)
+            lines.append('# TYPE %s %s' % (full_name, metric_type))
+            for labels, value in samples:
+                label_text = ','.join('%s="%s"' % (key, str(label).replace('\\', '\\\\').replace('"', '\\"'))
+                                      for key, label in labels)
+                lines.append('%s%s %s' % (full_name, '{%s}' % label_text if label_text else '', repr(float(value))))
+
+        metric('elapsed_seconds', 'gauge', [((), summary['elapsed_seconds'])])
+        stages = summary['stages']
+        metric('stage_seconds_total', 'counter',
+               [((('stage', stage),), timing['total_seconds']) for stage, timing in stages.items()])
+        metric('stage_count_total', 'counter',
+               [((('stage', stage),), timing['count']) for stage, timing in stages.items()])
+        metric('stage_max_seconds', 'gauge',
+               [((('stage', stage),), timing['max_seconds']) for stage, timing in stages.items()])
+        for name, value in summary['counters'].items():
+            if isinstance(value, dict):
+                metric(name + '_total', 'counter', [((('host', host),), host_value)
+                                                    for host, host_value in value.items()])
+            else:
+                metric(name + '_total', 'counter', [((), value)])
+        for name, value in summary['gauges'].items():
+            if 'value' in value:
+                metric(name, 'gauge', [((), value['value'])])
+            else:
+                metric(name, 'gauge', [((('host', host),), host_value['value'])
+                                       for host, host_value in value.items()])
+        metric('utilization_ratio', 'gauge', [((('pool', pool),), ratio)
+                                              for pool, ratio in summary['utilization'].items()])
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def __write_file(filename, text):
+        with open(filename + '.part', 'w', encoding='utf-8') as output_file:
+            output_file.write(text)
+        os.replace(filename + '.part', filename)
@@ -0,0 +1,144 @@
+import glob
+import json
+import os
+import re
+from datetime import datetime
+
+
+class PostExtractor:
+    """
+    Pulls structured records out of the posts on each page while the export already has the page parsed, so threads
+    can be analyzed without parsing the saved html again. Posts are written as JSON lines, a file per page while the
+    export runs, stitched into one file for the whole thread at the end, and optionally converted to parquet.
+    """
+    POSTS_FOLDER = 'posts'
+    POSTS_FILENAME = 'posts.jsonl'
+    POSTS_PARQUET_FILENAME = 'posts.parquet'
+    PAGE_POSTS_PATTERN_FILENAME = 'page_%d.jsonl'
+    POSTED_AT_FORMAT = '%b %d, %Y %H:%M'
+    POSTED_AT_PATTERN = re.compile(r'[A-Z][a-z]{2} \d{1,2}, \d{4} \d{2}:\d{2}')
+    QUOTED_POST_PATTERN = re.compile(r'(?:postid=|#post)(\d+)')
+    USERID_CLASS_PREFIX = 'userid-'
+
+    @classmethod
+    def extract(cls, soup, page_number):
+        """
+        Read the posts on a page into plain records that can be written as JSON
+        :param soup: the page, after it has been rewritten so image references point at the local copies
+        :param page_number:
+        :return: list of dicts, one per post, in the order they appear on the page
+        """
+        posts = []
+        for post_elem in soup.findAll('table', class_='post'):
+            post_id_string = post_elem.get('id', '')[len('post'):]
+            if not post_id_string.isdigit():
+                continue
+            post = {
+                'post_id': int(post_id_string),
+                'page_number': page_number,
+                'author_id': None,
+                'author': None,
+                'posted_at': None,
+                'body_html': None,
+                'body_text': None,
+                'quoted_post_ids': [],
+                'images': []
+            }
+
+            userinfo_elem = post_elem.find('td', class_='userinfo')
+            if userinfo_elem:
+                for class_ in userinfo_elem.get('class', []):
+                    if class_.startswith(cls.USERID_CLASS_PREFIX) and class_[len(cls.USERID_CLASS_PREFIX):].isdigit():
+                        post['author_id'] = int(class_[len(cls.USERID_CLASS_PREFIX):])
+                author_elem = userinfo_elem.find('dt', class_='author')
+                if author_elem:
+                    post['author'] = author_elem.get_text().strip()
+
+            postdate_elem = post_elem.find('td', class_='postdate')
+            posted_at_match = cls.POSTED_AT_PATTERN.search(postdate_elem.get_text()) if postdate_elem else None
+            if posted_at_match:
+                post['posted_at'] = datetime.strptime(posted_at_match.group(0), cls.POSTED_AT_FORMAT).isoformat()
+
+            postbody_elem = post_elem.find('td', class_='postbody')
+            if postbody_elem:
+                post['body_html'] = postbody_elem.decode_contents().strip()
+                post['body_text'] = postbody_elem.get_text().strip()
+                for quote_link_elem in postbody_elem.findAll('a', class_='quote_link'):
+                    quoted_post_matches = cls.QUOTED_POST_PATTERN.findall(quote_link_elem.get('href', ''))
+                    if quoted_post_matches:
+                        post['quoted_post_ids'].append(int(quoted_post_matches[-1]))
+                post['images'] = [img['src'] for img in postbody_elem.findAll('img') if img.has_attr('src')]
+            posts.append(post)
+        return posts
+
+    @classmethod
+    def write_page(cls, posts, output_folder, page_number):
+        """
+        Write the posts from one page to their own JSON lines file, under a temporary name until complete. Keeping a
+        file per page means pages can be saved in any order, or skipped on a rerun, and still be stitched together in
+        order.
+        :param posts:
+        :param output_folder:
+        :param page_number:
+        :return:
+        """
+        posts_folder = os.path.join(output_folder, cls.POSTS_FOLDER)
+        os.makedirs(posts_folder, exist_ok=True)
+        page_posts_filename = os.path.join(posts_folder, cls.PAGE_POSTS_PATTERN_FILENAME % page_number)
+        with open(page_posts_filename + '.part', 'w', encoding='utf-8') as page_posts_file:
+            for post in posts:
+                page_posts_file.write(json.dumps(post, ensure_ascii=False) + '\n')
+        os.replace(page_posts_filename + '.part', page_posts_filename)
+
+    @classmethod
+    def stitch(cls, output_folder, parquet=False):
+        """
+        Join the posts from every page into a single JSON lines file for the whole thread, in page order, and
+        optionally a parquet file as well. Writing parquet requires pyarrow.
+        :param output_folder:
+        :param parquet:
+        :return: the number of posts
+        """
+        page_posts_filenames = []
+        for page_posts_filename in glob.glob(os.path.join(output_folder, cls.POSTS_FOLDER, 'page_*.jsonl')):
+            page_number = int(os.path.basename(page_posts_filename)[len('page_'):-len('.jsonl')])
+            page_posts_filenames.append((page_number, page_posts_filename))
+
+        posts_filename = os.path.join(output_folder, cls.POSTS_FILENAME)
+        posts_count = 0
+        with open(posts_filename + '.part', 'w', encoding='utf-8') as posts_file:
+            for page_number, page_posts_filename in sorted(page_posts_filenames):
+                with open(page_posts_filename, encoding='utf-8') as page_posts_file:
+                    for line in page_posts_file:
+                        posts_file.write(line)
+                        posts_count += 1
+        os.replace(posts_filename + '.part', posts_filename)
+
+        if parquet:
+            cls.write_parquet(posts_filename, os.path.join(output_folder, cls.POSTS_PARQUET_FILENAME))
+        return posts_count
+
+    @staticmethod
+    def write_parquet(posts_filename, parquet_filename):
+        """
+        Convert a JSON lines file of posts to a parquet file, which loads much faster for analysis
+        :param posts_filename:
+        :param parquet_filename:
+        :return:
+        """
+        import pyarrow
+        import pyarrow.parquet
+        with open(posts_filename, encoding='utf-8') as posts_file:
+            posts = [json.loads(line) for line in posts_file]
+        pyarrow.parquet.write_table(pyarrow.Table.from_pylist(posts), parquet_filename + '.part')
+        os.replace(parquet_filename + '.part', parquet_filename)
+
+    @classmethod
+    def read(cls, output_folder):
+        """
+        :param output_folder: folder of a thread export made with posts extracted
+        :return: generator of post dicts
+        """
+        with open(os.path.join(output_folder, cls.POSTS_FILENAME), encoding='utf-8') as posts_file:
+            for line in posts_file:
+                yield json.loads(line)
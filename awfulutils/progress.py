@@ -0,0 +1,388 @@
+import collections
+import concurrent.futures
+import contextlib
+import threading
+import time
+
+
+class ExportCancelled(Exception):
+    """
+    Raised when an export is cancelled through its ExportControl. Pages and images that were not finished are left to
+    the next export of the thread.
+    """
+
+
+class ProgressEvent:
+    """
+    Something that happened during a thread export, passed to the export's listener as it happens
+    """
+    __slots__ = ('threadid', 'time')
+    kind = None
+
+    def __init__(self, threadid):
+        self.threadid = threadid
+        self.time = time.time()
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join('%s=%r' % (name, getattr(self, name))
+                                                         for cls in reversed(type(self).__mro__)
+                                                         for name in getattr(cls, '__slots__', ())))
+
+
+class PageStarted(ProgressEvent):
+    __slots__ = ('page_number', 'total_pages')
+    kind = 'page_started'
+
+    def __init__(self, threadid, page_number, total_pages):
+        super().__init__(threadid)
+        self.page_number = page_number
+        self.total_pages = total_pages
+
+
+class PageFinished(ProgressEvent):
+    __slots__ = ('page_number', 'total_pages', 'size', 'queued_assets_count', 'seconds')
+    kind = 'page_finished'
+
+    def __init__(self, threadid, page_number, total_pages, size, queued_assets_count, seconds):
+        super().__init__(threadid)
+        self.page_number = page_number
+        self.total_pages = total_pages
+        self.size = size
+        self.queued_assets_count = queued_assets_count
+        self.seconds = seconds
+
+
+class PageFailed(ProgressEvent):
+    __slots__ = ('page_number', 'error')
+    kind = 'page_failed'
+
+    def __init__(self, threadid, page_number, error):
+        super().__init__(threadid)
+        self.page_number = page_number
+        self.error = error
+
+
+class AssetFetched(ProgressEvent):
+    """
+    An image or stylesheet was saved, either downloaded or, if stored is true, linked from the asset store
+    """
+    __slots__ = ('url', 'filename', 'page_number', 'size', 'stored')
+    kind = 'asset_fetched'
+
+    def __init__(self, threadid, url, filename, page_number, size, stored):
+        super().__init__(threadid)
+        self.url = url
+        self.filename = filename
+        self.page_number = page_number
+        self.size = size
+        self.stored = stored
+
+
+class AssetFailed(ProgressEvent):
+    __slots__ = ('url', 'filename', 'page_number', 'error')
+    kind = 'asset_failed'
+
+    def __init__(self, threadid, url, filename, page_number, error):
+        super().__init__(threadid)
+        self.url = url
+        self.filename = filename
+        self.page_number = page_number
+        self.error = error
+
+
+class ExportProgress(ProgressEvent):
+    """
+    How far along the export is, sent after every page and image. The estimate of the seconds left is None until
+    there is something to base it on.
+    """
+    __slots__ = ('pages_done', 'total_pages', 'assets_done', 'assets_failed', 'assets_queued', 'bytes_downloaded',
+                 'elapsed_seconds', 'eta_seconds')
+    kind = 'progress'
+
+    def __init__(self, threadid, pages_done, total_pages, assets_done, assets_failed, assets_queued, bytes_downloaded,
+                 elapsed_seconds, eta_seconds):
+        super().__init__(threadid)
+        self.pages_done = pages_done
+        self.total_pages = total_pages
+        self.assets_done = assets_done
+        self.assets_failed = assets_failed
+        self.assets_queued = assets_queued
+        self.bytes_downloaded = bytes_downloaded
+        self.elapsed_seconds = elapsed_seconds
+        self.eta_seconds = eta_seconds
+
+
+class ExportFinished(ProgressEvent):
+    """
+    Sent by an ExportHandle once the export has finished, with what ThreadExport.save() returned
+    """
+    __slots__ = ('result',)
+    kind = 'export_finished'
+
+    def __init__(self, threadid, result):
+        super().__init__(threadid)
+        self.result = result
+
+
+class ExportFailed(ProgressEvent):
+    """
+    Sent by an ExportHandle if the export failed or was cancelled, in which case the error is ExportCancelled
+    """
+    __slots__ = ('error',)
+    kind = 'export_failed'
+
+    def __init__(self, threadid, error):
+        super().__init__(threadid)
+        self.error = error
+
+
+class ProgressTracker:
+    """
+    Keeps count of the pages and images of an export as its workers report on them, passing each report on to a
+    listener as a ProgressEvent followed by an ExportProgress. Without a listener nothing is counted.
+    """
+    def __init__(self, threadid, listener=None):
+        """
+        :param threadid:
+        :param listener: called with every ProgressEvent from whichever worker thread it happened on, so it must be
+        thread safe and quick
+        """
+        self.threadid = threadid
+        self.listener = listener
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.total_pages = 0
+        self.pages_done = 0
+        self.assets_queued = 0
+        self.assets_done = 0
+        self.assets_failed = 0
+        self.bytes_downloaded = 0
+
+    def pages_queued(self, count):
+        if self.listener:
+            with self.lock:
+                self.total_pages += count
+
+    def page_started(self, page_number, total_pages):
+        if self.listener:
+            self.listener(PageStarted(self.threadid, page_number, total_pages))
+
+    def page_finished(self, page_number, total_pages, size, queued_assets_count, seconds):
+        if self.listener:
+            with self.lock:
+                self.pages_done += 1
+                self.bytes_downloaded += size
+            self.__send(PageFinished(self.threadid, page_number, total_pages, size, queued_assets_count, seconds))
+
+    def page_failed(self, page_number, error):
+        if self.listener:
+            with self.lock:
+                self.pages_done += 1
+            self.__send(PageFailed(self.threadid, page_number, error))
+
+    def asset_queued(self):
+        if self.listener:
+            with self.lock:
+                self.assets_queued += 1
+
+    def asset_fetched(self, url, filename, page_number, size, stored):
+        if self.listener:
+            with self.lock:
+                self.assets_done += 1
+                if not stored:
+                    self.bytes_downloaded += size
+            self.__send(AssetFetched(self.threadid, url, filename, page_number, size, stored))
+
+    def asset_failed(self, url, filename, page_number, error):
+        if self.listener:
+            with self.lock:
+                self.assets_done += 1
+                self.assets_failed += 1
+            self.__send(AssetFailed(self.threadid, url, filename, page_number, error))
+
+    def progress(self):
+        """
+        :return: ExportProgress as of now. The estimate of the seconds left goes by whichever of the pages and the
+        images will take longer to finish at the rate they have been finishing so far.
+        """
+        with self.lock:
+            elapsed_seconds = time.time() - self.start
+            estimates = []
+            for done, total in [(self.pages_done, self.total_pages), (self.assets_done, self.assets_queued)]:
+                if done:
+                    estimates.append(elapsed_seconds / done * max(total - done, 0))
+                elif total:
+                    estimates.append(None)
+            eta_seconds = None if not estimates or None in estimates else max(estimates)
+            return ExportProgress(self.threadid, self.pages_done, self.total_pages, self.assets_done,
+                                  self.assets_failed, self.assets_queued, self.bytes_downloaded, elapsed_seconds,
+                                  eta_seconds)
+
+    def __send(self, event):
+        self.listener(event)
+        self.listener(self.progress())
+
+
+class ExportControl:
+    """
+    Lets another thread pause, resume or cancel an export while it runs, or change how many of its pages and images
+    are worked on at once. Workers ask for a slot before starting on a page or image, and wait while the export is
+    paused or already has as many underway as allowed. Pages and images underway are left to finish, except that
+    images still downloading stop as soon as the export is cancelled. Only as many pages and images can be underway as
+    the export has workers, so the limits can be lowered and raised again but not past that.
+    """
+    PAGE = 'page'
+    ASSET = 'asset'
+
+    def __init__(self, page_workers=None, asset_workers=None):
+        """
+        :param page_workers: most pages worked on at once, None for as many as there are page workers
+        :param asset_workers: most images and stylesheets downloaded at once, None for as many as there are workers
+        """
+        self.condition = threading.Condition()
+        self.limits = {self.PAGE: page_workers, self.ASSET: asset_workers}
+        self.active = {self.PAGE: 0, self.ASSET: 0}
+        self.paused = False
+        self.cancelled = False
+
+    def pause(self):
+        with self.condition:
+            self.paused = True
+
+    def resume(self):
+        with self.condition:
+            self.paused = False
+            self.condition.notify_all()
+
+    def cancel(self):
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify_all()
+
+    def set_concurrency(self, page_workers=None, asset_workers=None):
+        """
+        Change how many pages and images may be worked on at once. Lowering a limit lets the pages or images underway
+        finish before it applies.
+        :param page_workers: new limit on pages, or None to leave it as it is
+        :param asset_workers: new limit on images and stylesheets, or None to leave it as it is
+        :return:
+        """
+        with self.condition:
+            for kind, limit in [(self.PAGE, page_workers), (self.ASSET, asset_workers)]:
+                if limit is not None:
+                    self.limits[kind] = max(limit, 1)
+            self.condition.notify_all()
+
+    def check(self):
+        """
+        :raises ExportCancelled: if the export has been cancelled
+        """
+        if self.cancelled:
+            raise ExportCancelled()
+
+    @contextlib.contextmanager
+    def slot(self, kind):
+        """
+        Wait until a page or image may be started, and hold its place until it is finished
+        :param kind: PAGE or ASSET
+        :raises ExportCancelled: if the export is cancelled before it may be started
+        """
+        with self.condition:
+            while not self.cancelled and (self.paused or (self.limits[kind] is not None and
+                                                           self.active[kind] >= self.limits[kind])):
+                self.condition.wait()
+            self.check()
+            self.active[kind] += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active[kind] -= 1
+                self.condition.notify_all()
+
+
+class ExportHandle:
+    """
+    A thread export running in the background, returned by AwfulClient.export_thread(background=True). Everything
+    that happens during the export can be read from events() as it happens, and the export can be paused, resumed,
+    cancelled and have its concurrency changed while it runs. Events not read yet are kept up to a limit, past which
+    the oldest are dropped, so a handle only ever followed through its listener does not fill up memory.
+    """
+    DEFAULT_MAX_BUFFERED_EVENTS = 10000
+
+    def __init__(self, threadid, run, listener=None, max_buffered_events=DEFAULT_MAX_BUFFERED_EVENTS):
+        """
+        :param threadid:
+        :param run: function that runs the export when called with the handle's ExportControl and a listener for its
+        ProgressEvents, returning the result of the export
+        :param listener: also called with every ProgressEvent, from whichever thread it happened on
+        :param max_buffered_events: most events kept for events() to read
+        """
+        self.threadid = threadid
+        self.control = ExportControl()
+        self.listener = listener
+        self.condition = threading.Condition()
+        self.buffered_events = collections.deque(maxlen=max_buffered_events)
+        self.dropped_events_count = 0
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='export-%d' % threadid)
+        self.future = executor.submit(self.__run, run)
+        executor.shutdown(wait=False)
+
+    def events(self, timeout=None):
+        """
+        Events of the export as they happen, ending with ExportFinished or ExportFailed. Every event is only read
+        once, even if this is called again. If more events than the handle keeps have not been read, the oldest of
+        them are skipped.
+        :param timeout: stop early if no event arrives within this many seconds
+        :return: iterator of ProgressEvents
+        """
+        while True:
+            with self.condition:
+                if not self.condition.wait_for(lambda: self.buffered_events, timeout):
+                    return
+                event = self.buffered_events.popleft()
+            yield event
+            if isinstance(event, (ExportFinished, ExportFailed)):
+                return
+
+    def pause(self):
+        self.control.pause()
+
+    def resume(self):
+        self.control.resume()
+
+    def cancel(self):
+        self.control.cancel()
+
+    def set_concurrency(self, page_workers=None, asset_workers=None):
+        self.control.set_concurrency(page_workers=page_workers, asset_workers=asset_workers)
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        """
+        Wait for the export to finish
+        :param timeout:
+        :return: dict with the number of pages saved, new posts found and images and stylesheets downloaded
+        :raises ExportCancelled: if the export was cancelled
+        """
+        return self.future.result(timeout)
+
+    def __run(self, run):
+        try:
+            result = run(self.control, self.__send)
+        except BaseException as e:
+            self.__send(ExportFailed(self.threadid, e))
+            raise
+        self.__send(ExportFinished(self.threadid, result))
+        return result
+
+    def __send(self, event):
+        with self.condition:
+            if len(self.buffered_events) == self.buffered_events.maxlen:
+                self.dropped_events_count += 1
+            self.buffered_events.append(event)
+            self.condition.notify_all()
+        if self.listener:
+            self.listener(event)
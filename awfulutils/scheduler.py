@@ -0,0 +1,232 @@
+import logging
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+
+from awfulutils.metrics import ExportMetrics
+
+logger = logging.getLogger(__name__)
+
+
+class HostState:
+    """
+    What the scheduler knows about a single host: how many requests it currently allows at once, how many are in
+    flight, when the next request may start and how quickly it has been answering
+    """
+    def __init__(self, concurrency, min_interval):
+        self.concurrency = float(concurrency)
+        self.min_interval = min_interval
+        self.active = 0
+        self.next_start = 0.0
+        self.latency = None
+        self.baseline_latency = None
+        self.condition = threading.Condition()
+
+
+class RequestScheduler:
+    """
+    Every request to the forums and to image hosts goes through here. Requests are limited per host, both in how many
+    run at once and how often one may start. Transient failures (timeouts, dropped connections, 5xx and 429 responses)
+    are retried with jittered exponential backoff. The number of requests allowed at once adapts to each host: it
+    grows slowly while the host keeps answering quickly, and is halved whenever the host fails, throttles or slows
+    down, so throughput stays around the most a host will tolerate. A host's latency is the time until its response
+    headers arrive, so large images that take a while to stream do not count against it.
+
+    Only the threaded engine goes through the scheduler. AsyncThreadExport limits the connections to each host with
+    its own connector instead, without rate limits or adapting to how the host answers.
+    """
+    DEFAULT_INITIAL_CONCURRENCY = 4
+    DEFAULT_MAX_CONCURRENCY = 16
+    DEFAULT_MAX_RETRIES = 4
+    DEFAULT_BACKOFF_SECONDS = 0.5
+    MAX_BACKOFF_SECONDS = 60
+    RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+    # a host whose recent average latency rises past this multiple of its long term average is treated as overloaded
+    LATENCY_TOLERANCE = 2.0
+    LATENCY_SMOOTHING = 0.2
+    BASELINE_LATENCY_SMOOTHING = 0.02
+
+    def __init__(self, initial_concurrency=DEFAULT_INITIAL_CONCURRENCY, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 max_retries=DEFAULT_MAX_RETRIES, backoff_seconds=DEFAULT_BACKOFF_SECONDS, requests_per_second=None,
+                 metrics=None):
+        """
+        :param initial_concurrency: requests allowed at once to a host before anything is known about it
+        :param max_concurrency: most requests ever allowed at once to a single host
+        :param max_retries: how many times a transient failure is retried before giving up
+        :param backoff_seconds: delay before the first retry, doubled for each one after, with full jitter
+        :param requests_per_second: dict of host name to the most requests that may be started per second, None or
+        a missing host means no limit. The key None applies to every host not listed.
+        :param metrics: ExportMetrics the retries and the concurrency of each host are recorded in
+        """
+        self.initial_concurrency = initial_concurrency
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.requests_per_second = requests_per_second or {}
+        self.metrics = metrics or ExportMetrics()
+        self.lock = threading.Lock()
+        self.hosts = {}
+        self.retries_count = 0
+        self.local = threading.local()
+
+    def get(self, session, url, **kwargs):
+        """
+        Make a GET request through a session, retrying transient failures
+        :param session:
+        :param url:
+        :param kwargs: passed through to session.get
+        :return: the response, which may still be an error if retries ran out
+        """
+        return self.call(url, session.get, url, **kwargs)
+
+    def call(self, url, function, *args, **kwargs):
+        """
+        Run a function that makes a request to a url, such as a download that streams the response to disk, once a
+        request to its host is allowed. It is run again if it raises a transient error or returns a response with a
+        status code worth retrying.
+        :param url: url the function requests, used to find the host
+        :param function:
+        :return: whatever the function returns
+        """
+        host_name = urlparse(url).hostname or ''
+        host = self.__host(host_name)
+        attempt = 0
+        while True:
+            self.__acquire(host)
+            start = time.time()
+            self.local.headers_time = None
+            retry_after = None
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                response = getattr(e, 'response', None)
+                transient = isinstance(e, (requests.Timeout, requests.ConnectionError,
+                                           requests.exceptions.ChunkedEncodingError)) or self.__should_retry(response)
+                self.__release(host_name, host, self.__latency(start, response), ok=not transient)
+                if not transient or attempt >= self.max_retries:
+                    raise
+                reason = repr(e)
+                retry_after = self.__retry_after(response)
+            else:
+                retry = self.__should_retry(result)
+                self.__release(host_name, host, self.__latency(start, result), ok=not retry)
+                if not retry or attempt >= self.max_retries:
+                    return result
+                reason = 'status %d' % result.status_code
+                retry_after = self.__retry_after(result)
+                result.close()
+
+            attempt += 1
+            delay = random.uniform(0, min(self.MAX_BACKOFF_SECONDS, self.backoff_seconds * 2 ** (attempt - 1)))
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+                # a host asking us to back off is asking every worker, not just this one
+                with host.condition:
+                    host.next_start = max(host.next_start, time.time() + retry_after)
+            with self.lock:
+                self.retries_count += 1
+            self.metrics.count('retries', host=host_name)
+            logger.warning('Retrying %s in %.1f seconds (attempt %d of %d) due to %s'
+                           % (url, delay, attempt, self.max_retries, reason))
+            time.sleep(delay)
+
+    def headers_received(self):
+        """
+        Called by a function run through call() once the response headers have arrived, before it reads the body, so
+        that only the time until then counts as the host's latency
+        :return:
+        """
+        self.local.headers_time = time.time()
+
+    def concurrency(self, host_name):
+        """
+        :param host_name:
+        :return: number of requests currently allowed at once to a host
+        """
+        return int(self.__host(host_name).concurrency)
+
+    def __host(self, host_name):
+        with self.lock:
+            host = self.hosts.get(host_name)
+            if host is None:
+                requests_per_second = self.requests_per_second.get(host_name, self.requests_per_second.get(None))
+                host = HostState(self.initial_concurrency, 1.0 / requests_per_second if requests_per_second else 0.0)
+                self.hosts[host_name] = host
+            return host
+
+    @staticmethod
+    def __acquire(host):
+        """
+        Wait until a host allows another request at once and the rate limit allows another request to start
+        :param host:
+        :return:
+        """
+        with host.condition:
+            while True:
+                now = time.time()
+                if host.active < int(host.concurrency) and now >= host.next_start:
+                    host.active += 1
+                    host.next_start = max(host.next_start, now) + host.min_interval
+                    return
+                host.condition.wait(timeout=max(host.next_start - now, 0) or None)
+
+    def __release(self, host_name, host, latency, ok):
+        """
+        Let the next request to a host start and adjust how many the host allows at once. Concurrency goes up by about
+        one for every window of successful requests and is halved when the host fails, or when its recent latency
+        climbs well above its long term average, which is what queueing at an overloaded host looks like.
+        :param host_name:
+        :param host:
+        :param latency: seconds until the host answered
+        :param ok: whether the host answered properly
+        :return:
+        """
+        with host.condition:
+            host.active -= 1
+            if ok:
+                if host.latency is None:
+                    host.latency = host.baseline_latency = latency
+                host.latency += self.LATENCY_SMOOTHING * (latency - host.latency)
+                host.baseline_latency += self.BASELINE_LATENCY_SMOOTHING * (latency - host.baseline_latency)
+                if host.latency > self.LATENCY_TOLERANCE * max(host.baseline_latency, 0.001):
+                    host.concurrency = max(1.0, host.concurrency / 2)
+                    # give the lower concurrency a chance before judging latency again
+                    host.latency = host.baseline_latency
+                else:
+                    host.concurrency = min(float(self.max_concurrency), host.concurrency + 1 / host.concurrency)
+            else:
+                host.concurrency = max(1.0, host.concurrency / 2)
+            host.condition.notify_all()
+            concurrency = host.concurrency
+        self.metrics.gauge('host_concurrency', int(concurrency), host=host_name)
+
+    def __latency(self, start, response):
+        """
+        :param start: time the request was started
+        :param response: what the request returned, if anything
+        :return: seconds until the response headers arrived, or until the request finished if that is not known
+        """
+        if self.local.headers_time is not None:
+            return self.local.headers_time - start
+        elapsed = getattr(response, 'elapsed', None)
+        if elapsed is not None:
+            return elapsed.total_seconds()
+        return time.time() - start
+
+    def __should_retry(self, response):
+        return response is not None and getattr(response, 'status_code', None) in self.RETRY_STATUS_CODES
+
+    def __retry_after(self, response):
+        """
+        :param response:
+        :return: seconds the server asked us to wait before trying again, or None
+        """
+        if response is None:
+            return None
+        retry_after = response.headers.get('Retry-After', '')
+        if not retry_after.isdigit():
+            return None
+        return min(float(retry_after), self.MAX_BACKOFF_SECONDS)
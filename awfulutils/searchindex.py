@@ -0,0 +1,142 @@
+import itertools
+import os
+import sqlite3
+import threading
+
+from awfulutils.manifest import ExportManifest
+from awfulutils.posts import PostExtractor
+
+
+class SearchIndex:
+    """
+    Full text index of the posts in any number of thread exports, kept in a single SQLite database using FTS5. Posts
+    are indexed a page at a time as each page is saved, and a page that is saved again by a later export replaces what
+    was indexed for it before, so the index follows the exports incrementally. Searches return the post ids along with
+    the saved page and anchor each post can be found at.
+    """
+    DEFAULT_FILENAME = 'awful_search.sqlite'
+    DEFAULT_LIMIT = 20
+    SNIPPET_TOKENS = 16
+
+    def __init__(self, filename=DEFAULT_FILENAME):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False, isolation_level=None, timeout=30)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS posts (
+                post_id INTEGER PRIMARY KEY,
+                threadid INTEGER NOT NULL,
+                page_number INTEGER NOT NULL,
+                page_filename TEXT NOT NULL,
+                author TEXT,
+                posted_at TEXT
+            );
+            CREATE INDEX IF NOT EXISTS posts_page ON posts (threadid, page_number);
+            CREATE VIRTUAL TABLE IF NOT EXISTS posts_text USING fts5 (
+                author,
+                body,
+                tokenize = 'unicode61 remove_diacritics 2'
+            );
+        ''')
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM posts').fetchone()[0]
+
+    def index_page(self, threadid, page_number, page_filename, posts):
+        """
+        Index the posts on a saved page, replacing whatever was indexed for the page before
+        :param threadid:
+        :param page_number:
+        :param page_filename: saved page the posts can be viewed in
+        :param posts: post records as produced by PostExtractor.extract
+        :return:
+        """
+        with self.lock:
+            self.connection.execute('BEGIN')
+            try:
+                self.connection.execute('DELETE FROM posts_text WHERE rowid IN'
+                                        ' (SELECT post_id FROM posts WHERE threadid = ? AND page_number = ?)',
+                                        (threadid, page_number))
+                self.connection.execute('DELETE FROM posts WHERE threadid = ? AND page_number = ?',
+                                        (threadid, page_number))
+                for post in posts:
+                    # a post can move to another page when earlier posts are deleted
+                    self.connection.execute('DELETE FROM posts_text WHERE rowid = ?', (post['post_id'],))
+                    self.connection.execute('INSERT OR REPLACE INTO posts (post_id, threadid, page_number,'
+                                            ' page_filename, author, posted_at) VALUES (?, ?, ?, ?, ?, ?)',
+                                            (post['post_id'], threadid, page_number, page_filename, post['author'],
+                                             post['posted_at']))
+                    self.connection.execute('INSERT INTO posts_text (rowid, author, body) VALUES (?, ?, ?)',
+                                            (post['post_id'], post['author'] or '', post['body_text'] or ''))
+            except Exception:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+
+    def index_export(self, threadid, output_folder):
+        """
+        Index every post in a thread export made before the index existed. The export must have been made with posts
+        extracted.
+        :param threadid:
+        :param output_folder:
+        :return: the number of posts indexed
+        """
+        # imported here since awfulclient depends on this module
+        from awfulutils.awfulclient import PageRewriter
+        manifest = ExportManifest(output_folder)
+        page_pad_zeros = len(str(manifest.get('total_pages', 1)))
+        manifest.close()
+        posts_count = 0
+        for page_number, posts in itertools.groupby(PostExtractor.read(output_folder),
+                                                    key=lambda post: post['page_number']):
+            posts = list(posts)
+            page_filename = os.path.join(output_folder,
+                                         PageRewriter.PAGE_PATTERN_FILENAME % str(page_number).zfill(page_pad_zeros))
+            self.index_page(threadid, page_number, page_filename, posts)
+            posts_count += len(posts)
+        return posts_count
+
+    def optimize(self):
+        """
+        Merge the index into as few pieces as possible, which makes searches faster after a lot has been indexed
+        :return:
+        """
+        with self.lock:
+            self.connection.execute("INSERT INTO posts_text (posts_text) VALUES ('optimize')")
+
+    def search(self, query, threadid=None, limit=DEFAULT_LIMIT):
+        """
+        Find the posts matching a query, best matches first
+        :param query: FTS5 query, such as words that must all appear, "a phrase", author:name or word OR word
+        :param threadid: only search this thread
+        :param limit: most results returned
+        :return: list of dicts with the post id, thread id, page number, author, post time, a snippet of the matching
+        text, and the anchor of the post in its saved page
+        """
+        sql = ('SELECT posts.post_id, posts.threadid, posts.page_number, posts.page_filename, posts.author,'
+               " posts.posted_at, snippet(posts_text, 1, '[', ']', '...', ?)"
+               ' FROM posts_text JOIN posts ON posts.post_id = posts_text.rowid WHERE posts_text MATCH ?')
+        parameters = [self.SNIPPET_TOKENS, query]
+        if threadid is not None:
+            sql += ' AND posts.threadid = ?'
+            parameters.append(threadid)
+        sql += ' ORDER BY rank LIMIT ?'
+        parameters.append(limit)
+        with self.lock:
+            rows = self.connection.execute(sql, parameters).fetchall()
+        return [{
+            'post_id': post_id,
+            'threadid': threadid,
+            'page_number': page_number,
+            'author': author,
+            'posted_at': posted_at,
+            'snippet': snippet,
+            'anchor': '%s#post%d' % (page_filename, post_id)
+        } for post_id, threadid, page_number, page_filename, author, posted_at, snippet in rows]
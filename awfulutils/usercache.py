@@ -0,0 +1,100 @@
+import collections
+import json
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+
+class UserInfoCache:
+    """
+    Least recently used cache of user details that expire after a while, kept in memory and optionally backed by a
+    SQLite database so lookups made by previous runs can be reused. Entries that fall out of memory are still served
+    from the database until they expire.
+    """
+    DEFAULT_MAX_ENTRIES = 100000
+    DEFAULT_TTL_SECONDS = 7 * 24 * 60 * 60
+    DATETIME_FIELDS = ['join_date', 'last_post']
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl_seconds=DEFAULT_TTL_SECONDS, filename=None):
+        """
+        :param max_entries: number of users kept in memory
+        :param ttl_seconds: how long user details are trusted before they are fetched again
+        :param filename: SQLite database to keep user details in across runs, in memory only if not set
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.connection = None
+        if filename:
+            self.connection = sqlite3.connect(filename, check_same_thread=False, isolation_level=None, timeout=30)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS users (userid INTEGER PRIMARY KEY, data TEXT NOT NULL,'
+                                    ' fetched_at REAL NOT NULL)')
+
+    def close(self):
+        with self.lock:
+            if self.connection:
+                self.connection.close()
+                self.connection = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, userid):
+        """
+        :param userid:
+        :return: the cached UserInfo, or None if the user is not cached or has expired
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(userid)
+            if entry:
+                fetched_at, userinfo = entry
+                if now - fetched_at < self.ttl_seconds:
+                    self.entries.move_to_end(userid)
+                    return userinfo
+                del self.entries[userid]
+            if not self.connection:
+                return None
+            row = self.connection.execute('SELECT data, fetched_at FROM users WHERE userid = ? AND fetched_at > ?',
+                                          (userid, now - self.ttl_seconds)).fetchone()
+            if not row:
+                return None
+            userinfo = self.__from_json(row[0])
+            self.__remember(userid, row[1], userinfo)
+            return userinfo
+
+    def put(self, userid, userinfo):
+        now = time.time()
+        with self.lock:
+            self.__remember(userid, now, userinfo)
+            if self.connection:
+                self.connection.execute('INSERT OR REPLACE INTO users (userid, data, fetched_at) VALUES (?, ?, ?)',
+                                        (userid, self.__to_json(userinfo), now))
+
+    def __remember(self, userid, fetched_at, userinfo):
+        self.entries[userid] = (fetched_at, userinfo)
+        self.entries.move_to_end(userid)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    @classmethod
+    def __to_json(cls, userinfo):
+        data = {}
+        for field in userinfo.__slots__:
+            value = getattr(userinfo, field)
+            data[field] = value.isoformat() if field in cls.DATETIME_FIELDS and value else value
+        return json.dumps(data)
+
+    @classmethod
+    def __from_json(cls, data):
+        # imported here since awfulclient depends on this module
+        from awfulutils.awfulclient import UserInfo
+        userinfo = UserInfo()
+        for field, value in json.loads(data).items():
+            if field in UserInfo.__slots__:
+                setattr(userinfo, field, datetime.fromisoformat(value) if field in cls.DATETIME_FIELDS and value
+                        else value)
+        return userinfo
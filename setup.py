@@ -14,13 +14,20 @@ setup(
     author='Greg Barker',
     author_email='fletch@fletchowns.net',
     url='https://github.com/fletchowns/awfulutils',
-    scripts = ['bin/awful_export_thread'],
+    scripts = ['bin/awful_export_thread', 'bin/awful_export_threads', 'bin/awful_search', 'bin/awful_view',
+               'bin/awful_benchmark'],
     keywords=['something awful'],
     install_requires=[
         'html5lib',
         'requests',
         'beautifulsoup4'
     ],
+    extras_require={
+        'async': ['aiohttp'],
+        'lxml': ['lxml'],
+        'parquet': ['pyarrow'],
+        'media': ['Pillow']
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Intended Audience :: Developers',
@@ -1,9 +1,46 @@
+import asyncio
+import glob
+import hashlib
+import json
 import os
+import tempfile
+import threading
+import time
 import unittest
 import datetime
 import shutil
 
-from awfulutils.awfulclient import AwfulClient
+import requests
+
+from awfulutils.archive import ArchiveServer, ThreadArchive
+from awfulutils.assetstore import AssetStore
+from awfulutils.awfulclient import AssetDownloader, AwfulClient, PageRewriter, ThreadExport
+from awfulutils.benchmark import Benchmark, ForumStandIn
+from awfulutils.manifest import ExportManifest
+from awfulutils.media import MediaStage
+from awfulutils.metrics import ExportMetrics
+from awfulutils.posts import PostExtractor
+from awfulutils.progress import ExportCancelled, ExportControl
+from awfulutils.scheduler import RequestScheduler
+from awfulutils.searchindex import SearchIndex
+from awfulutils.usercache import UserInfoCache
+
+try:
+    import lxml
+except ImportError:
+    lxml = None
+
+try:
+    import PIL.Image
+except ImportError:
+    PIL = None
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+TEST_DATA_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_data')
 
 
 class MyTestCase(unittest.TestCase):
@@ -39,6 +76,818 @@ class MyTestCase(unittest.TestCase):
         self.assertTrue(os.path.exists(output_folder))
         shutil.rmtree(output_folder)
 
+    def test_export_threads(self):
+        threadids = [3677640, 2675400]
+        results = self.awful_client.export_threads(threadids)
+        for threadid in threadids:
+            self.assertIsNotNone(results[threadid])
+            output_folder = 'somethingawful_thread_%d' % threadid
+            self.assertTrue(os.path.exists(output_folder))
+            shutil.rmtree(output_folder)
+
+
+class PageRewriterTestCase(unittest.TestCase):
+    """
+    Every parser and rewriting engine must produce exactly the same page as the html5lib multi pass reference
+    """
+    def setUp(self):
+        self.sample_pages = []
+        for sample_filename in sorted(glob.glob(os.path.join(TEST_DATA_FOLDER, 'showthread*.html'))):
+            with open(sample_filename, encoding='utf-8') as sample_file:
+                self.sample_pages.append(sample_file.read())
+        self.assertTrue(self.sample_pages)
+
+    def assert_equivalent(self, parser, single_pass):
+        reference = PageRewriter(3677640, 6, 'output')
+        rewriter = PageRewriter(3677640, 6, 'output', parser=parser, single_pass=single_pass)
+        for html in self.sample_pages:
+            expected_html, expected_assets = reference.render(html, 2)
+            actual_html, actual_assets = rewriter.render(html, 2)
+            self.assertEqual(actual_html, expected_html)
+            self.assertEqual(actual_assets, expected_assets)
+
+    def test_serialize(self):
+        rewriter = PageRewriter(3677640, 6, 'output')
+        for html in self.sample_pages:
+            page_soup, assets = rewriter.rewrite(html, 2)
+            self.assertEqual(''.join(PageRewriter.serialize(page_soup)), page_soup.prettify())
+            self.assertEqual(''.join(PageRewriter.serialize(page_soup, pretty=False)), page_soup.decode())
+
+    def test_html5lib_single_pass(self):
+        self.assert_equivalent('html5lib', True)
+
+    @unittest.skipUnless(lxml, 'lxml is not installed')
+    def test_lxml(self):
+        self.assert_equivalent('lxml', False)
+
+    @unittest.skipUnless(lxml, 'lxml is not installed')
+    def test_lxml_single_pass(self):
+        self.assert_equivalent('lxml', True)
+
+    @unittest.skipUnless(lxml, 'lxml is not installed')
+    def test_table_bodies(self):
+        # the forums leave out the tbody of post tables, and of tables posted in them
+        html = self.sample_pages[-1]
+        self.assertNotIn('<tbody', html)
+        for single_pass in [False, True]:
+            rewriter = PageRewriter(3677640, 6, 'output', parser='lxml', single_pass=single_pass)
+            page_soup, assets = rewriter.rewrite(html, 2)
+            tables = page_soup.findAll('table')
+            self.assertEqual(len(tables), 3)
+            for table in tables:
+                self.assertEqual([child.name for child in table.findAll(recursive=False)], ['tbody'])
+
+    def test_thread_details(self):
+        html = self.sample_pages[0]
+        self.assertEqual(ThreadExport.parse_total_pages(html), 6)
+        page_soup, assets = PageRewriter(3677640, 6, 'output').rewrite(html, 2)
+        self.assertEqual(PageRewriter.find_post_ids(page_soup)[:3], [200, 201, 202])
+
+
+class PostExtractorTestCase(unittest.TestCase):
+    def setUp(self):
+        with open(os.path.join(TEST_DATA_FOLDER, 'showthread.html'), encoding='utf-8') as sample_file:
+            self.page_soup, assets = PageRewriter(3677640, 6, 'output').rewrite(sample_file.read(), 2)
+        self.output_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_folder)
+
+    def test_extract(self):
+        posts = PostExtractor.extract(self.page_soup, 2)
+        self.assertEqual([post['post_id'] for post in posts], [200, 201, 202])
+        self.assertEqual(posts[0]['author_id'], 1)
+        self.assertEqual(posts[0]['author'], 'user1')
+        self.assertEqual(posts[0]['posted_at'], '2014-11-03T19:00:00')
+        self.assertEqual(posts[0]['quoted_post_ids'], [199])
+        self.assertIn('images/smile.gif', posts[0]['images'])
+        self.assertTrue(posts[0]['body_text'].startswith('Hello from post 200 & friends'))
+
+    def test_stitch(self):
+        posts = PostExtractor.extract(self.page_soup, 2)
+        # pages are stitched in page order no matter which was saved first
+        PostExtractor.write_page(posts[1:], self.output_folder, 10)
+        PostExtractor.write_page(posts[:1], self.output_folder, 9)
+        self.assertEqual(PostExtractor.stitch(self.output_folder), 3)
+        self.assertEqual([post['post_id'] for post in PostExtractor.read(self.output_folder)], [200, 201, 202])
+
+
+class SearchIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        with open(os.path.join(TEST_DATA_FOLDER, 'showthread.html'), encoding='utf-8') as sample_file:
+            page_soup, assets = PageRewriter(3677640, 6, 'output').rewrite(sample_file.read(), 2)
+        self.posts = PostExtractor.extract(page_soup, 2)
+        self.folder = tempfile.mkdtemp()
+        self.search_index = SearchIndex(os.path.join(self.folder, SearchIndex.DEFAULT_FILENAME))
+
+    def tearDown(self):
+        self.search_index.close()
+        shutil.rmtree(self.folder)
+
+    def test_search(self):
+        self.search_index.index_page(3677640, 2, 'output/page_2.html', self.posts)
+        results = self.search_index.search('cafe friends')
+        self.assertEqual([result['post_id'] for result in results], [200])
+        self.assertEqual(results[0]['threadid'], 3677640)
+        self.assertEqual(results[0]['anchor'], 'output/page_2.html#post200')
+        self.assertIn('[friends]', results[0]['snippet'])
+        self.assertEqual(self.search_index.search('cafe', threadid=1), [])
+
+    def test_page_saved_again(self):
+        self.search_index.index_page(3677640, 2, 'output/page_2.html', self.posts)
+        self.search_index.index_page(3677640, 3, 'output/page_3.html', [])
+        # a post that moves to another page is only found on the page it is on now
+        self.search_index.index_page(3677640, 2, 'output/page_2.html', self.posts[1:])
+        self.search_index.index_page(3677640, 3, 'output/page_3.html', self.posts[:1])
+        self.assertEqual(len(self.search_index), 3)
+        self.assertEqual([result['anchor'] for result in self.search_index.search('cafe')],
+                         ['output/page_3.html#post200'])
+
+
+class ThreadArchiveTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.output_folder = os.path.join(self.folder, ThreadExport.OUTPUT_FOLDER_PATTERN % 3677640)
+        os.mkdir(self.output_folder)
+        ExportManifest(self.output_folder).close()
+        with open(os.path.join(TEST_DATA_FOLDER, 'showthread.html'), encoding='utf-8') as sample_file:
+            self.page_soup, assets = PageRewriter(3677640, 6, self.output_folder).rewrite(sample_file.read(), 2)
+        self.posts = PostExtractor.extract(self.page_soup, 2)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write(self, name, data):
+        filename = os.path.join(self.output_folder, name)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'wb') as output_file:
+            output_file.write(data)
+
+    def test_pack(self):
+        self.write('page_1.html', b'first')
+        self.write('page_2.html', b'second')
+        self.write('images/smile.gif', b'GIF89a')
+        PostExtractor.write_page(self.posts[:1], self.output_folder, 1)
+        PostExtractor.write_page(self.posts[1:], self.output_folder, 2)
+        archive_filename = ThreadArchive.pack(self.output_folder, remove=True)
+        self.assertEqual(os.listdir(self.output_folder), [ExportManifest.FILENAME])
+
+        # a later export only has the pages it fetched again, which replace the packed ones
+        self.write('page_02.html', b'second again')
+        self.write('page_10.html', b'tenth')
+        PostExtractor.write_page([], self.output_folder, 10)
+        ThreadArchive.pack(self.output_folder, remove=True)
+        archive = ThreadArchive(archive_filename)
+        self.assertEqual(archive.total_pages, 10)
+        self.assertEqual(archive.page(1), b'first')
+        self.assertEqual(archive.page(2), b'second again')
+        self.assertNotIn('page_2.html', archive.names())
+        self.assertEqual(archive.read('images/smile.gif'), b'GIF89a')
+        posts = [json.loads(line) for line in archive.read(PostExtractor.POSTS_FILENAME).splitlines()]
+        self.assertEqual([post['post_id'] for post in posts], [200, 201, 202])
+        archive.close()
+
+    def test_serve(self):
+        self.write('page_1.html', b'first')
+        ThreadArchive.pack(self.output_folder, remove=True)
+        server = ArchiveServer(self.folder, ('127.0.0.1', 0))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = 'http://127.0.0.1:%d/%s/' % (server.server_address[1], os.path.basename(self.output_folder))
+        try:
+            r = requests.get(url)
+            self.assertEqual(r.url, url + 'page_1.html')
+            self.assertEqual(r.content, b'first')
+            self.assertEqual(requests.get(url + 'page_2.html').status_code, 404)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class MediaStageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.output_folder = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.output_folder, 'images'))
+        self.manifest = ExportManifest(self.output_folder)
+
+    def tearDown(self):
+        self.manifest.close()
+        shutil.rmtree(self.output_folder)
+
+    def add_image(self, name, data):
+        filename = os.path.join(self.output_folder, 'images', name)
+        with open(filename, 'wb') as output_file:
+            output_file.write(data)
+        self.manifest.asset_complete(filename, 'http://example.com/' + name, len(data),
+                                     hashlib.sha256(data).hexdigest())
+        return filename
+
+    def test_deduplicate(self):
+        first_filename = self.add_image('smile_1.gif', b'GIF89a smile')
+        second_filename = self.add_image('smile_2.gif', b'GIF89a smile')
+        misnamed_filename = self.add_image('attachment_1', b'\x89PNG\r\n\x1a\n')
+        media_stage = MediaStage()
+        result = media_stage.process(self.output_folder, self.manifest)
+        self.assertEqual(result['duplicates_count'], 1)
+        self.assertTrue(os.path.samefile(first_filename, second_filename))
+        media_names = os.listdir(os.path.join(self.output_folder, MediaStage.MEDIA_FOLDER))
+        self.assertEqual(sorted(os.path.splitext(name)[1] for name in media_names), ['.gif', '.png'])
+        self.assertEqual(MediaStage.detect_type(misnamed_filename), 'png')
+
+    @unittest.skipIf(PIL is None, 'Pillow is not installed')
+    def test_recompress(self):
+        image = PIL.Image.new('RGB', (256, 256), (200, 30, 30))
+        image_filename = os.path.join(self.output_folder, 'uncompressed.png')
+        image.save(image_filename, 'PNG', compress_level=0)
+        with open(image_filename, 'rb') as image_file:
+            filename = self.add_image('big.png', image_file.read())
+        media_stage = MediaStage(recompress=True, min_recompress_size=1024, processes=1)
+        result = media_stage.process(self.output_folder, self.manifest)
+        media_stage.close()
+        self.assertEqual(result['recompressed_count'], 1)
+        self.assertLess(os.path.getsize(filename), os.path.getsize(image_filename))
+        with PIL.Image.open(filename) as recompressed_image:
+            self.assertEqual(recompressed_image.size, (256, 256))
+
+
+class ExportManifestTestCase(unittest.TestCase):
+    def setUp(self):
+        self.output_folder = tempfile.mkdtemp()
+        self.manifest = ExportManifest(self.output_folder)
+
+    def tearDown(self):
+        self.manifest.close()
+        shutil.rmtree(self.output_folder)
+
+    def test_resume(self):
+        self.assertEqual(self.manifest.pages_to_fetch(5), [1, 2, 3, 4, 5])
+        self.manifest.set('total_pages', 5)
+        image_filename = os.path.join(self.output_folder, 'images', 'smile.gif')
+        for page_number in [1, 2, 4, 5]:
+            self.manifest.page_complete(page_number, 100, 'abc', [('http://fi.somethingawful.com/smile.gif',
+                                                                   image_filename)])
+
+        # page 3 never finished and page 5 was the last page so it has probably changed
+        self.assertEqual(self.manifest.pages_to_fetch(6), [3, 5, 6])
+        self.assertEqual(self.manifest.unfinished_assets(),
+                         [('http://fi.somethingawful.com/smile.gif', image_filename, 1)])
+        self.manifest.asset_complete(image_filename, 'http://fi.somethingawful.com/smile.gif', 10, 'def')
+        self.assertTrue(self.manifest.asset_is_complete(image_filename))
+        self.assertEqual(self.manifest.unfinished_assets(), [])
+
+    def test_import_existing_export(self):
+        folder = os.path.join(self.output_folder, 'legacy')
+        os.makedirs(os.path.join(folder, 'images'))
+        # page 1 refers to an image a crash left empty, and page 3 was left empty itself
+        files = {'page_1.html': '<img src="images/a.png"/>', 'page_2.html': '<img src="images/b.png"/>',
+                 'page_3.html': '', os.path.join('images', 'a.png'): '', os.path.join('images', 'b.png'): 'PNG'}
+        for filename, contents in files.items():
+            with open(os.path.join(folder, filename), 'w', encoding='utf-8') as output_file:
+                output_file.write(contents)
+        manifest = ExportManifest(folder)
+        self.assertEqual(manifest.pages_to_fetch(3), [1, 3])
+        self.assertFalse(manifest.asset_is_complete(os.path.join(folder, 'images', 'a.png')))
+        self.assertTrue(manifest.asset_is_complete(os.path.join(folder, 'images', 'b.png')))
+        manifest.close()
+
+    def test_page_filenames_change(self):
+        self.manifest.set('total_pages', 9)
+        for page_number in range(1, 10):
+            self.manifest.page_complete(page_number, 100, 'abc', [])
+        self.assertEqual(self.manifest.pages_to_fetch(10), list(range(1, 11)))
+
+    def test_page_validators(self):
+        self.assertEqual(self.manifest.page_validators(1), (None, None))
+        self.manifest.page_complete(1, 100, 'abc', [], etag='"abc"', last_modified='Sat, 17 Oct 2026 10:00:00 GMT')
+        self.assertEqual(self.manifest.page_validators(1), ('"abc"', 'Sat, 17 Oct 2026 10:00:00 GMT'))
+        self.manifest.page_failed(1)
+        self.assertEqual(self.manifest.page_validators(1), (None, None))
+
+
+class AssetStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.asset_store = AssetStore(os.path.join(self.folder, 'store'))
+
+    def tearDown(self):
+        self.asset_store.close()
+        shutil.rmtree(self.folder)
+
+    def test_add_and_link(self):
+        url = 'http://fi.somethingawful.com/images/smilies/emot-smile.gif'
+        self.assertIsNone(self.asset_store.lookup(url))
+        downloaded_filename = os.path.join(self.folder, 'emot-smile.gif')
+        with open(downloaded_filename, 'wb') as downloaded_file:
+            downloaded_file.write(b'GIF89a')
+        stored_filename = self.asset_store.add(url, downloaded_filename, 6, 'abc123')
+        self.assertEqual(self.asset_store.lookup(url), (stored_filename, 6, 'abc123'))
+
+        # a second url with the same contents shares the stored file
+        self.assertEqual(self.asset_store.add(url + '?v=2', downloaded_filename, 6, 'abc123'), stored_filename)
+
+        output_filename = os.path.join(self.folder, 'linked.gif')
+        AssetStore.link(stored_filename, output_filename)
+        with open(output_filename, 'rb') as output_file:
+            self.assertEqual(output_file.read(), b'GIF89a')
+
+
+class UserInfoTestCase(unittest.TestCase):
+    def setUp(self):
+        with open(os.path.join(TEST_DATA_FOLDER, 'member.html'), encoding='utf-8') as member_file:
+            self.userinfo = AwfulClient.parse_userinfo(member_file.read())
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_parse_userinfo(self):
+        self.assertEqual(self.userinfo.username, 'fletcher')
+        self.assertEqual(self.userinfo.aim_handle, 'cafe scholzen')
+        self.assertEqual(self.userinfo.join_date, datetime.datetime(2003, 6, 26))
+        self.assertEqual(self.userinfo.last_post, datetime.datetime(2014, 11, 6, hour=19, minute=23))
+        self.assertEqual(self.userinfo.post_count, 6073)
+        self.assertFalse(hasattr(self.userinfo, '__dict__'))
+
+    def test_cache_evicts_least_recently_used(self):
+        cache = UserInfoCache(max_entries=2)
+        cache.put(1, self.userinfo)
+        cache.put(2, self.userinfo)
+        cache.get(1)
+        cache.put(3, self.userinfo)
+        self.assertIs(cache.get(1), self.userinfo)
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(len(cache), 2)
+
+    def test_cache_expires(self):
+        cache = UserInfoCache(ttl_seconds=0)
+        cache.put(1, self.userinfo)
+        self.assertIsNone(cache.get(1))
+
+    def test_cache_persists(self):
+        filename = os.path.join(self.folder, 'users.sqlite')
+        cache = UserInfoCache(filename=filename)
+        cache.put(38563, self.userinfo)
+        cache.close()
+
+        cache = UserInfoCache(filename=filename)
+        userinfo = cache.get(38563)
+        cache.close()
+        self.assertEqual(userinfo.username, 'fletcher')
+        self.assertEqual(userinfo.last_post, datetime.datetime(2014, 11, 6, hour=19, minute=23))
+
+
+class ForumPageTestCase(unittest.TestCase):
+    def test_parse_forum_page(self):
+        with open(os.path.join(TEST_DATA_FOLDER, 'forumdisplay.html'), encoding='utf-8') as forum_file:
+            forum_threads, total_pages = AwfulClient.parse_forum_page(forum_file.read())
+        self.assertEqual(total_pages, 3)
+        self.assertEqual([forum_thread.threadid for forum_thread in forum_threads], [3677640, 2675400])
+        self.assertEqual(forum_threads[0].title, 'General Programming Questions Not Worth Their Own Thread')
+        self.assertEqual(forum_threads[0].replies, 1234)
+        self.assertEqual(forum_threads[0].last_post, datetime.datetime(2026, 10, 17, hour=21, minute=44))
+        self.assertEqual(forum_threads[1].title, 'Post your desktop & setup')
+
+
+class ExportMetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.measurements = []
+        self.metrics = ExportMetrics(callback=lambda *measurement: self.measurements.append(measurement),
+                                     json_filename=os.path.join(self.folder, 'metrics.json'),
+                                     prometheus_filename=os.path.join(self.folder, 'metrics.prom'))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_write(self):
+        with self.metrics.time('parse'):
+            pass
+        self.metrics.observe('parse', 2.0)
+        self.metrics.count('bytes_downloaded', 100, host='forums.somethingawful.com')
+        self.metrics.count('bytes_downloaded', 50, host='forums.somethingawful.com')
+        self.metrics.count('asset_store_hits')
+        self.metrics.adjust('asset_queue_depth', 3)
+        self.metrics.adjust('asset_queue_depth', -1)
+        summary = self.metrics.write()
+        self.assertEqual(summary['stages']['parse']['count'], 2)
+        self.assertEqual(summary['stages']['parse']['max_seconds'], 2.0)
+        self.assertEqual(summary['counters'], {'asset_store_hits': 1,
+                                               'bytes_downloaded': {'forums.somethingawful.com': 150}})
+        self.assertEqual(summary['gauges']['asset_queue_depth'], {'value': 2, 'max': 3})
+        self.assertEqual(len(self.measurements), 7)
+        self.assertIn(('counter', 'asset_store_hits', 1, None), self.measurements)
+
+        with open(os.path.join(self.folder, 'metrics.json')) as json_file:
+            self.assertEqual(json.load(json_file)['counters']['asset_store_hits'], 1)
+        with open(os.path.join(self.folder, 'metrics.prom')) as prometheus_file:
+            prometheus_text = prometheus_file.read()
+        self.assertIn('awfulutils_stage_count_total{stage="parse"} 2.0\n', prometheus_text)
+        self.assertIn('awfulutils_bytes_downloaded_total{host="forums.somethingawful.com"} 150.0\n', prometheus_text)
+
+    def test_page_timings(self):
+        with open(os.path.join(TEST_DATA_FOLDER, 'showthread.html'), encoding='utf-8') as sample_file:
+            page = PageRewriter(3677640, 6, self.folder).save(sample_file.read(), 2,
+                                                              os.path.join(self.folder, 'page_2.html'))
+        self.assertEqual(sorted(page['timings']), ['disk_write', 'parse', 'rewrite', 'serialize'])
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    def test_stand_in(self):
+        stand_in = ForumStandIn(TEST_DATA_FOLDER, failure_rate=0.5, seed=1)
+        forums_url = stand_in.start()
+        try:
+            html = stand_in.thread_page(12, 3)
+            self.assertEqual(ThreadExport.parse_total_pages(html), 12)
+            self.assertIn('id="post3200"', html)
+            self.assertNotIn('somethingawful.com', html)
+            self.assertIn('%s/ext/pic200_3.png' % stand_in.assets_url, html)
+            self.assertEqual(ThreadExport.parse_total_pages(stand_in.thread_page(12, 12)), 12)
+
+            statuses = []
+            for _ in range(20):
+                try:
+                    statuses.append(requests.get(forums_url + '/images/smile.gif').status_code)
+                except requests.ConnectionError:
+                    statuses.append(None)
+            self.assertIn(200, statuses)
+            self.assertEqual(len([status for status in statuses if status != 200]), stand_in.failures_count)
+        finally:
+            stand_in.stop()
+        data, content_type = stand_in.asset('/images/smile.gif')
+        self.assertEqual(content_type, 'image/gif')
+        self.assertTrue(data.startswith(b'GIF89a'))
+        self.assertEqual(len(data), ForumStandIn.DEFAULT_ASSET_SIZE)
+        self.assertNotEqual(stand_in.asset('/images/frown.gif')[0], data)
+
+    def test_run(self):
+        results = Benchmark(TEST_DATA_FOLDER, thread_sizes=[2], userinfo_count=3).run()
+        export_result, userinfo_result = results['results']
+        self.assertEqual(export_result['saved_pages_count'], 2)
+        self.assertGreater(export_result['downloaded_assets_count'], 10)
+        self.assertGreater(export_result['pages_per_second'], 0)
+        self.assertGreater(export_result['cpu_seconds'], 0)
+        self.assertEqual(userinfo_result['users'], 3)
+        self.assertIn('users_per_second', userinfo_result)
+        self.assertEqual(json.loads(json.dumps(results)), results)
+
+        slower = json.loads(json.dumps(results))
+        slower['results'][0]['pages_per_second'] /= 2
+        changes = Benchmark.compare(slower, results)
+        self.assertEqual([(change['measurement'], change['worse']) for change in changes],
+                         [('pages_per_second', False)])
+        self.assertTrue(Benchmark.compare(results, slower)[0]['worse'])
+
+        fewer_assets = json.loads(json.dumps(results))
+        fewer_assets['results'][0]['assets_per_second'] *= 2
+        changes = Benchmark.compare(fewer_assets, results)
+        self.assertEqual([(change['measurement'], change['worse']) for change in changes],
+                         [('assets_per_second', True)])
+
+
+class StandInTestCase(unittest.TestCase):
+    """
+    Exports to a temporary folder from a ForumStandIn instead of the forums
+    """
+    STAND_IN_OPTIONS = {}
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.previous_folder = os.getcwd()
+        os.chdir(self.folder)
+        self.stand_in = ForumStandIn(TEST_DATA_FOLDER, **self.STAND_IN_OPTIONS)
+        self.forums_url = AwfulClient.FORUMS_URL
+        AwfulClient.FORUMS_URL = self.stand_in.start()
+        self.awful_client = AwfulClient(0, '', scheduler=RequestScheduler(backoff_seconds=0.01))
+
+    def tearDown(self):
+        AwfulClient.FORUMS_URL = self.forums_url
+        self.stand_in.stop()
+        os.chdir(self.previous_folder)
+        shutil.rmtree(self.folder)
+
+    def export_folder(self, threadid):
+        return os.path.join(self.folder, ThreadExport.OUTPUT_FOLDER_PATTERN % threadid)
+
+
+class ForumExportTestCase(StandInTestCase):
+    STAND_IN_OPTIONS = {'thread_pages': {3677640: 2, 2675400: 1}}
+
+    def test_last_post_recorded_once_complete(self):
+        # an image on the first page of every thread is gone
+        self.stand_in.errors[r'/ext/pic200_1\.png'] = 404
+        results = self.awful_client.export_forum(273, max_pages=1)
+        self.assertEqual(sorted(results), [2675400, 3677640])
+        self.assertEqual(results[3677640]['unfinished_assets_count'], 1)
+        self.assertIsNone(ThreadExport.previous_forum_last_post(3677640))
+
+        # the thread is exported again rather than skipped, and is recorded as up to date once the image is back
+        del self.stand_in.errors[r'/ext/pic200_1\.png']
+        results = self.awful_client.export_forum(273, max_pages=1)
+        self.assertEqual(sorted(results), [2675400, 3677640])
+        self.assertEqual(results[3677640]['unfinished_assets_count'], 0)
+        self.assertEqual(results[3677640]['unfinished_pages_count'], 0)
+        self.assertEqual(ThreadExport.previous_forum_last_post(3677640), datetime.datetime(2026, 10, 17, 21, 44))
+        self.assertEqual(self.awful_client.export_forum(273, max_pages=1), {})
+
+
+class AssetDownloaderTestCase(StandInTestCase):
+    def test_finished_per_manifest(self):
+        asset_downloader = AssetDownloader(scheduler=self.awful_client.scheduler)
+        manifests = []
+        for folder in ['first', 'second', 'third']:
+            os.mkdir(folder)
+            manifests.append(ExportManifest(folder))
+        first, second, third = manifests
+        held_back = ExportControl()
+        held_back.pause()
+        asset_downloader.enqueue(self.stand_in.assets_url + '/a.png', os.path.join('first', 'a.png'), 1, first)
+        asset_downloader.enqueue(self.stand_in.assets_url + '/b.png', os.path.join('second', 'b.png'), 1, second,
+                                 control=held_back)
+
+        # the first manifest's download is done while the second's is still held back
+        first_finished, second_finished, third_finished = threading.Event(), threading.Event(), threading.Event()
+        asset_downloader.when_finished(first, first_finished.set)
+        asset_downloader.when_finished(second, second_finished.set)
+        asset_downloader.when_finished(third, third_finished.set)
+        self.assertTrue(first_finished.wait(10))
+        self.assertTrue(third_finished.is_set())
+        self.assertEqual(asset_downloader.pop_downloaded_count(first), 1)
+        self.assertFalse(second_finished.is_set())
+        # only the downloads still pending are kept
+        self.assertEqual(list(asset_downloader.futures), [os.path.join('second', 'b.png')])
+        self.assertEqual(list(asset_downloader.pending_counts), [second])
+
+        held_back.resume()
+        self.assertTrue(second_finished.wait(10))
+        self.assertEqual(asset_downloader.wait(), 2)
+        self.assertEqual((asset_downloader.futures, asset_downloader.pending_counts), ({}, {}))
+        self.assertEqual(dict(asset_downloader.manifest_filenames), {})
+        for manifest in manifests:
+            manifest.close()
+
+    def test_connections_reused(self):
+        asset_downloader = AssetDownloader(max_workers=2, scheduler=self.awful_client.scheduler)
+        for number in range(10):
+            asset_downloader.enqueue(self.stand_in.assets_url + '/%d.png' % number, '%d.png' % number, 1)
+        self.assertEqual(asset_downloader.wait(), 10)
+        # every worker opens one keep-alive connection and every other download reuses one
+        adapter = asset_downloader.adapter
+        self.assertEqual(adapter.connections_opened + adapter.connections_reused, 10)
+        self.assertGreaterEqual(adapter.connections_opened, 1)
+        self.assertLessEqual(adapter.connections_opened, 2)
+
+    def assets_requested(self):
+        return {path: count for path, count in self.stand_in.paths_requested.items()
+                if not path.startswith('/showthread.php')}
+
+    def test_each_url_fetched_once(self):
+        # smilies, avatars and stylesheets are on every page, but only fetched once
+        results = self.awful_client.export_threads([3])
+        self.assertEqual(results[3]['unfinished_assets_count'], 0)
+        assets_requested = self.assets_requested()
+        self.assertIn('/images/smilies/smile.gif', assets_requested)
+        self.assertEqual(set(assets_requested.values()), {1})
+        self.assertEqual(results[3]['downloaded_assets_count'], len(assets_requested))
+
+        # nothing is fetched again on a rerun, even for the last page which is saved again
+        self.stand_in.paths_requested.clear()
+        results = self.awful_client.export_threads([3])
+        self.assertEqual((results[3]['saved_pages_count'], results[3]['downloaded_assets_count']), (1, 0))
+        self.assertEqual(self.assets_requested(), {})
+
+    def test_each_url_fetched_once_across_threads(self):
+        asset_store = AssetStore('store')
+        results = self.awful_client.export_threads([2, 3], asset_store=asset_store)
+        asset_store.close()
+        self.assertEqual([results[threadid]['unfinished_assets_count'] for threadid in [2, 3]], [0, 0])
+        self.assertEqual(set(self.assets_requested().values()), {1})
+        for threadid in [2, 3]:
+            self.assertTrue(os.path.exists(os.path.join(self.export_folder(threadid), 'images', 'smile.gif')))
+
+
+class SyncTestCase(StandInTestCase):
+    def pages_requested(self):
+        return sorted((path, count) for path, count in self.stand_in.paths_requested.items()
+                      if path.startswith('/showthread.php'))
+
+    def test_unchanged(self):
+        self.awful_client.export_thread(3)
+        manifest = ExportManifest(self.export_folder(3))
+        etags = [manifest.page_validators(page_number)[0] for page_number in [1, 2, 3]]
+        manifest.close()
+        self.assertTrue(all(etags))
+        page_filenames = glob.glob(os.path.join(self.export_folder(3), 'page_*.html'))
+        modified_times = [os.path.getmtime(filename) for filename in page_filenames]
+
+        # only the last page is asked for, with its ETag, and the 304 keeps the page that was saved
+        self.stand_in.paths_requested.clear()
+        result = self.awful_client.export_thread(3, sync=True)
+        self.assertEqual((result['saved_pages_count'], result['new_posts_count']), (0, 0))
+        self.assertEqual(self.pages_requested(), [('/showthread.php?perpage=40&threadid=3&pagenumber=3', 1)])
+        self.assertEqual([os.path.getmtime(filename) for filename in page_filenames], modified_times)
+
+    def test_new_page(self):
+        self.awful_client.export_thread(3)
+        self.stand_in.thread_pages[3] = 4
+        self.stand_in.paths_requested.clear()
+        result = self.awful_client.export_thread(3, sync=True)
+        self.assertEqual((result['saved_pages_count'], result['unfinished_pages_count']), (2, 0))
+        self.assertEqual(self.pages_requested(), [('/showthread.php?perpage=40&threadid=3&pagenumber=3', 1),
+                                                  ('/showthread.php?perpage=40&threadid=3&pagenumber=4', 1)])
+
+
+class ParseProcessesTestCase(StandInTestCase):
+    def exported_pages(self, threadid):
+        pages = {}
+        for filename in glob.glob(os.path.join(self.export_folder(threadid), 'page_*.html')):
+            with open(filename, 'rb') as page_file:
+                pages[os.path.basename(filename)] = page_file.read()
+        return pages
+
+    def test_same_output(self):
+        self.awful_client.export_threads([2, 3])
+        expected_pages = {threadid: self.exported_pages(threadid) for threadid in [2, 3]}
+        self.assertEqual([len(expected_pages[threadid]) for threadid in [2, 3]], [2, 3])
+
+        # pages of every thread in the batch are parsed by one shared pool of processes
+        for threadid in [2, 3]:
+            shutil.rmtree(self.export_folder(threadid))
+        results = self.awful_client.export_threads([2, 3], parse_processes=2)
+        self.assertEqual([results[threadid]['saved_pages_count'] for threadid in [2, 3]], [2, 3])
+        for threadid in [2, 3]:
+            self.assertEqual(self.exported_pages(threadid), expected_pages[threadid])
+
+        # a single thread starts a pool of its own
+        shutil.rmtree(self.export_folder(3))
+        self.assertEqual(self.awful_client.export_thread(3, parse_processes=2)['saved_pages_count'], 3)
+        self.assertEqual(self.exported_pages(3), expected_pages[3])
+
+
+@unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+class AsyncExportTestCase(StandInTestCase):
+    def export_thread(self, threadid, **kwargs):
+        return asyncio.run(self.awful_client.export_thread_async(threadid, backoff_seconds=0.01, **kwargs))
+
+    def test_export(self):
+        result = self.export_thread(3)
+        self.assertEqual(result['saved_pages_count'], 3)
+        self.assertGreater(result['downloaded_assets_count'], 0)
+        self.assertEqual((result['unfinished_pages_count'], result['unfinished_assets_count']), (0, 0))
+        for page_number in [1, 2, 3]:
+            self.assertTrue(os.path.exists(os.path.join(self.export_folder(3), 'page_%d.html' % page_number)))
+
+        # only the last page, which may have new posts, is saved again on a rerun
+        result = self.export_thread(3)
+        self.assertEqual((result['saved_pages_count'], result['downloaded_assets_count']), (1, 0))
+
+    def test_extract_posts(self):
+        self.export_thread(2, extract_posts=True)
+        with open(os.path.join(self.export_folder(2), PostExtractor.POSTS_FILENAME), encoding='utf-8') as posts_file:
+            self.assertEqual(len(posts_file.readlines()), 6)
+
+    def test_archive(self):
+        self.export_thread(2, archive=True)
+        self.assertTrue(os.path.exists(ThreadArchive.archive_filename(self.export_folder(2))))
+        self.assertFalse(glob.glob(os.path.join(self.export_folder(2), 'page_*.html')))
+
+    def test_retries_transient_errors(self):
+        self.stand_in.failure_rate = 0.2
+        result = self.export_thread(3, max_retries=10)
+        self.assertEqual(result['saved_pages_count'], 3)
+        self.assertEqual((result['unfinished_pages_count'], result['unfinished_assets_count']), (0, 0))
+
+    def test_error_status(self):
+        self.export_thread(3)
+        page_filename = os.path.join(self.export_folder(3), 'page_1.html')
+        with open(page_filename, 'rb') as page_file:
+            page = page_file.read()
+
+        # the error page is neither taken for a one page thread nor saved over the page saved before
+        self.stand_in.errors[r'pagenumber=1$'] = 503
+        self.assertRaises(aiohttp.ClientResponseError, self.export_thread, 3, single_pass=True, max_retries=1)
+        manifest = ExportManifest(self.export_folder(3))
+        self.assertEqual(manifest.get('total_pages'), '3')
+        manifest.close()
+        with open(page_filename, 'rb') as page_file:
+            self.assertEqual(page_file.read(), page)
+
+        # pages and images that fail are left for the next export
+        self.stand_in.errors = {r'pagenumber=2$': 404, r'/ext/pic200_1\.png': 404}
+        shutil.rmtree(self.export_folder(3))
+        result = self.export_thread(3)
+        self.assertEqual(result['saved_pages_count'], 2)
+        self.assertEqual((result['unfinished_pages_count'], result['unfinished_assets_count']), (1, 1))
+        self.stand_in.errors = {}
+        result = self.export_thread(3)
+        self.assertEqual(result['saved_pages_count'], 2)
+        self.assertEqual((result['unfinished_pages_count'], result['unfinished_assets_count']), (0, 0))
+
+
+class ExportHandleTestCase(StandInTestCase):
+    STAND_IN_OPTIONS = {'latency': 0.02}
+
+    def test_events(self):
+        listened = []
+        handle = self.awful_client.export_thread(3, background=True, listener=listened.append)
+        events = list(handle.events(timeout=30))
+        self.assertEqual(listened, events)
+        self.assertEqual(sorted(event.page_number for event in events if event.kind == 'page_finished'), [1, 2, 3])
+        self.assertEqual(len([event for event in events if event.kind == 'page_started']), 3)
+        fetched = [event for event in events if event.kind == 'asset_fetched']
+        self.assertTrue(all(os.path.exists(event.filename) for event in fetched))
+        progress = [event for event in events if event.kind == 'progress'][-1]
+        self.assertEqual((progress.pages_done, progress.total_pages), (3, 3))
+        self.assertEqual((progress.assets_done, progress.assets_queued), (len(fetched), len(fetched)))
+        self.assertEqual(progress.eta_seconds, 0)
+        self.assertGreater(progress.bytes_downloaded, ForumStandIn.DEFAULT_ASSET_SIZE * len(fetched))
+        self.assertEqual(events[-1].kind, 'export_finished')
+        self.assertEqual(handle.result()['saved_pages_count'], 3)
+
+    def test_events_dropped(self):
+        # only the newest events are kept for events(), while the listener still gets every one
+        listened = []
+        handle = self.awful_client.export_thread(3, background=True, listener=listened.append, max_buffered_events=5)
+        handle.result(30)
+        self.assertEqual(list(handle.events(timeout=5)), listened[-5:])
+        self.assertEqual(handle.dropped_events_count, len(listened) - 5)
+        self.assertEqual(listened[-1].kind, 'export_finished')
+
+    def test_cancel(self):
+        handle = self.awful_client.export_thread(3, background=True)
+        handle.pause()
+        handle.cancel()
+        self.assertRaises(ExportCancelled, handle.result, 30)
+        events = list(handle.events(timeout=30))
+        self.assertEqual([event.kind for event in events], ['export_failed'])
+        self.assertIsInstance(events[0].error, ExportCancelled)
+
+        # what was left undone is picked up by the next export
+        self.assertEqual(self.awful_client.export_thread(3)['saved_pages_count'], 3)
+
+    def test_concurrency(self):
+        control = ExportControl()
+        control.set_concurrency(page_workers=1)
+        started = threading.Event()
+
+        def save_page():
+            with control.slot(ExportControl.PAGE):
+                started.set()
+
+        with control.slot(ExportControl.PAGE):
+            thread = threading.Thread(target=save_page)
+            thread.start()
+            self.assertFalse(started.wait(0.1))
+            # other kinds of work are not held up
+            with control.slot(ExportControl.ASSET):
+                pass
+        self.assertTrue(started.wait(5))
+        thread.join()
+
+
+class RequestSchedulerTestCase(unittest.TestCase):
+    URL = 'http://forums.somethingawful.com/showthread.php?threadid=3677640'
+
+    def setUp(self):
+        self.scheduler = RequestScheduler(backoff_seconds=0, max_retries=2)
+        self.attempts = 0
+
+    def fail_twice(self, error):
+        self.attempts += 1
+        if self.attempts <= 2:
+            raise error
+        return 'page'
+
+    def test_retries_transient_errors(self):
+        self.assertEqual(self.scheduler.call(self.URL, self.fail_twice, requests.ConnectionError()), 'page')
+        self.assertEqual(self.scheduler.retries_count, 2)
+        self.assertLess(self.scheduler.concurrency('forums.somethingawful.com'),
+                        RequestScheduler.DEFAULT_INITIAL_CONCURRENCY)
+
+    def test_gives_up(self):
+        self.scheduler.max_retries = 1
+        self.assertRaises(requests.Timeout, self.scheduler.call, self.URL, self.fail_twice, requests.Timeout())
+        self.assertEqual(self.attempts, 2)
+
+    def test_does_not_retry_other_errors(self):
+        self.assertRaises(ValueError, self.scheduler.call, self.URL, self.fail_twice, ValueError())
+        self.assertEqual(self.attempts, 1)
+
+    def test_concurrency_grows(self):
+        for _ in range(20):
+            self.scheduler.call(self.URL, lambda: 'page')
+        self.assertGreater(self.scheduler.concurrency('forums.somethingawful.com'),
+                           RequestScheduler.DEFAULT_INITIAL_CONCURRENCY)
+
+    def stream_body(self, seconds):
+        self.scheduler.headers_received()
+        time.sleep(seconds)
+        return 'image'
+
+    def test_slow_body_is_not_latency(self):
+        for seconds in [0, 0, 0.05, 0.05, 0.05]:
+            self.scheduler.call(self.URL, self.stream_body, seconds)
+        self.assertGreaterEqual(self.scheduler.concurrency('forums.somethingawful.com'),
+                                RequestScheduler.DEFAULT_INITIAL_CONCURRENCY)
+
 
 if __name__ == '__main__':
     unittest.main()